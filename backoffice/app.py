@@ -1,6 +1,7 @@
 import os
 from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import joinedload
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
 # Multi-language support - manual implementation
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -11,6 +12,9 @@ from functools import wraps
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# Limite do corpo da requisição: duas imagens de até 5MB e o formulário
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
 # Multi-language configuration
 app.config['LANGUAGES'] = {
     'pt': 'Português (Brasil)',
@@ -69,14 +73,24 @@ DB_USER = os.environ.get('DB_USER', 'btl_user')
 DB_PASSWORD = os.environ.get('DB_PASSWORD', 'btl_password')
 DB_NAME = os.environ.get('DB_NAME', 'btl_db')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+# DATABASE_URL permite apontar para outro banco (ex.: sqlite:///btl.db em desenvolvimento/testes)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'DATABASE_URL',
+    f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Import models first
-from models import db, Backend_Users, Profile, Organizacao, Backyard, Atleta, AtletaBackyard
+from models import db, Backend_Users, Profile
+from services.contadores import contadores
+from services.autorizacao import principal_atual
+from services.processamento_imagens import processamento_imagens
+from services.image_service import image_service
 
 # Initialize extensions
 db.init_app(app)
+image_service.init_app(app)
+processamento_imagens.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -85,7 +99,8 @@ login_manager.login_message_category = 'info'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return Backend_Users.query.get(int(user_id))
+    # Profile vem na mesma consulta: decorators, principal e menu usam o papel em toda requisição
+    return db.session.get(Backend_Users, int(user_id), options=[joinedload(Backend_Users.profile)])
 
 # Language detection function
 def get_current_language():
@@ -120,7 +135,8 @@ def inject_conf_vars():
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome != 'Admin':
+        principal = principal_atual()
+        if principal is None or not principal.is_admin:
             flash('Access denied. Admin privileges required.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -129,7 +145,8 @@ def admin_required(f):
 def organizador_or_admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome not in ['Admin', 'Organizador']:
+        principal = principal_atual()
+        if principal is None or not (principal.is_admin or principal.is_organizador):
             flash('Access denied. Insufficient privileges.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -171,41 +188,35 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get statistics for dashboard
-    stats = {
-        'total_users': Backend_Users.query.count(),
-        'total_organizacoes': Organizacao.query.count(),
-        'total_backyards': Backyard.query.count(),
-        'total_atletas': Atleta.query.count(),
-        'total_inscricoes': AtletaBackyard.query.count(),
-    }
-    
+    # Get statistics for dashboard (cached, one query on a miss)
     # Filter based on user role
-    if current_user.profile.nome == 'Organizador':
-        # Show only organizations and backyards related to this user
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        stats['my_organizacoes'] = len(user_orgs)
-        stats['my_backyards'] = Backyard.query.filter(Backyard.organizador.in_(org_ids)).count() if org_ids else 0
-        
-        # Count atletas inscribed in organizador's backyards
-        if org_ids:
-            my_backyard_ids = [b.id for b in Backyard.query.filter(Backyard.organizador.in_(org_ids)).all()]
-            stats['my_atletas'] = db.session.query(AtletaBackyard.atleta_id).filter(
-                AtletaBackyard.backyard_id.in_(my_backyard_ids)
-            ).distinct().count() if my_backyard_ids else 0
-            stats['my_inscricoes'] = AtletaBackyard.query.filter(
-                AtletaBackyard.backyard_id.in_(my_backyard_ids)
-            ).count() if my_backyard_ids else 0
-        else:
-            stats['my_atletas'] = 0
-            stats['my_inscricoes'] = 0
+    if principal_atual().is_organizador:
+        # Also count organizations, backyards and athletes related to this user
+        stats = contadores.organizador(current_user.id)
+    else:
+        stats = contadores.globais()
     
     return render_template('dashboard.html', stats=stats)
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
+    from scheduler import scheduler, eleicao
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.utcnow().isoformat(),
+        'scheduler': scheduler.status(),
+        'scheduler_lider': eleicao.status(),
+        'imagens': processamento_imagens.status()
+    })
+
+@app.route('/imagens/trabalhos/<trabalho_id>')
+@login_required
+def status_trabalho_imagem(trabalho_id):
+    """Situação do processamento de uma imagem enviada (trabalhos deste processo)"""
+    status = processamento_imagens.status(trabalho_id)
+    if status is None:
+        return jsonify({'status': 'desconhecido'}), 404
+    return jsonify(status)
 
 # Import and register blueprints
 from views.users import users_bp
@@ -222,15 +233,39 @@ app.register_blueprint(backyards_bp, url_prefix='/backyards')
 app.register_blueprint(atletas_bp, url_prefix='/atletas')
 app.register_blueprint(loops_bp, url_prefix='/loops')
 
+# Perfil de SQL por requisição (BTL_SQL_PROFILER=true): Server-Timing, comandos lentos e N+1
+from services.sql_profiler import sql_profiler
+sql_profiler.init_app(app)
+
+@app.route('/debug/sql', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def debug_sql():
+    if request.method == 'POST':
+        sql_profiler.limpar()
+        return redirect(url_for('debug_sql'))
+    
+    requisicoes = sql_profiler.requisicoes()
+    if request.args.get('apenas') == 'problemas':
+        requisicoes = [r for r in requisicoes if r['lentas'] or r['n_mais_1']]
+    
+    return render_template('debug/sql.html',
+                         ativo=sql_profiler.ativo,
+                         limite_lento_ms=sql_profiler.limite_lento * 1000,
+                         limite_n1=sql_profiler.limite_n1,
+                         requisicoes=requisicoes)
+
 # Database initialization is handled by init_db.py
 
 # Inicializar scheduler para verificação automática de tempo limite
-try:
-    from scheduler import init_scheduler
-    init_scheduler(app)
-    print("BTL Scheduler ativado - verificação automática de tempo limite a cada 30 segundos")
-except Exception as e:
-    print(f"AVISO: Não foi possível inicializar o scheduler: {str(e)}")
+# (BTL_SCHEDULER_ENABLED=false em scripts como init_db.py, que apenas importam o app)
+if os.environ.get('BTL_SCHEDULER_ENABLED', 'true').lower() == 'true':
+    try:
+        from scheduler import init_scheduler
+        init_scheduler(app)
+        print("BTL Scheduler ativado - eliminação automática no prazo de cada loop (processo líder)")
+    except Exception as e:
+        print(f"AVISO: Não foi possível inicializar o scheduler: {str(e)}")
 
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0')
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark da busca textual (services/busca.py) contra os filtros ilike('%termo%')
+
+Gera atletas e backyards sintéticos (100 mil e 10 mil por padrão) e mede,
+para uma lista de termos, a mediana do COUNT(*) filtrado com cada abordagem.
+
+Uso: python benchmark_busca.py [DATABASE_URI]
+     Sem URI usa SQLite em memória. Com URI, informe um banco vazio e
+     descartável: as tabelas são criadas e populadas nele.
+     BENCH_ATLETAS e BENCH_BACKYARDS alteram a quantidade de linhas.
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault('BTL_SCHEDULER_ENABLED', 'false')
+
+from flask import Flask
+from sqlalchemy import insert, or_
+from models import db, Profile, Backend_Users, Organizacao, Backyard, Atleta, BackyardStatus
+from services.busca import busca_atletas, busca_backyards, criar_indices_fulltext
+
+NOMES = ['João', 'José', 'Maria', 'Ana', 'Antônio', 'Francisco', 'Luíza', 'Márcia', 'Sérgio',
+         'Conceição', 'Fábio', 'Letícia', 'Caio', 'Beatriz', 'Gonçalo', 'Inês', 'Vinícius', 'Débora']
+SOBRENOMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Araújo', 'Gonçalves', 'Ribeiro', 'Simões',
+              'Magalhães', 'Assunção', 'Figueiredo', 'Brandão', 'Conceição', 'Patrício', 'Lopes']
+CIDADES = [('São Paulo', 'SP'), ('Florianópolis', 'SC'), ('Belo Horizonte', 'MG'), ('Goiânia', 'GO'),
+           ('Maceió', 'AL'), ('Curitiba', 'PR'), ('Vitória', 'ES'), ('Niterói', 'RJ'), ('Cuiabá', 'MT')]
+PALAVRAS_EVENTO = ['Backyard', 'Ultra', 'Desafio', 'Trilha', 'Serra', 'Montanha', 'Última Volta',
+                   'Resistência', 'Noturna', 'Cachoeira']
+
+TERMOS = ['joao', 'João Silva', 'conc', 'magalhaes', 'sp', 'sao paulo', 'atleta42@', '123.4', 'xyzinexistente']
+TERMOS_BACKYARDS = ['backyard', 'serra sc', 'ultima volta', 'goiania', 'resist', 'xyzinexistente']
+REPETICOES = 5
+
+def criar_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def popular(total_atletas, total_backyards):
+    rnd = random.Random(42)
+    agora = datetime.utcnow()
+
+    db.session.add(Profile(id=1, nome='Admin'))
+    db.session.add(Backend_Users(id=1, nome='bench', email='bench@btl', password='-', profile_id=1))
+    db.session.add(Organizacao(id=1, nome='Bench', organizador=1))
+    db.session.flush()
+
+    lote = []
+    for i in range(total_atletas):
+        cidade, estado = rnd.choice(CIDADES)
+        cpf = f'{i:011d}'
+        lote.append({
+            'nome': f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}',
+            'cpf': f'{cpf[:3]}.{cpf[3:6]}.{cpf[6:9]}-{cpf[9:]}',
+            'email': f'atleta{i}@exemplo.com.br',
+            'password': '-',
+            'cidade': cidade,
+            'estado': estado,
+            'criado_em': agora,
+            'atualizado_em': agora,
+        })
+        if len(lote) == 5000:
+            db.session.execute(insert(Atleta), lote)
+            lote = []
+    if lote:
+        db.session.execute(insert(Atleta), lote)
+
+    lote = []
+    for i in range(total_backyards):
+        cidade, estado = rnd.choice(CIDADES)
+        lote.append({
+            'nome': f'{rnd.choice(PALAVRAS_EVENTO)} {rnd.choice(PALAVRAS_EVENTO)} {cidade} {i}',
+            'descricao': ' '.join(rnd.choice(PALAVRAS_EVENTO) for _ in range(30)),
+            'cidade': cidade,
+            'estado': estado,
+            'organizador': 1,
+            'status': rnd.choice(list(BackyardStatus)),
+            'data_criacao': agora,
+            'data_ultima_atualizacao': agora,
+        })
+        if len(lote) == 5000:
+            db.session.execute(insert(Backyard), lote)
+            lote = []
+    if lote:
+        db.session.execute(insert(Backyard), lote)
+    db.session.commit()
+
+def medir(query, filtro):
+    tempos = []
+    for _ in range(REPETICOES):
+        inicio = time.perf_counter()
+        total = query.filter(filtro).count()
+        tempos.append(time.perf_counter() - inicio)
+    return total, statistics.median(tempos) * 1000
+
+def comparar(titulo, modelo, colunas_ilike, busca, termos):
+    print(f"\n{titulo}")
+    inicio = time.perf_counter()
+    busca.filtro('aquecimento')  # constrói o índice em memória (SQLite)
+    print(f"  preparação da busca: {(time.perf_counter() - inicio) * 1000:.1f} ms")
+    print(f"  {'termo':<18} {'ilike (linhas, ms)':>22} {'busca (linhas, ms)':>22}")
+    for termo in termos:
+        antigo = or_(*[c.ilike(f'%{termo}%') for c in colunas_ilike])
+        linhas_antigo, ms_antigo = medir(modelo.query, antigo)
+        linhas_novo, ms_novo = medir(modelo.query, busca.filtro(termo))
+        print(f"  {termo:<18} {linhas_antigo:>12} {ms_antigo:>8.1f} {linhas_novo:>12} {ms_novo:>8.1f}")
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else 'sqlite://'
+    total_atletas = int(os.environ.get('BENCH_ATLETAS', 100000))
+    total_backyards = int(os.environ.get('BENCH_BACKYARDS', 10000))
+
+    app = criar_app(uri)
+    with app.app_context():
+        db.create_all()
+        criar_indices_fulltext(db.engine)
+        print(f"Populando {total_atletas} atletas e {total_backyards} backyards ({db.engine.dialect.name})...")
+        inicio = time.perf_counter()
+        popular(total_atletas, total_backyards)
+        print(f"  {time.perf_counter() - inicio:.1f} s")
+
+        comparar('Atletas', Atleta, busca_atletas.colunas, busca_atletas, TERMOS)
+        comparar('Backyards', Backyard, busca_backyards.colunas, busca_backyards, TERMOS_BACKYARDS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark das transições de loop (start_backyard e a virada de hora)
+
+Cria uma backyard com 1.000 inscritos por padrão e mede, pelas rotas do
+blueprint de loops, o tempo e o número de comandos SQL de:
+
+- start_backyard: cria o loop 1 com todos os inscritos (INSERT ... SELECT)
+- virada de hora: create_next_loop (DNF dos ATIVOS, classificação e
+  INSERT ... SELECT dos que concluíram) seguido de start_loop
+
+Antes de cada virada os atletas do loop corrente são marcados como
+CONCLUIDO (BENCH_DESISTENCIA dos ativos desistem a cada loop), fora da medição.
+Sai com código 1 se a mediana da virada passa de LIMITE_MS.
+
+Uso: python benchmark_loops.py [DATABASE_URI]
+     Sem URI usa SQLite em memória. Com URI, informe um banco vazio e
+     descartável: as tabelas são criadas e populadas nele.
+     BENCH_LARGADA (atletas), BENCH_VIRADAS e BENCH_DESISTENCIA alteram o cenário.
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+os.environ.setdefault('BTL_SCHEDULER_ENABLED', 'false')
+
+from sqlalchemy import event, insert, select, update
+from models import (db, Profile, Backend_Users, Organizacao, Backyard, Atleta, AtletaBackyard,
+                    Loop, AtletaLoop, BackyardStatus, AtletaLoopStatus)
+from benchmark_busca import criar_app
+from views.loops import loops_bp
+
+LIMITE_MS = 100
+
+def popular(total_atletas):
+    """Uma backyard em preparação com total_atletas inscritos; retorna o id da backyard"""
+    agora = datetime.utcnow()
+    db.session.add(Profile(id=1, nome='Admin'))
+    db.session.add(Backend_Users(id=1, nome='bench', email='bench@btl', password='-', profile_id=1))
+    db.session.add(Organizacao(id=1, nome='Bench', organizador=1))
+    backyard = Backyard(nome='Bench Backyard', organizador=1, status=BackyardStatus.PREPARACAO,
+                        capacidade=total_atletas, data_evento=agora)
+    db.session.add(backyard)
+    db.session.flush()
+
+    db.session.execute(insert(Atleta), [{
+        'nome': f'Atleta {i}',
+        'cpf': f'{i:011d}',
+        'email': f'atleta{i}@exemplo.com.br',
+        'password': '-',
+        'criado_em': agora,
+        'atualizado_em': agora,
+    } for i in range(total_atletas)])
+    atleta_ids = db.session.execute(select(Atleta.id)).scalars().all()
+    db.session.execute(insert(AtletaBackyard), [{
+        'atleta_id': atleta_id,
+        'backyard_id': backyard.id,
+        'numero_peito': i + 1,
+        'data_inscricao': agora,
+    } for i, atleta_id in enumerate(atleta_ids)])
+    db.session.commit()
+    return backyard.id
+
+class ContadorSQL:
+    """Conta os comandos enviados ao banco"""
+
+    def __init__(self, engine):
+        self.total = 0
+        event.listen(engine, 'before_cursor_execute', self._contar)
+
+    def _contar(self, *args):
+        self.total += 1
+
+def medir(contador, requisicao):
+    """(resposta, ms, comandos) de uma requisição"""
+    antes = contador.total
+    inicio = time.perf_counter()
+    resposta = requisicao()
+    ms = (time.perf_counter() - inicio) * 1000
+    if resposta.status_code >= 400:
+        raise RuntimeError(f"{resposta.status_code}: {resposta.get_data(as_text=True)[:200]}")
+    return resposta, ms, contador.total - antes
+
+def concluir_loop(loop_id, desistencia, rnd):
+    """Marca os ATIVOS do loop como CONCLUIDO, exceto uma fração de desistentes"""
+    ativos = db.session.execute(select(AtletaLoop.id).where(
+        AtletaLoop.loop_id == loop_id, AtletaLoop.status == AtletaLoopStatus.ATIVO
+    )).scalars().all()
+    desistentes = set(rnd.sample(ativos, int(len(ativos) * desistencia)))
+    concluidos = [i for i in ativos if i not in desistentes]
+    if concluidos:
+        db.session.execute(update(AtletaLoop).where(AtletaLoop.id.in_(concluidos)).values(
+            status=AtletaLoopStatus.CONCLUIDO, tempo_fim=datetime.utcnow(), tempo_total_segundos=3000
+        ))
+    db.session.commit()
+    return len(concluidos)
+
+def loop_corrente(backyard_id):
+    return db.session.execute(select(Loop.id).where(Loop.backyard_id == backyard_id).order_by(
+        Loop.numero_loop.desc()
+    ).limit(1)).scalar()
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else 'sqlite://'
+    total_atletas = int(os.environ.get('BENCH_LARGADA', 1000))
+    viradas = int(os.environ.get('BENCH_VIRADAS', 10))
+    desistencia = float(os.environ.get('BENCH_DESISTENCIA', 0.02))
+    rnd = random.Random(42)
+
+    app = criar_app(uri)
+    app.config['SECRET_KEY'] = 'bench'
+    app.config['LOGIN_DISABLED'] = True
+    app.register_blueprint(loops_bp, url_prefix='/loops')
+    cliente = app.test_client()
+
+    with app.app_context():
+        db.create_all()
+        backyard_id = popular(total_atletas)
+        contador = ContadorSQL(db.engine)
+        print(f"Backyard com {total_atletas} inscritos ({db.engine.dialect.name})")
+
+        _, ms, comandos = medir(contador, lambda: cliente.post(f'/loops/backyard/{backyard_id}/start'))
+        print(f"\nstart_backyard: {ms:.1f} ms, {comandos} comandos")
+
+        loop_id = loop_corrente(backyard_id)
+        medir(contador, lambda: cliente.post(f'/loops/loop/{loop_id}/start'))
+
+        print(f"\n{'virada':>6} {'atletas':>8} {'create_next':>12} {'start_loop':>11} {'total':>9} {'comandos':>9}")
+        tempos = []
+        for numero in range(1, viradas + 1):
+            atletas = concluir_loop(loop_id, desistencia, rnd)
+            resposta, ms_proximo, cmd_proximo = medir(
+                contador, lambda: cliente.post(f'/loops/loop/{loop_id}/create_next')
+            )
+            loop_id = resposta.get_json()['new_loop_id']
+            _, ms_inicio, cmd_inicio = medir(contador, lambda: cliente.post(f'/loops/loop/{loop_id}/start'))
+            tempos.append(ms_proximo + ms_inicio)
+            print(f"{numero:>6} {atletas:>8} {ms_proximo:>9.1f} ms {ms_inicio:>8.1f} ms "
+                  f"{ms_proximo + ms_inicio:>6.1f} ms {cmd_proximo + cmd_inicio:>9}")
+
+    mediana = statistics.median(tempos)
+    print(f"\nvirada de hora: mediana {mediana:.1f} ms, máximo {max(tempos):.1f} ms (limite {LIMITE_MS} ms)")
+    if mediana > LIMITE_MS:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""
+EXPLAIN das consultas quentes: falha se alguma varre a tabela inteira
+
+Gera os dados sintéticos do benchmark_busca.py (100 mil atletas por padrão),
+inscrições com número de peito, loops e atleta_loops, e captura o plano das
+consultas montadas pelas mesmas funções que as views e o scheduler usam, então
+uma view que deixa de usar um índice faz o harness falhar:
+
+- listagem de backyards (views.backyards.consultas_listagem): o total com o
+  filtro de eventos passados e cada segmento, na primeira página e na seguinte
+- listagem de atletas (views.atletas.consulta_listagem), admin e organizador
+- check-in (views.loops): loop ativo da backyard e números de peito do lote
+- atletas ativos do loop (eliminação por tempo, DNF, início do loop)
+- loops ativos do scheduler (verificação a cada segundo e ressincronização)
+
+As páginas seguintes usam services.paginacao.consulta_keyset com a chave da
+última linha da primeira página, como o cursor da URL.
+
+Sai com código 1 se algum plano tem SCAN de uma tabela (SQLite, EXPLAIN QUERY
+PLAN) ou type=ALL (MariaDB/MySQL, EXPLAIN). A primeira página pode percorrer o
+índice da ordenação; o total de atletas do admin (COUNT da tabela, em cache)
+fica de fora.
+
+Uso: python explain_consultas.py [DATABASE_URI]
+     Sem URI usa SQLite em memória. Com URI, informe um banco vazio e
+     descartável: as tabelas são criadas e populadas nele.
+     BENCH_ATLETAS, BENCH_BACKYARDS e BENCH_LOOPS alteram a quantidade de linhas.
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BTL_SCHEDULER_ENABLED', 'false')
+
+from sqlalchemy import insert, select, text, update
+from models import (db, Atleta, Backyard, Loop, AtletaLoop, AtletaBackyard,
+                    BackyardStatus, LoopStatus, AtletaLoopStatus)
+from services.autorizacao import Principal
+from services.busca import criar_indices_fulltext
+from services.paginacao import consulta_keyset, segmentos_keyset
+from benchmark_busca import criar_app, popular
+from scheduler import consulta_loops_ativos
+from views.atletas import consulta_listagem as consulta_listagem_atletas
+from views.backyards import consultas_listagem
+from views.loops import consulta_loop_ativo, consulta_atletas_por_numero, consulta_atletas_ativos
+
+# Itens por página das listagens do backoffice
+POR_PAGINA = 10
+
+def popular_corrida(total_loops):
+    """Datas dos eventos, inscrições (numeradas por backyard), loops e atleta_loops"""
+    agora = datetime.utcnow()
+    backyards = db.session.execute(select(Backyard.id, Backyard.status).order_by(Backyard.id)).all()
+    atleta_ids = db.session.execute(select(Atleta.id).order_by(Atleta.id)).scalars().all()
+
+    db.session.execute(update(Backyard), [
+        {'id': backyard_id, 'data_evento': agora + timedelta(days=backyard_id % 730 - 365)}
+        for backyard_id, _ in backyards
+    ])
+
+    inscritos = {}
+    lote = []
+    for i, atleta_id in enumerate(atleta_ids):
+        backyard_id = backyards[i % len(backyards)][0]
+        inscritos.setdefault(backyard_id, []).append(atleta_id)
+        lote.append({
+            'atleta_id': atleta_id,
+            'backyard_id': backyard_id,
+            'numero_peito': len(inscritos[backyard_id]),
+            'data_inscricao': agora,
+        })
+        if len(lote) == 5000:
+            db.session.execute(insert(AtletaBackyard), lote)
+            lote = []
+    if lote:
+        db.session.execute(insert(AtletaBackyard), lote)
+
+    # Loops apenas para as backyards que já largaram
+    com_loops = [(b, s) for b, s in backyards if s in (BackyardStatus.ATIVO, BackyardStatus.FINALIZADO)]
+    db.session.execute(insert(Loop), [{
+        'backyard_id': backyard_id,
+        'numero_loop': numero,
+        'status': LoopStatus.ATIVO if status == BackyardStatus.ATIVO and numero == total_loops
+                  else LoopStatus.FINALIZADO,
+        'data_inicio': agora - timedelta(hours=total_loops - numero),
+        'tempo_limite': 3600,
+        'distancia_km': 6.706,
+        'criado_em': agora,
+    } for backyard_id, status in com_loops for numero in range(1, total_loops + 1)])
+
+    lote = []
+    for loop_id, backyard_id, status in db.session.execute(select(Loop.id, Loop.backyard_id, Loop.status)):
+        status_atleta = AtletaLoopStatus.ATIVO if status == LoopStatus.ATIVO else AtletaLoopStatus.CONCLUIDO
+        for atleta_id in inscritos.get(backyard_id, []):
+            lote.append({'atleta_id': atleta_id, 'loop_id': loop_id, 'status': status_atleta, 'criado_em': agora})
+            if len(lote) == 5000:
+                db.session.execute(insert(AtletaLoop), lote)
+                lote = []
+    if lote:
+        db.session.execute(insert(AtletaLoop), lote)
+    db.session.commit()
+
+def consultas_quentes():
+    """(descrição, Select) das consultas que precisam de índice"""
+    loop_id, backyard_id = db.session.execute(
+        select(Loop.id, Loop.backyard_id).where(Loop.status == LoopStatus.ATIVO).limit(1)
+    ).one()
+    organizador = db.session.execute(select(Backyard.organizador).where(Backyard.id == backyard_id)).scalar()
+    admin = Principal(1, 'Admin')
+    organizacao = Principal(2, 'Organizador')
+    organizacao._org_ids = frozenset([organizador])
+
+    consultas = []
+
+    query_total, segmentos = consultas_listagem(admin)
+    consultas.append(('listagem de backyards: total sem eventos passados', query_total, False))
+    for i, (query, chaves) in enumerate(segmentos):
+        consultas += paginas(f'listagem de backyards: segmento {i + 1}', query, chaves, POR_PAGINA)
+    _, segmentos = consultas_listagem(admin, status_filter='PREPARACAO', ocultar_passados=False)
+    consultas += paginas('listagem de backyards: em preparação', *segmentos[0], POR_PAGINA)
+
+    # O total do admin é um COUNT(*) da tabela (em cache em contadores.total_listagem)
+    for descricao, principal in (('admin', admin), ('organizador', organizacao)):
+        query_total, query, chaves = consulta_listagem_atletas(principal)
+        if not principal.is_admin:
+            consultas.append((f'listagem de atletas ({descricao}): total', query_total))
+        for i, (segmento, chaves_segmento) in enumerate(segmentos_keyset(query, chaves)):
+            consultas += paginas(f'listagem de atletas ({descricao}): segmento {i + 1}',
+                                 segmento, chaves_segmento, POR_PAGINA)
+
+    consultas += [
+        ('check-in: loop ativo da backyard', consulta_loop_ativo(backyard_id).limit(1)),
+        ('check-in: números de peito do lote', consulta_atletas_por_numero(backyard_id, loop_id, [3, 17, 42])),
+        ('atletas ativos do loop', consulta_atletas_ativos(loop_id)),
+        ('scheduler: loops ativos', consulta_loops_ativos()),
+    ]
+    return [(c[0], getattr(c[1], 'statement', c[1]), c[2] if len(c) > 2 else False) for c in consultas]
+
+def paginas(descricao, query, chaves, por_pagina):
+    """
+    Primeira página e a seguinte (cursor na última linha da primeira), como em paginar()
+
+    A primeira página pode percorrer o índice da ordenação (para no LIMIT);
+    a seguinte precisa começar a busca no cursor.
+    """
+    primeira = consulta_keyset(query, chaves, limite=por_pagina + 1)
+    resultado = [(f'{descricao}, página 1', primeira, True)]
+    linhas = primeira.all()
+    if linhas:
+        valores = list(tuple(linhas[-1])[-len(chaves):])
+        resultado.append((f'{descricao}, página 2',
+                          consulta_keyset(query, chaves, valores, limite=por_pagina + 1), False))
+    return resultado
+
+def explicar(consulta, percorre_indice=False):
+    """
+    Linhas do plano e se alguma delas é uma varredura completa de tabela
+
+    percorre_indice aceita percorrer um índice na ordem da consulta (SQLite:
+    SCAN ... USING INDEX), o plano da primeira página de uma listagem.
+    Varreduras de subconsultas materializadas não contam.
+    """
+    sql = str(consulta.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    with db.engine.connect() as conn:
+        if db.engine.dialect.name == 'sqlite':
+            linhas = [linha.detail for linha in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+            varredura = any(
+                linha.startswith('SCAN') and linha.split()[1] in db.metadata.tables
+                and not (percorre_indice and ' USING ' in linha and 'INDEX' in linha)
+                for linha in linhas
+            )
+        else:
+            plano = conn.execute(text(f'EXPLAIN {sql}')).mappings().all()
+            linhas = [f"{p['table']}: type={p['type']} key={p['key']} rows={p['rows']}" for p in plano]
+            varredura = any(p['type'] == 'ALL' and p['table'] in db.metadata.tables for p in plano)
+    return linhas, varredura
+
+def main():
+    uri = sys.argv[1] if len(sys.argv) > 1 else 'sqlite://'
+    total_atletas = int(os.environ.get('BENCH_ATLETAS', 100000))
+    total_backyards = int(os.environ.get('BENCH_BACKYARDS', 2000))
+    total_loops = int(os.environ.get('BENCH_LOOPS', 10))
+
+    app = criar_app(uri)
+    with app.app_context():
+        db.create_all()
+        criar_indices_fulltext(db.engine)
+        print(f"Populando {total_atletas} atletas, {total_backyards} backyards e "
+              f"{total_loops} loops por backyard iniciada ({db.engine.dialect.name})...")
+        inicio = time.perf_counter()
+        popular(total_atletas, total_backyards)
+        popular_corrida(total_loops)
+        print(f"  {time.perf_counter() - inicio:.1f} s")
+
+        falhas = []
+        for descricao, consulta, percorre_indice in consultas_quentes():
+            linhas, varredura = explicar(consulta, percorre_indice)
+            print(f"\n{'FALHA' if varredura else 'ok':<5} {descricao}")
+            for linha in linhas:
+                print(f"      {linha}")
+            if varredura:
+                falhas.append(descricao)
+
+    if falhas:
+        print(f"\n{len(falhas)} consulta(s) com varredura completa: {', '.join(falhas)}")
+        sys.exit(1)
+    print("\nNenhuma varredura completa.")
+
+if __name__ == '__main__':
+    main()
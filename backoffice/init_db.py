@@ -4,15 +4,68 @@ import os
 import sys
 sys.path.insert(0, '/app')
 
+# Script de inicialização não deve disputar a liderança do scheduler
+os.environ.setdefault('BTL_SCHEDULER_ENABLED', 'false')
+
 from app import app
 from models import db, Backend_Users, Profile, Organizacao, Backyard, Atleta, AtletaBackyard, Loop, AtletaLoop
+from services.busca import criar_indices_fulltext
 from werkzeug.security import generate_password_hash
+from sqlalchemy import inspect, text
+
+# Standings of events that already had finished loops before the column existed
+BACKFILL_STANDINGS = """
+UPDATE atleta_backyard SET
+    voltas_completadas = (
+        SELECT COUNT(*) FROM atleta_loops al JOIN loops l ON l.id = al.loop_id
+        WHERE l.backyard_id = atleta_backyard.backyard_id AND al.atleta_id = atleta_backyard.atleta_id
+          AND al.status = 'CONCLUIDO' AND l.status = 'FINALIZADO'
+    ),
+    tempo_total_segundos = (
+        SELECT COALESCE(SUM(al.tempo_total_segundos), 0) FROM atleta_loops al JOIN loops l ON l.id = al.loop_id
+        WHERE l.backyard_id = atleta_backyard.backyard_id AND al.atleta_id = atleta_backyard.atleta_id
+          AND al.status = 'CONCLUIDO' AND l.status = 'FINALIZADO'
+    )
+"""
+
+# Columns added after the initial schema (db.create_all does not alter existing tables):
+# (table, column, DDL, optional backfill statement run right after the column is added)
+COLUMN_MIGRATIONS = [
+    ('backyards', 'versao_dados', 'INTEGER NOT NULL DEFAULT 0', None),
+    ('atleta_backyard', 'tempo_total_segundos', 'INTEGER NOT NULL DEFAULT 0', BACKFILL_STANDINGS),
+    ('imagens_armazenadas', 'larguras', 'VARCHAR(32)', None),
+]
+
+def apply_migrations():
+    """Add missing columns and indexes to tables created by older versions"""
+    inspector = inspect(db.engine)
+    for table, column, ddl, backfill in COLUMN_MIGRATIONS:
+        existing = {c['name'] for c in inspector.get_columns(table)}
+        if column in existing:
+            continue
+        print(f"Adding column {table}.{column}...")
+        with db.engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill:
+                conn.execute(text(backfill))
+    
+    # Indexes declared on the models but missing in the database
+    for table in db.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                print(f"Creating index {index.name}...")
+                index.create(db.engine)
+    
+    # FULLTEXT indexes used by the athlete and backyard search (MariaDB/MySQL only)
+    criar_indices_fulltext(db.engine)
 
 def init_database():
     """Initialize database with tables and default data"""
     with app.app_context():
         print("Creating database tables...")
         db.create_all()
+        apply_migrations()
         print("Tables created successfully!")
         
         # Create default profiles if they don't exist
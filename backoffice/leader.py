@@ -0,0 +1,227 @@
+"""
+Eleição de líder entre processos do backoffice
+Garante que apenas um BTLScheduler esteja ativo em todo o cluster
+"""
+
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from models import db, SchedulerLease
+
+class MariaDBLease:
+    """Lease baseada em GET_LOCK do MariaDB, presa a uma conexão dedicada
+
+    O lock pertence à conexão: se o processo líder morrer, o servidor fecha a
+    conexão e libera o lock automaticamente para o próximo candidato.
+    """
+
+    def __init__(self, engine, nome):
+        self.engine = engine
+        self.nome = nome
+        self.conexao = None
+
+    def adquirir(self):
+        """Tenta obter o lock sem esperar; retorna True se este processo é o líder"""
+        if self.conexao is not None:
+            return self.renovar()
+
+        conexao = self.engine.connect()
+        try:
+            obtido = conexao.execute(text("SELECT GET_LOCK(:nome, 0)"), {'nome': self.nome}).scalar()
+        except Exception:
+            conexao.close()
+            raise
+
+        if obtido == 1:
+            self.conexao = conexao
+            return True
+
+        conexao.close()
+        return False
+
+    def renovar(self):
+        """Confirma que a conexão ainda existe e continua dona do lock"""
+        if self.conexao is None:
+            return False
+        try:
+            dono = self.conexao.execute(
+                text("SELECT IS_USED_LOCK(:nome) = CONNECTION_ID()"), {'nome': self.nome}
+            ).scalar()
+        except Exception:
+            self._descartar_conexao()
+            return False
+
+        if dono != 1:
+            self._descartar_conexao()
+            return False
+        return True
+
+    def liberar(self):
+        """Libera o lock explicitamente (encerramento limpo)"""
+        if self.conexao is None:
+            return
+        try:
+            self.conexao.execute(text("SELECT RELEASE_LOCK(:nome)"), {'nome': self.nome})
+        except Exception:
+            pass
+        self._descartar_conexao()
+
+    def _descartar_conexao(self):
+        try:
+            self.conexao.invalidate()
+            self.conexao.close()
+        except Exception:
+            pass
+        self.conexao = None
+
+class TabelaLease:
+    """Lease em tabela com expiração, substituto do GET_LOCK no SQLite (dev/testes)
+
+    O líder renova a expiração periodicamente; se morrer, outro processo assume
+    quando a lease expirar.
+    """
+
+    def __init__(self, engine, nome, dono, duracao=30):
+        self.engine = engine
+        self.nome = nome
+        self.dono = dono
+        self.duracao = duracao
+
+    def adquirir(self):
+        """Assume a lease se estiver livre, expirada ou já for deste processo"""
+        agora = datetime.utcnow()
+        tabela = SchedulerLease.__table__
+
+        with self.engine.begin() as conexao:
+            atualizada = conexao.execute(
+                tabela.update().where(
+                    tabela.c.nome == self.nome,
+                    (tabela.c.dono == self.dono) | (tabela.c.expira_em < agora)
+                ).values(dono=self.dono, expira_em=agora + timedelta(seconds=self.duracao))
+            ).rowcount
+
+        if atualizada == 1:
+            return True
+
+        try:
+            with self.engine.begin() as conexao:
+                conexao.execute(tabela.insert().values(
+                    nome=self.nome,
+                    dono=self.dono,
+                    expira_em=agora + timedelta(seconds=self.duracao)
+                ))
+            return True
+        except IntegrityError:
+            return False  # Outro processo detém a lease
+
+    def renovar(self):
+        """Estende a expiração; falha se outro processo já assumiu"""
+        return self.adquirir()
+
+    def liberar(self):
+        """Expira a lease imediatamente para que outro processo assuma"""
+        tabela = SchedulerLease.__table__
+        with self.engine.begin() as conexao:
+            conexao.execute(
+                tabela.update().where(
+                    tabela.c.nome == self.nome,
+                    tabela.c.dono == self.dono
+                ).values(expira_em=datetime(1970, 1, 1))
+            )
+
+class LeaderElector:
+    """Disputa periodicamente a liderança e notifica ao assumir ou perder"""
+
+    def __init__(self, nome='btl_scheduler', intervalo=10):
+        self.nome = nome
+        self.intervalo = intervalo
+        self.dono = f"{socket.gethostname()}:{os.getpid()}"
+        self.app = None
+        self.lease = None
+        self.lider = False
+        self.running = False
+        self.thread = None
+        self.ao_assumir = None
+        self.ao_perder = None
+        self._parar = threading.Event()
+
+    def init_app(self, app, ao_assumir=None, ao_perder=None):
+        """Configura a aplicação e os callbacks de mudança de liderança"""
+        self.app = app
+        self.ao_assumir = ao_assumir
+        self.ao_perder = ao_perder
+
+    def start(self):
+        """Inicia a disputa de liderança em thread separada"""
+        if self.running:
+            return
+
+        self.running = True
+        self._parar.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Para a disputa e libera a liderança, se houver"""
+        self.running = False
+        self._parar.set()
+        if self.thread:
+            self.thread.join()
+        if self.lider:
+            self._perder_lideranca()
+        if self.lease:
+            try:
+                self.lease.liberar()
+            except Exception as e:
+                print(f"ERRO ao liberar liderança: {str(e)}")
+
+    def status(self):
+        """Retorna o estado da eleição neste processo"""
+        return {
+            'lider': self.lider,
+            'dono': self.dono,
+            'backend': type(self.lease).__name__ if self.lease else None,
+        }
+
+    def _criar_lease(self):
+        """Escolhe a implementação de lease conforme o banco configurado"""
+        engine = db.engine
+        if engine.dialect.name in ('mysql', 'mariadb'):
+            return MariaDBLease(engine, self.nome)
+        return TabelaLease(engine, self.nome, self.dono, duracao=self.intervalo * 3)
+
+    def _run(self):
+        """Loop principal: tenta assumir como seguidor, renova como líder"""
+        while self.running:
+            try:
+                with self.app.app_context():
+                    if self.lease is None:
+                        self.lease = self._criar_lease()
+
+                    if self.lider:
+                        if not self.lease.renovar():
+                            print(f"LIDER: {self.dono} perdeu a liderança de '{self.nome}'")
+                            self._perder_lideranca()
+                    elif self.lease.adquirir():
+                        print(f"LIDER: {self.dono} assumiu a liderança de '{self.nome}'")
+                        self.lider = True
+                        if self.ao_assumir:
+                            self.ao_assumir()
+
+            except Exception as e:
+                print(f"ERRO na eleição de líder: {str(e)}")
+                if self.lider:
+                    self._perder_lideranca()
+
+            self._parar.wait(self.intervalo)
+
+    def _perder_lideranca(self):
+        self.lider = False
+        if self.ao_perder:
+            try:
+                self.ao_perder()
+            except Exception as e:
+                print(f"ERRO ao encerrar tarefas do líder: {str(e)}")
@@ -97,17 +97,42 @@ class Backyard(db.Model):
     capacidade = db.Column(db.Integer, nullable=False, default=100)  # Quantidade máxima de atletas
     numero_inicial = db.Column(db.Integer, nullable=False, default=1)  # Primeiro número de peito disponível
     
+    # Contador de alterações (corrida, inscrições, dados do evento) usado para validar caches de leitura
+    versao_dados = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
     data_ultima_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationships
     atletas = db.relationship('Atleta', secondary='atleta_backyard', back_populates='backyards')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_backyards_status_data_evento', 'status', 'data_evento'),
+        db.Index('ix_backyards_data_evento', 'data_evento'),
+        db.Index('ix_backyards_organizador_data_evento', 'organizador', 'data_evento'),  # escopo do organizador
+    )
+    
     @property
     def numero_final(self):
         """Calcula o número final baseado no inicial + capacidade - 1"""
         return self.numero_inicial + self.capacidade - 1
     
+    @staticmethod
+    def registrar_alteracao(backyard_id, retornar_versao=False):
+        """Incrementa versao_dados na transação corrente (invalida caches dos demais processos)
+
+        Com retornar_versao=True devolve o valor após o incremento, lido na mesma
+        transação: o UPDATE mantém a linha bloqueada até o commit.
+        """
+        db.session.execute(
+            db.update(Backyard).where(Backyard.id == backyard_id).values(
+                versao_dados=Backyard.versao_dados + 1
+            ).execution_options(synchronize_session=False)
+        )
+        if retornar_versao:
+            return db.session.query(Backyard.versao_dados).filter(Backyard.id == backyard_id).scalar()
+    
     def get_proximo_numero_peito(self):
         """Retorna o próximo número de peito disponível"""
         # Buscar o maior número já atribuído
@@ -159,6 +184,7 @@ class Backyard(db.Model):
                 break  # Capacidade esgotada
         
         if numeros_atribuidos > 0:
+            Backyard.registrar_alteracao(self.id)
             db.session.commit()
         
         return numeros_atribuidos
@@ -187,6 +213,11 @@ class Atleta(UserMixin, db.Model):
     # Relationships
     backyards = db.relationship('Backyard', secondary='atleta_backyard', back_populates='atletas')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_atletas_criado_em_id', 'criado_em', 'id'),  # listagem paginada por cursor
+    )
+    
     def __repr__(self):
         return f'<Atleta {self.nome}>'
 
@@ -203,6 +234,7 @@ class AtletaBackyard(db.Model):
     posicao_final = db.Column(db.Integer)  # Posição final na corrida (1 = vencedor, 2 = segundo, etc.)
     voltas_completadas = db.Column(db.Integer, default=0)  # Número de voltas completadas
     tempo_total = db.Column(db.Time)  # Tempo total de corrida
+    tempo_total_segundos = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Soma dos tempos dos loops concluídos (sem o limite de 24h do Time)
     
     # Relationships
     atleta = db.relationship('Atleta', backref='inscricoes')
@@ -212,8 +244,18 @@ class AtletaBackyard(db.Model):
     __table_args__ = (
         db.UniqueConstraint('backyard_id', 'numero_peito', name='unique_numero_peito_por_backyard'),
         db.UniqueConstraint('atleta_id', 'backyard_id', name='unique_atleta_por_backyard'),
+        db.Index('ix_atleta_backyard_classificacao', 'backyard_id', 'voltas_completadas', 'tempo_total_segundos'),
     )
     
+    @staticmethod
+    def classificacao(backyard_id):
+        """Classificação da backyard: mais voltas primeiro, desempate pelo menor tempo total"""
+        return AtletaBackyard.query.filter_by(backyard_id=backyard_id).order_by(
+            AtletaBackyard.voltas_completadas.desc(),
+            AtletaBackyard.tempo_total_segundos.asc(),
+            AtletaBackyard.id.asc()
+        )
+    
     def __repr__(self):
         numero = f"#{self.numero_peito}" if self.numero_peito else "sem número"
         return f'<AtletaBackyard {self.atleta_id}-{self.backyard_id} ({numero})>'
@@ -235,6 +277,12 @@ class Loop(db.Model):
     backyard = db.relationship('Backyard', backref='loops')
     atletas = db.relationship('AtletaLoop', backref='loop', lazy=True)
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_loops_backyard_status_numero', 'backyard_id', 'status', 'numero_loop'),
+        db.Index('ix_loops_status_data_inicio', 'status', 'data_inicio'),  # loops ativos (scheduler)
+    )
+    
 
     def get_atletas_ativos(self):
         """Retorna lista de atletas ativos neste loop"""
@@ -271,6 +319,7 @@ class AtletaLoop(db.Model):
     # Constraints
     __table_args__ = (
         db.UniqueConstraint('atleta_id', 'loop_id', name='unique_atleta_por_loop'),
+        db.Index('ix_atleta_loops_loop_status', 'loop_id', 'status'),
     )
     
     def get_tempo_formatado(self):
@@ -284,3 +333,41 @@ class AtletaLoop(db.Model):
     
     def __repr__(self):
         return f'<AtletaLoop atleta_id={self.atleta_id} loop_id={self.loop_id} status={self.status}>'
+
+class SchedulerLease(db.Model):
+    """Lease de liderança usada quando o banco não oferece GET_LOCK (SQLite)"""
+    __tablename__ = 'scheduler_leases'
+    
+    nome = db.Column(db.String(64), primary_key=True)
+    dono = db.Column(db.String(255), nullable=False)
+    expira_em = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<SchedulerLease {self.nome} dono={self.dono}>'
+
+class RequisicaoIdempotente(db.Model):
+    """Resposta registrada de uma requisição com Idempotency-Key, reproduzida em retentativas"""
+    __tablename__ = 'requisicoes_idempotentes'
+    
+    chave = db.Column(db.String(64), primary_key=True)  # sha256(usuário, método, caminho, Idempotency-Key)
+    status_code = db.Column(db.Integer)  # NULL enquanto a requisição original está em processamento
+    resposta = db.Column(db.Text)
+    mimetype = db.Column(db.String(100))
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<RequisicaoIdempotente {self.chave} status={self.status_code}>'
+
+class ImagemArmazenada(db.Model):
+    """Imagem no armazenamento (prefixo endereçado pelo conteúdo) e quantos registros a usam"""
+    __tablename__ = 'imagens_armazenadas'
+    
+    prefixo = db.Column(db.String(191), primary_key=True)  # {image_type}/{sha256}
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    larguras = db.Column(db.String(32))  # largura real das variantes (thumb,card,full) para o srcset
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ImagemArmazenada {self.prefixo} referencias={self.referencias}>'
@@ -1,99 +1,309 @@
 """
 Scheduler para tarefas automáticas do BTL
-Inclui verificação de tempo limite dos loops
+Mantém um heap com o prazo (data_inicio + tempo_limite) de cada loop ativo
+e elimina os atletas atrasados assim que o prazo expira. Se após o disparo o
+loop ainda tem atletas ATIVOS (ex.: erro no banco durante a eliminação), o
+prazo volta ao heap com espera crescente até a eliminação ser aplicada
+
+Só o processo líder mantém o heap; nos demais agendar/cancelar não fazem
+nada. Loops iniciados ou encerrados em outro worker são percebidos pela
+verificação a cada INTERVALO_VERIFICACAO: uma consulta de uma linha (total,
+soma dos ids e maior início dos loops ativos) que dispara a ressincronização
+completa quando muda
 """
 
+import heapq
 import threading
 import time
-from datetime import datetime
-from models import db, Loop, LoopStatus
-from views.loops import eliminar_atletas_por_tempo
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import db, Loop, LoopStatus, AtletaLoop, AtletaLoopStatus
+from leader import LeaderElector
+
+def consulta_loops_ativos():
+    """Loops ativos já iniciados (os que têm prazo)"""
+    return db.session.query(Loop).filter(
+        Loop.status == LoopStatus.ATIVO,
+        Loop.data_inicio.isnot(None)
+    )
 
 class BTLScheduler:
     """Classe para gerenciar tarefas agendadas do BTL"""
-    
+
+    # eliminar_atletas_por_tempo só elimina quando o tempo decorrido (em segundos
+    # inteiros) EXCEDE o tempo limite, então o disparo acontece 1s após o prazo
+    MARGEM_DISPARO = timedelta(seconds=1)
+
+    # Verificação barata dos loops ativos (loops iniciados em outros workers)
+    # e ressincronização completa com o banco, mesmo sem mudança detectada
+    INTERVALO_VERIFICACAO = 1
+    INTERVALO_RESYNC = 60
+
+    # Nova tentativa quando a eliminação não foi aplicada: 5s, 10s, 20s... até 60s
+    ESPERA_RETENTATIVA = 5
+    ESPERA_RETENTATIVA_MAXIMA = 60
+
     def __init__(self, app=None):
         self.app = app
         self.running = False
         self.thread = None
-        
+
+        self._cond = threading.Condition()
+        self._heap = []          # (horario_disparo, loop_id)
+        self._agenda = {}        # loop_id -> horario_disparo vigente
+        self._disparados = {}    # loop_id -> horario_disparo já processado
+        self._retentativas = {}  # loop_id -> (horario_disparo original, tentativas)
+        self._proximo_resync = 0
+        self._proxima_verificacao = 0
+        self._impressao = None   # impressão dos loops ativos na última verificação
+
+        # Métricas de atraso (lag) em relação ao horário agendado
+        self.lag_ultimo = 0.0
+        self.lag_maximo = 0.0
+        self.total_disparos = 0
+        self.ultimo_disparo = None
+
     def init_app(self, app):
         """Inicializa o scheduler com a aplicação Flask"""
         self.app = app
-        
+
     def start(self):
         """Inicia o scheduler em thread separada"""
         if self.running:
             return
-            
+
         self.running = True
+        self._proximo_resync = 0
+        self._proxima_verificacao = 0
         self.thread = threading.Thread(target=self._run_scheduler, daemon=True)
         self.thread.start()
         print("BTL Scheduler iniciado!")
-        
+
     def stop(self):
         """Para o scheduler"""
-        self.running = False
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
         if self.thread:
             self.thread.join()
+        with self._cond:
+            # Um novo mandato reconstrói a agenda a partir do banco
+            self._heap.clear()
+            self._agenda.clear()
+            self._disparados.clear()
+            self._retentativas.clear()
+            self._impressao = None
         print("BTL Scheduler parado!")
-        
+
+    def agendar(self, loop_id, prazo):
+        """Agenda (ou reagenda) a eliminação por tempo de um loop para o prazo informado"""
+        horario = prazo + self.MARGEM_DISPARO
+        with self._cond:
+            # Fora do líder ninguém lê o heap: o líder percebe o loop na próxima verificação
+            if not self.running or self._agenda.get(loop_id) == horario:
+                return
+            self._agenda[loop_id] = horario
+            self._disparados.pop(loop_id, None)
+            self._retentativas.pop(loop_id, None)
+            heapq.heappush(self._heap, (horario, loop_id))
+            self._cond.notify()
+
+    def cancelar(self, loop_id):
+        """Remove o prazo de um loop (finalizado ou ainda em preparação)"""
+        with self._cond:
+            if not self.running:
+                return
+            # A entrada no heap é descartada de forma preguiçosa quando chegar ao topo
+            self._agenda.pop(loop_id, None)
+            self._disparados.pop(loop_id, None)
+            self._retentativas.pop(loop_id, None)
+            self._cond.notify()
+
+    def agendar_loop(self, loop):
+        """Atualiza a agenda a partir do estado atual de um loop"""
+        if loop.status == LoopStatus.ATIVO and loop.data_inicio:
+            self.agendar(loop.id, loop.data_inicio + timedelta(seconds=loop.tempo_limite))
+        else:
+            self.cancelar(loop.id)
+
+    def ressincronizar(self):
+        """Força uma releitura dos loops ativos na próxima iteração"""
+        with self._cond:
+            self._proximo_resync = 0
+            self._proxima_verificacao = 0
+            self._cond.notify()
+
+    def status(self):
+        """Retorna o estado do scheduler, incluindo o atraso dos disparos"""
+        with self._cond:
+            proximo = min(self._agenda.values()) if self._agenda else None
+            return {
+                'running': self.running,
+                'loops_agendados': len(self._agenda),
+                'loops_em_retentativa': len(self._retentativas),
+                'proximo_disparo': proximo.isoformat() if proximo else None,
+                'total_disparos': self.total_disparos,
+                'ultimo_disparo': self.ultimo_disparo.isoformat() if self.ultimo_disparo else None,
+                'lag_ultimo_segundos': round(self.lag_ultimo, 3),
+                'lag_maximo_segundos': round(self.lag_maximo, 3),
+            }
+
     def _run_scheduler(self):
         """Loop principal do scheduler"""
         while self.running:
             try:
-                with self.app.app_context():
-                    self._check_time_limits()
-                    
-                # Verificar a cada 30 segundos
-                time.sleep(30)
-                
+                if time.monotonic() >= self._proxima_verificacao:
+                    with self.app.app_context():
+                        impressao = self._impressao_loops_ativos()
+                        if impressao != self._impressao or time.monotonic() >= self._proximo_resync:
+                            self._ressincronizar_loops()
+                            self._impressao = impressao
+                            self._proximo_resync = time.monotonic() + self.INTERVALO_RESYNC
+                    self._proxima_verificacao = time.monotonic() + self.INTERVALO_VERIFICACAO
+
+                for horario, loop_id in self._aguardar_vencidos():
+                    self._disparar(horario, loop_id)
+
             except Exception as e:
                 print(f"ERRO no scheduler: {str(e)}")
-                time.sleep(60)  # Esperar mais tempo em caso de erro
-                
-    def _check_time_limits(self):
-        """Verificar tempo limite de todos os loops ativos"""
+                time.sleep(5)  # Evitar loop apertado em caso de erro persistente
+
+    def _aguardar_vencidos(self):
+        """Dorme até o próximo prazo (ou verificação) e retorna as entradas vencidas"""
+        with self._cond:
+            while self.running:
+                # Descartar entradas canceladas ou reagendadas
+                while self._heap and self._agenda.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+
+                agora = datetime.utcnow()
+                vencidos = []
+                while self._heap and self._heap[0][0] <= agora:
+                    horario, loop_id = heapq.heappop(self._heap)
+                    if self._agenda.get(loop_id) == horario:
+                        vencidos.append((horario, loop_id))
+                if vencidos:
+                    return vencidos
+
+                espera_verificacao = self._proxima_verificacao - time.monotonic()
+                if espera_verificacao <= 0:
+                    return []
+
+                espera = espera_verificacao
+                if self._heap:
+                    espera = min(espera, (self._heap[0][0] - agora).total_seconds())
+                self._cond.wait(timeout=max(espera, 0))
+            return []
+
+    def _disparar(self, horario, loop_id):
+        """Elimina os atletas ativos de um loop cujo prazo expirou"""
+        # Import tardio: views.loops importa este módulo para reagendar loops
+        from views.loops import eliminar_atletas_por_tempo
+
+        lag = (datetime.utcnow() - horario).total_seconds()
+        with self.app.app_context():
+            eliminados = eliminar_atletas_por_tempo(loop_id)
+            pendente = self._eliminacao_pendente(loop_id)
+
+        with self._cond:
+            if self._agenda.get(loop_id) == horario:
+                prazo, tentativas = self._retentativas.get(loop_id, (horario, 0))
+                if pendente:
+                    # eliminar_atletas_por_tempo engole erros: tentar de novo mais tarde
+                    tentativas += 1
+                    espera = min(self.ESPERA_RETENTATIVA * 2 ** (tentativas - 1), self.ESPERA_RETENTATIVA_MAXIMA)
+                    novo_horario = datetime.utcnow() + timedelta(seconds=espera)
+                    self._retentativas[loop_id] = (prazo, tentativas)
+                    self._agenda[loop_id] = novo_horario
+                    heapq.heappush(self._heap, (novo_horario, loop_id))
+                    print(f"SCHEDULER: eliminação do loop {loop_id} não aplicada, "
+                          f"nova tentativa em {espera}s (tentativa {tentativas})")
+                else:
+                    del self._agenda[loop_id]
+                    self._retentativas.pop(loop_id, None)
+                    self._disparados[loop_id] = prazo
+            self.lag_ultimo = lag
+            self.lag_maximo = max(self.lag_maximo, lag)
+            self.total_disparos += 1
+            self.ultimo_disparo = datetime.utcnow()
+
+        if eliminados > 0:
+            print(f"SCHEDULER: {eliminados} atletas eliminados automaticamente no loop {loop_id} "
+                  f"(lag: {lag:.3f}s)")
+
+    def _eliminacao_pendente(self, loop_id):
+        """True se o loop segue ATIVO com atletas ATIVOS após o prazo (ou se não foi possível verificar)"""
         try:
-            # Buscar todos os loops ativos
-            loops_ativos = Loop.query.filter_by(status=LoopStatus.ATIVO).all()
-            
-            total_eliminados = 0
-            
-            for loop in loops_ativos:
-                if not loop.data_inicio:
-                    continue
-                    
-                # Verificar se excedeu tempo limite
-                tempo_atual = datetime.utcnow()
-                tempo_decorrido = tempo_atual - loop.data_inicio
-                tempo_total_segundos = int(tempo_decorrido.total_seconds())
-                
-                # Se excedeu o tempo limite, eliminar atletas ativos
-                if tempo_total_segundos > loop.tempo_limite:
-                    eliminados = eliminar_atletas_por_tempo(loop.id)
-                    total_eliminados += eliminados
-                    
-                    if eliminados > 0:
-                        print(f"SCHEDULER: {eliminados} atletas eliminados automaticamente no loop {loop.id} "
-                              f"(tempo: {tempo_total_segundos}s > {loop.tempo_limite}s)")
-            
-            # Log apenas se houver eliminações
-            if total_eliminados > 0:
-                print(f"SCHEDULER: Total de {total_eliminados} atletas eliminados por tempo limite")
-                
+            return db.session.query(AtletaLoop.id).join(
+                Loop, Loop.id == AtletaLoop.loop_id
+            ).filter(
+                Loop.id == loop_id,
+                Loop.status == LoopStatus.ATIVO,
+                AtletaLoop.status == AtletaLoopStatus.ATIVO
+            ).first() is not None
         except Exception as e:
-            print(f"ERRO ao verificar tempo limite: {str(e)}")
+            print(f"ERRO ao verificar eliminação do loop {loop_id}: {str(e)}")
+            db.session.rollback()
+            return True
+
+    def _impressao_loops_ativos(self):
+        """(total, soma dos ids, maior início) dos loops ativos: muda quando um loop inicia ou termina"""
+        return tuple(consulta_loops_ativos().with_entities(
+            func.count(Loop.id),
+            func.coalesce(func.sum(Loop.id), 0),
+            func.max(Loop.data_inicio)
+        ).one())
+
+    def _ressincronizar_loops(self):
+        """Recarrega os prazos de todos os loops ativos a partir do banco"""
+        loops_ativos = consulta_loops_ativos().with_entities(
+            Loop.id, Loop.data_inicio, Loop.tempo_limite
+        ).all()
+
+        with self._cond:
+            ids_ativos = set()
+            for loop_id, data_inicio, tempo_limite in loops_ativos:
+                ids_ativos.add(loop_id)
+                horario = data_inicio + timedelta(seconds=tempo_limite) + self.MARGEM_DISPARO
+                if self._disparados.get(loop_id) == horario or self._agenda.get(loop_id) == horario:
+                    continue
+                if self._retentativas.get(loop_id, (None,))[0] == horario:
+                    continue  # prazo já vencido, aguardando nova tentativa
+                self._agenda[loop_id] = horario
+                self._retentativas.pop(loop_id, None)
+                heapq.heappush(self._heap, (horario, loop_id))
+
+            # Loops que deixaram de estar ativos saem da agenda
+            for loop_id in list(self._agenda):
+                if loop_id not in ids_ativos:
+                    del self._agenda[loop_id]
+            for loop_id in list(self._disparados):
+                if loop_id not in ids_ativos:
+                    del self._disparados[loop_id]
+            for loop_id in list(self._retentativas):
+                if loop_id not in ids_ativos:
+                    del self._retentativas[loop_id]
+            self._cond.notify()
 
 # Instância global do scheduler
 scheduler = BTLScheduler()
 
+# Apenas o processo líder do cluster executa o scheduler
+eleicao = LeaderElector(nome='btl_scheduler')
+
 def init_scheduler(app):
-    """Função para inicializar o scheduler com a aplicação"""
+    """Função para inicializar o scheduler com a aplicação
+
+    O scheduler só roda no processo que vencer a eleição de líder; os demais
+    workers ficam como candidatos e assumem se o líder cair.
+    """
     scheduler.init_app(app)
-    scheduler.start()
+    eleicao.init_app(app, ao_assumir=scheduler.start, ao_perder=scheduler.stop)
+    eleicao.start()
     return scheduler
 
 def stop_scheduler():
     """Função para parar o scheduler"""
-    scheduler.stop()
+    eleicao.stop()
+    if scheduler.running:
+        scheduler.stop()
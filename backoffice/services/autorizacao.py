@@ -0,0 +1,59 @@
+"""
+Contexto de autorização da requisição
+
+O papel (Admin/Organizador) e os ids das organizações do usuário logado são
+montados uma única vez por requisição em um Principal guardado em flask.g.
+O perfil já vem com o usuário (joinedload no user_loader) e as organizações
+custam uma consulta, feita apenas na primeira verificação de escopo; antes
+cada decorator e cada view consultava Profile e Organizacao de novo.
+"""
+
+from flask import g
+from flask_login import current_user
+from sqlalchemy import true, false
+from models import db, Organizacao
+
+class Principal:
+    """Papel e organizações do usuário logado, com o filtro de escopo por organização"""
+
+    def __init__(self, user_id, perfil):
+        self.user_id = user_id
+        self.perfil = perfil
+        self._org_ids = None
+
+    @property
+    def is_admin(self):
+        return self.perfil == 'Admin'
+
+    @property
+    def is_organizador(self):
+        return self.perfil == 'Organizador'
+
+    @property
+    def org_ids(self):
+        """Ids das organizações do usuário (consultados uma vez por requisição)"""
+        if self._org_ids is None:
+            self._org_ids = frozenset(
+                org_id for (org_id,) in db.session.query(Organizacao.id).filter_by(organizador=self.user_id)
+            )
+        return self._org_ids
+
+    def pode_gerenciar(self, organizacao_id):
+        """Admin gerencia tudo; Organizador apenas as próprias organizações"""
+        return self.is_admin or organizacao_id in self.org_ids
+
+    def filtro_organizacao(self, coluna):
+        """Condição para Query.filter() restringindo coluna (id da organização) ao escopo do usuário"""
+        if self.is_admin:
+            return true()
+        return coluna.in_(self.org_ids) if self.org_ids else false()
+
+def principal_atual():
+    """Principal da requisição corrente (None se não há usuário logado)"""
+    if not current_user.is_authenticated:
+        return None
+    principal = g.get('principal')
+    if principal is None or principal.user_id != current_user.id:
+        principal = Principal(current_user.id, current_user.profile.nome)
+        g.principal = principal
+    return principal
@@ -0,0 +1,97 @@
+"""
+Contadores do dashboard
+
+Os totais globais e os de cada organizador são calculados em uma única
+consulta (subconsultas escalares) e mantidos em memória por TTL segundos,
+assim como o total de itens das listagens paginadas por cursor.
+As rotas que criam ou removem usuários, organizações, backyards, atletas e
+inscrições chamam contadores.invalidar() depois do commit; o TTL limita a
+defasagem das alterações feitas por outros processos (ex.: inscrições pelo
+frontend).
+"""
+
+import threading
+import time
+from sqlalchemy import select, func
+from models import db, Backend_Users, Organizacao, Backyard, Atleta, AtletaBackyard
+
+class ContadoresCache:
+    """Cache com TTL dos contadores exibidos no dashboard"""
+
+    TTL = 60  # segundos
+    MAX_ENTRADAS = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._valores = {}  # chave -> (expira_em, dict de contadores)
+
+    def globais(self):
+        """Totais de usuários, organizações, backyards, atletas e inscrições"""
+        return self._obter('globais', _calcular_globais)
+
+    def organizador(self, user_id):
+        """Totais globais mais os das organizações do organizador"""
+        return self._obter(('organizador', user_id), lambda: _calcular_organizador(user_id))
+
+    def total_listagem(self, chave, query):
+        """Total de itens de uma listagem paginada (chave: rota, usuário e filtros)"""
+        return self._obter(('listagem', chave), lambda: {'total': query.scalar()})['total']
+
+    def invalidar(self):
+        """Descarta todos os contadores (chamar após o commit da alteração)"""
+        with self._lock:
+            self._valores.clear()
+
+    def _obter(self, chave, calcular):
+        agora = time.monotonic()
+        with self._lock:
+            entrada = self._valores.get(chave)
+        if entrada is not None and entrada[0] > agora:
+            return dict(entrada[1])
+
+        valores = calcular()
+        with self._lock:
+            if len(self._valores) >= self.MAX_ENTRADAS:
+                # Listagens com filtros arbitrários não acumulam entradas vencidas
+                self._valores = {k: v for k, v in self._valores.items() if v[0] > agora}
+                if len(self._valores) >= self.MAX_ENTRADAS:
+                    self._valores.clear()
+            self._valores[chave] = (agora + self.TTL, valores)
+        return dict(valores)
+
+def _contagem(coluna, *condicoes):
+    """Subconsulta escalar COUNT(coluna) com as condições informadas"""
+    return select(func.count(coluna)).where(*condicoes).scalar_subquery()
+
+def _subconsultas_globais():
+    return {
+        'total_users': _contagem(Backend_Users.id),
+        'total_organizacoes': _contagem(Organizacao.id),
+        'total_backyards': _contagem(Backyard.id),
+        'total_atletas': _contagem(Atleta.id),
+        'total_inscricoes': _contagem(AtletaBackyard.id),
+    }
+
+def _executar(subconsultas):
+    linha = db.session.execute(select(*[s.label(nome) for nome, s in subconsultas.items()])).one()
+    return dict(linha._mapping)
+
+def _calcular_globais():
+    return _executar(_subconsultas_globais())
+
+def _calcular_organizador(user_id):
+    minhas_backyards = select(Backyard.id).join(
+        Organizacao, Backyard.organizador == Organizacao.id
+    ).where(Organizacao.organizador == user_id)
+
+    subconsultas = _subconsultas_globais()
+    subconsultas.update({
+        'my_organizacoes': _contagem(Organizacao.id, Organizacao.organizador == user_id),
+        'my_backyards': _contagem(Backyard.id, Backyard.id.in_(minhas_backyards)),
+        'my_atletas': _contagem(AtletaBackyard.atleta_id.distinct(), AtletaBackyard.backyard_id.in_(minhas_backyards)),
+        'my_inscricoes': _contagem(AtletaBackyard.id, AtletaBackyard.backyard_id.in_(minhas_backyards)),
+    })
+    return _executar(subconsultas)
+
+# Instância global do cache de contadores
+contadores = ContadoresCache()
@@ -0,0 +1,128 @@
+"""
+Idempotência das escritas de cronometragem
+
+Requisições enviadas com o cabeçalho Idempotency-Key têm a resposta
+registrada em requisicoes_idempotentes. Uma retentativa com a mesma chave
+recebe a resposta original em vez de executar a escrita de novo (o que, por
+exemplo, devolveria "Atleta não está ativo" para uma chegada já registrada).
+"""
+
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, make_response, jsonify
+from flask_login import current_user
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from models import db, RequisicaoIdempotente
+
+CABECALHO = 'Idempotency-Key'
+
+# Por quanto tempo a resposta original é reproduzida
+TTL_RESPOSTA = timedelta(hours=24)
+
+# Reserva da chave enquanto a requisição original executa; se o processo
+# morrer no meio, a chave volta a ficar livre depois desse prazo
+TTL_RESERVA = timedelta(seconds=60)
+
+# Remoção periódica das chaves expiradas (por processo)
+INTERVALO_LIMPEZA = 300
+_proxima_limpeza = 0
+
+def idempotente(f):
+    """Decorator: reproduz a resposta original para requisições repetidas com a mesma Idempotency-Key"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        chave_cliente = request.headers.get(CABECALHO)
+        if not chave_cliente:
+            return f(*args, **kwargs)
+
+        if len(chave_cliente) > 255:
+            return jsonify({'success': False, 'message': f'{CABECALHO} inválida'}), 400
+
+        chave = _calcular_chave(chave_cliente)
+        registro = _reservar(chave)
+        if registro is not None:
+            return _reproduzir(registro)
+
+        try:
+            resposta = make_response(f(*args, **kwargs))
+        except Exception:
+            _liberar(chave)
+            raise
+
+        # Erros do servidor não são registrados: a retentativa executa de novo
+        if resposta.status_code >= 500:
+            _liberar(chave)
+        else:
+            _registrar(chave, resposta)
+        return resposta
+    return decorated_function
+
+def _calcular_chave(chave_cliente):
+    """A mesma chave vinda de outro usuário ou para outro endpoint é outra requisição"""
+    usuario = current_user.get_id() if current_user.is_authenticated else ''
+    bruta = f"{usuario}\n{request.method}\n{request.path}\n{chave_cliente}"
+    return hashlib.sha256(bruta.encode('utf-8')).hexdigest()
+
+def _reservar(chave):
+    """
+    Reserva a chave em transação própria (independente do commit/rollback da view)
+    Retorna None se a reserva foi feita, ou o registro existente da chave
+    """
+    global _proxima_limpeza
+    tabela = RequisicaoIdempotente.__table__
+    agora = datetime.utcnow()
+
+    try:
+        with db.engine.begin() as conexao:
+            if time.monotonic() >= _proxima_limpeza:
+                _proxima_limpeza = time.monotonic() + INTERVALO_LIMPEZA
+                conexao.execute(tabela.delete().where(tabela.c.expira_em < agora))
+            else:
+                conexao.execute(tabela.delete().where(tabela.c.chave == chave, tabela.c.expira_em < agora))
+
+            conexao.execute(tabela.insert().values(
+                chave=chave,
+                criado_em=agora,
+                expira_em=agora + TTL_RESERVA
+            ))
+        return None
+    except IntegrityError:
+        pass
+
+    with db.engine.connect() as conexao:
+        registro = conexao.execute(select(tabela).where(tabela.c.chave == chave)).first()
+    # Registro removido entre as duas consultas: tratar como ainda em processamento
+    return registro if registro is not None else RequisicaoIdempotente(chave=chave)
+
+def _reproduzir(registro):
+    """Resposta para uma chave já vista"""
+    if registro.status_code is None:
+        resposta = jsonify({'success': False, 'message': 'Requisição em processamento, tente novamente'})
+        resposta.status_code = 409
+        resposta.headers['Retry-After'] = '1'
+        return resposta
+
+    resposta = make_response(registro.resposta, registro.status_code)
+    resposta.mimetype = registro.mimetype
+    resposta.headers['Idempotent-Replayed'] = 'true'
+    return resposta
+
+def _registrar(chave, resposta):
+    """Grava a resposta da requisição original"""
+    tabela = RequisicaoIdempotente.__table__
+    with db.engine.begin() as conexao:
+        conexao.execute(tabela.update().where(tabela.c.chave == chave).values(
+            status_code=resposta.status_code,
+            resposta=resposta.get_data(as_text=True),
+            mimetype=resposta.mimetype,
+            expira_em=datetime.utcnow() + TTL_RESPOSTA
+        ))
+
+def _liberar(chave):
+    """Desfaz a reserva para que a retentativa execute a escrita"""
+    tabela = RequisicaoIdempotente.__table__
+    with db.engine.begin() as conexao:
+        conexao.execute(tabela.delete().where(tabela.c.chave == chave))
@@ -1,31 +1,40 @@
-import os
 import io
-import uuid
-from minio import Minio
-from minio.error import S3Error
-from PIL import Image
+import hashlib
+from collections import OrderedDict
+from PIL import Image, ImageOps
 import magic
 from werkzeug.utils import secure_filename
+from services.armazenamento import criar_armazenamento
 
 class ImageService:
+    """
+    Validação, variantes, armazenamento e URLs das imagens
+
+    Use a instância do processo (image_service, no fim do módulo). Os objetos
+    ficam no backend de services.armazenamento (MinIO ou diretório local) com
+    nomes endereçados pelo conteúdo: {image_type}/{sha256 do arquivo enviado}/
+    {tamanho}.{formato}. A mesma imagem enviada de novo (ex.: o logo a cada
+    edição) cai no mesmo nome e é armazenada uma vez só; quantos registros usam
+    cada imagem fica em imagens_armazenadas (services.processamento_imagens).
+    URLs são montadas apenas com strings, sem acessar o backend; a largura real
+    de cada variante (srcset) fica em imagens_armazenadas.larguras.
+    """
+
+    # Variantes geradas no upload (largura máxima; 'full' usa max_dimensions),
+    # cada uma em WebP e JPEG. O caminho salvo no banco é o da variante full.jpg
+    VARIANT_SIZES = {'thumb': 160, 'card': 640, 'full': None}
+    CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+    SNIFF_SIZE = 8 * 1024   # bytes read to detect the file type
+    CHUNK_SIZE = 64 * 1024  # upload read size
+    MAX_KNOWN_WIDTHS = 4096  # prefixes whose variant widths are kept in memory
+
     def __init__(self):
-        # MinIO configuration
-        self.minio_endpoint = os.environ.get('MINIO_ENDPOINT', 'minio:9000')
-        self.minio_access_key = os.environ.get('MINIO_ACCESS_KEY', 'minioadmin')
-        self.minio_secret_key = os.environ.get('MINIO_SECRET_KEY', 'minioadmin123')
-        self.bucket_name = os.environ.get('MINIO_BUCKET', 'btl-images')
-        self.minio_secure = os.environ.get('MINIO_SECURE', 'False').lower() == 'true'
+        # Storage backend (BTL_IMAGENS_BACKEND: minio or local)
+        self.storage = criar_armazenamento()
         
-        # Initialize MinIO client
-        self.client = Minio(
-            self.minio_endpoint,
-            access_key=self.minio_access_key,
-            secret_key=self.minio_secret_key,
-            secure=self.minio_secure
-        )
-        
-        # For URL generation, use public endpoint if provided, otherwise use configured endpoint
-        self.public_endpoint = os.environ.get('MINIO_PUBLIC_ENDPOINT', self.minio_endpoint)
+        # prefix -> {size: width}; content-addressed images never change, so no expiry
+        self._widths = OrderedDict()
         
         # Allowed file extensions and MIME types
         self.allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
@@ -36,185 +45,295 @@ class ImageService:
         # Maximum file size (5MB)
         self.max_file_size = 5 * 1024 * 1024
         
+        # Maximum pixels: JPEGs are decoded downscaled, other formats at full size (4 bytes/pixel)
+        self.max_pixels = 50_000_000
+        self.max_pixels_full_decode = 16_000_000
+        
         # Image size limits
         self.max_dimensions = {
             'profile_picture': (1200, 800),  # Main backyard photo
             'logo': (400, 400)  # Logo
         }
     
+    def init_app(self, app):
+        """Registers the route that serves images when the storage is a local directory"""
+        self.storage.init_app(app)
     
-    def validate_image(self, file):
-        """Validate uploaded image file"""
-        errors = []
-        
+    def read_image(self, file):
+        """
+        Read and validate an uploaded image in a single pass -> (content, errors)
+
+        The size cap is enforced while reading, the type is sniffed from the
+        first chunk and the pixel dimensions come from the header, so large
+        files, non-images and decompression bombs are rejected without being
+        read whole or decoded.
+        """
         if not file or not file.filename:
-            errors.append("No file selected")
-            return errors
+            return None, ["No file selected"]
         
         # Check file extension
         filename = secure_filename(file.filename)
         if '.' not in filename:
-            errors.append("File must have an extension")
-            return errors
+            return None, ["File must have an extension"]
         
         extension = filename.rsplit('.', 1)[1].lower()
         if extension not in self.allowed_extensions:
-            errors.append(f"File type not allowed. Allowed: {', '.join(self.allowed_extensions)}")
+            return None, [f"File type not allowed. Allowed: {', '.join(self.allowed_extensions)}"]
         
-        # Read file content for validation
         file.seek(0)
-        file_content = file.read()
-        file.seek(0)  # Reset file pointer
+        head = file.read(self.SNIFF_SIZE)
+        errors = self._check_type(head)
+        if errors:
+            return None, errors
         
-        # Check file size
-        if len(file_content) > self.max_file_size:
-            errors.append(f"File too large. Maximum size: {self.max_file_size // (1024*1024)}MB")
+        content = io.BytesIO()
+        content.write(head)
+        while True:
+            chunk = file.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            if content.tell() + len(chunk) > self.max_file_size:
+                return None, [self.too_large_error()]
+            content.write(chunk)
         
-        # Check MIME type using python-magic
+        content = content.getvalue()
+        errors = self._check_dimensions(content)
+        return (None, errors) if errors else (content, [])
+    
+    def validate_image_data(self, data):
+        """Validate image bytes already in memory (e.g. cropped in the browser)"""
+        if len(data) > self.max_file_size:
+            return [self.too_large_error()]
+        return self._check_type(data[:self.SNIFF_SIZE]) or self._check_dimensions(data)
+    
+    def too_large_error(self):
+        """Error message for files over max_file_size"""
+        return f"File too large. Maximum size: {self.max_file_size // (1024*1024)}MB"
+    
+    def _check_type(self, head):
+        """Check MIME type using python-magic on the first bytes of the file"""
         try:
-            mime_type = magic.from_buffer(file_content, mime=True)
+            mime_type = magic.from_buffer(head, mime=True)
             if mime_type not in self.allowed_mime_types:
-                errors.append(f"Invalid file type: {mime_type}")
-        except Exception as e:
-            errors.append("Could not determine file type")
+                return [f"Invalid file type: {mime_type}"]
+        except Exception:
+            return ["Could not determine file type"]
+        return []
+    
+    def _check_dimensions(self, content):
+        """Reject decompression bombs using the dimensions in the image header (nothing is decoded)"""
+        try:
+            with Image.open(io.BytesIO(content)) as image:
+                width, height = image.size
+                image_format = image.format
+        except Image.DecompressionBombError:
+            return ["Image dimensions too large"]
+        except Exception:
+            return ["Could not read image"]
         
-        return errors
+        # JPEGs are decoded already downscaled (draft mode); other formats at full size
+        max_pixels = self.max_pixels if image_format == 'JPEG' else self.max_pixels_full_decode
+        if width * height > max_pixels:
+            return [f"Image dimensions too large: {width}x{height} pixels"]
+        return []
     
-    def resize_image(self, file_content, image_type='profile_picture'):
-        """Resize image to appropriate dimensions"""
-        max_width, max_height = self.max_dimensions.get(image_type, (800, 600))
+    def create_variants(self, file_content, image_type='profile_picture'):
+        """Render every variant (orientation applied, EXIF stripped) -> {(size, format): bytes}"""
+        errors = self._check_dimensions(file_content)
+        if errors:
+            raise Exception(f"Error processing image: {errors[0]}")
         
         try:
-            # Open image
             image = Image.open(io.BytesIO(file_content))
+            image.seek(0)  # first frame of animated GIFs
             
-            # Convert to RGB if necessary
-            if image.mode in ('RGBA', 'LA', 'P'):
-                image = image.convert('RGB')
+            # JPEG: let the decoder scale down by 1/2, 1/4 or 1/8 while decoding,
+            # keeping at least the full variant size (in either orientation)
+            side = max(self.variant_box('full', image_type))
+            image.draft('RGB', (side, side))
+            image = ImageOps.exif_transpose(image)
             
-            # Calculate new dimensions maintaining aspect ratio
-            width, height = image.size
-            aspect_ratio = width / height
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+            image = image.convert('RGBA' if has_alpha else 'RGB')
             
-            if width > max_width or height > max_height:
-                if width > height:
-                    new_width = max_width
-                    new_height = int(max_width / aspect_ratio)
-                else:
-                    new_height = max_height
-                    new_width = int(max_height * aspect_ratio)
+            # Largest to smallest, each resized in place from the previous one (no extra copies)
+            variants = {}
+            for size in reversed(list(self.VARIANT_SIZES)):
+                image.thumbnail(self.variant_box(size, image_type), Image.Resampling.LANCZOS)
                 
-                image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Save to bytes
-            output = io.BytesIO()
-            image.save(output, format='JPEG', quality=85, optimize=True)
-            output.seek(0)
+                # WebP keeps transparency; the JPEG fallback is flattened on white
+                output = io.BytesIO()
+                image.save(output, format='WEBP', quality=80, method=4)
+                variants[(size, 'webp')] = output.getvalue()
+                
+                flat = image
+                if has_alpha:
+                    flat = Image.new('RGB', image.size, (255, 255, 255))
+                    flat.paste(image, mask=image.getchannel('A'))
+                output = io.BytesIO()
+                flat.save(output, format='JPEG', quality=85, optimize=True, progressive=True)
+                variants[(size, 'jpg')] = output.getvalue()
             
-            return output.getvalue()
+            return variants
         
         except Exception as e:
             raise Exception(f"Error processing image: {str(e)}")
     
-    def upload_image_data(self, image_data, filename, image_type='profile_picture', folder='backyards'):
-        """Upload image data directly to MinIO"""
+    def variant_box(self, size, image_type):
+        """Bounding box (width, height) of a variant"""
+        full = self.max_dimensions.get(image_type, (800, 600))
+        if size == 'full':
+            return full
+        width = min(self.VARIANT_SIZES[size], full[0])
+        return (width, width * 2)
+    
+    def variant_widths(self, variants):
+        """Rendered width of each variant size, read from the JPEG headers -> {size: width}"""
+        widths = {}
+        for (size, fmt), data in variants.items():
+            if fmt == 'jpg':
+                with Image.open(io.BytesIO(data)) as image:
+                    widths[size] = image.width
+        return widths
+    
+    def encode_widths(self, widths):
+        """Widths as stored in imagens_armazenadas.larguras: '160,640,1200' (VARIANT_SIZES order)"""
+        if not widths:
+            return None
+        return ','.join(str(widths[size]) for size in self.VARIANT_SIZES)
+    
+    def decode_widths(self, value):
+        """Inverse of encode_widths ({} for images stored before the widths were recorded)"""
         try:
-            # Generate unique filename
-            extension = filename.split('.')[-1] if '.' in filename else 'jpg'
-            unique_filename = f"{uuid.uuid4().hex}.{extension}"
-            
-            # Create object name with folder structure
-            object_name = f"{folder}/{image_type}/{unique_filename}"
-            
-            # Upload to MinIO
-            self.client.put_object(
-                self.bucket_name,
-                object_name,
-                io.BytesIO(image_data),
-                length=len(image_data),
-                content_type='image/jpeg'
-            )
-            
-            # Use public endpoint for URL generation
-            protocol = 'https' if self.minio_secure else 'http'
+            return dict(zip(self.VARIANT_SIZES, (int(width) for width in value.split(','))))
+        except (AttributeError, ValueError):
+            return {}
+    
+    def remember_widths(self, prefix, widths):
+        """Keep the variant widths of an image for get_srcset"""
+        self._widths[prefix] = widths
+        self._widths.move_to_end(prefix)
+        while len(self._widths) > self.MAX_KNOWN_WIDTHS:
+            self._widths.popitem(last=False)
+    
+    def stored_widths(self, prefix):
+        """Variant widths recorded when the image was stored (one lookup per image and process)"""
+        widths = self._widths.get(prefix)
+        if widths is None:
+            # Late import: the storage layer does not depend on the models otherwise
+            from models import db, ImagemArmazenada
+            try:
+                value = db.session.query(ImagemArmazenada.larguras).filter_by(prefixo=prefix).scalar()
+            except Exception as e:
+                print(f"Error reading variant widths: {e}")
+                return {}
+            widths = self.decode_widths(value)
+            self.remember_widths(prefix, widths)
+        return widths
+    
+    def content_prefix(self, file_content, image_type='profile_picture'):
+        """Object prefix of an image, derived from the uploaded bytes: {image_type}/{sha256}"""
+        return f"{image_type}/{hashlib.sha256(file_content).hexdigest()}"
+    
+    def store_variants(self, prefix, variants):
+        """Store the rendered variants under prefix and return the file_path (full-size JPEG)"""
+        for (size, fmt), data in variants.items():
+            self.storage.gravar(f"{prefix}/{size}.{fmt}", data, self.CONTENT_TYPES[fmt])
+        return f"{prefix}/full.jpg"
+    
+    def is_stored(self, file_path):
+        """True if the image (its full-size JPEG) is in the storage"""
+        return self.storage.existe(file_path)
+    
+    def upload_variants(self, file_content, image_type='profile_picture', folder=None):
+        """
+        Store all variants of an image synchronously; file_path is the full-size JPEG
+
+        folder is kept for compatibility: names are content-addressed. No
+        reference is recorded, see services.processamento_imagens for that.
+        """
+        try:
+            object_name = f"{self.content_prefix(file_content, image_type)}/full.jpg"
+            if not self.is_stored(object_name):
+                variants = self.create_variants(file_content, image_type)
+                self.store_variants(object_name.rsplit('/', 1)[0], variants)
             return {
                 'success': True,
                 'file_path': object_name,
-                'file_url': f"{protocol}://{self.public_endpoint}/{self.bucket_name}/{object_name}"
+                'file_url': self.get_public_url(object_name)
             }
         
         except Exception as e:
             return {'success': False, 'errors': [f"Upload failed: {str(e)}"]}
+    
+    def upload_image_data(self, image_data, filename, image_type='profile_picture', folder=None):
+        """Upload image data (e.g. cropped in the browser)"""
+        return self.upload_variants(image_data, image_type, folder)
 
-    def upload_image(self, file, image_type='profile_picture', folder='backyards'):
-        """Upload image to MinIO"""
-        # Validate image
-        errors = self.validate_image(file)
+    def upload_image(self, file, image_type='profile_picture', folder=None):
+        """Upload image"""
+        # Read and validate image
+        content, errors = self.read_image(file)
         if errors:
             return {'success': False, 'errors': errors}
         
-        try:
-            # Read file content
-            file.seek(0)
-            file_content = file.read()
-            
-            # Resize image
-            resized_content = self.resize_image(file_content, image_type)
-            
-            # Generate unique filename
-            filename = secure_filename(file.filename)
-            extension = filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{uuid.uuid4().hex}.{extension}"
-            
-            # Create object name with folder structure
-            object_name = f"{folder}/{image_type}/{unique_filename}"
-            
-            # Upload to MinIO
-            self.client.put_object(
-                self.bucket_name,
-                object_name,
-                io.BytesIO(resized_content),
-                length=len(resized_content),
-                content_type='image/jpeg'
-            )
-            
-            # Use public endpoint for URL generation
-            protocol = 'https' if self.minio_secure else 'http'
-            return {
-                'success': True,
-                'file_path': object_name,
-                'file_url': f"{protocol}://{self.public_endpoint}/{self.bucket_name}/{object_name}"
-            }
-        
-        except Exception as e:
-            return {'success': False, 'errors': [f"Upload failed: {str(e)}"]}
+        return self.upload_variants(content, image_type, folder)
+    
+    def variant_names(self, file_path):
+        """Object names of all variants of an image (just file_path for images stored before variants)"""
+        if not self.has_variants(file_path):
+            return [file_path]
+        prefix = file_path.rsplit('/', 1)[0]
+        return [f"{prefix}/{size}.{fmt}" for size in self.VARIANT_SIZES for fmt in self.CONTENT_TYPES]
+    
+    def has_variants(self, file_path):
+        return bool(file_path) and file_path.endswith('/full.jpg')
     
     def delete_image(self, file_path):
-        """Delete image from MinIO"""
+        """
+        Delete the objects of an image (and its variants) from the storage
+
+        Content-addressed images may be shared: callers release references
+        through services.processamento_imagens, which deletes them after the
+        commit that releases the last one.
+        """
         try:
-            self.client.remove_object(self.bucket_name, file_path)
+            self.storage.remover(self.variant_names(file_path))
             return True
         except Exception as e:
             print(f"Error deleting image: {e}")
             return False
     
-    def get_image_url(self, file_path, expiry=3600):
-        """Get public URL for image (bucket is public)"""
-        try:
-            if not file_path:
-                return None
-            
-            # Since bucket is public, we can use direct URLs
-            protocol = 'https' if self.minio_secure else 'http'
-            public_url = f"{protocol}://{self.public_endpoint}/{self.bucket_name}/{file_path}"
-            return public_url
-        except Exception as e:
-            print(f"Error getting image URL: {e}")
-            return None
+    def get_image_url(self, file_path, expiry=3600, size=None, fmt='jpg'):
+        """Get public URL for image (no request to the storage)"""
+        return self.get_public_url(file_path, size, fmt)
     
-    def get_public_url(self, file_path):
-        """Get public URL for image (if bucket is public)"""
+    def get_public_url(self, file_path, size=None, fmt='jpg'):
+        """Get public URL for image, optionally of a variant (thumb/card/full)"""
         if not file_path:
             return None
-        protocol = 'https' if self.minio_secure else 'http'
-        return f"{protocol}://{self.public_endpoint}/{self.bucket_name}/{file_path}"
+        if size not in self.VARIANT_SIZES:
+            size = 'full'
+        if (size != 'full' or fmt != 'jpg') and fmt in self.CONTENT_TYPES and self.has_variants(file_path):
+            file_path = f"{file_path.rsplit('/', 1)[0]}/{size}.{fmt}"
+        return self.storage.url_base + file_path
+    
+    def get_srcset(self, file_path, fmt='jpg'):
+        """srcset attribute value with all variants ('' for images stored before variants)"""
+        if not self.has_variants(file_path):
+            return ''
+        prefix = file_path.rsplit('/', 1)[0]
+        image_type = prefix.rsplit('/', 2)[-2]
+        stored = self.stored_widths(prefix)
+        widths = {}  # width -> smallest variant with it (a small image has the same width in every size)
+        for size in self.VARIANT_SIZES:
+            # Images stored before the widths were recorded: the variant's bounding box
+            widths.setdefault(stored.get(size) or self.variant_box(size, image_type)[0], size)
+        return ', '.join(f"{self.get_public_url(file_path, size, fmt)} {width}w" for width, size in widths.items())
+
+# Instância do processo (backend de armazenamento compartilhado)
+image_service = ImageService()
+
+def create_variants(file_content, image_type='profile_picture'):
+    """Variantes de uma imagem; ponto de entrada dos processos de services.processamento_imagens"""
+    return image_service.create_variants(file_content, image_type)
@@ -0,0 +1,245 @@
+"""
+Paginação por cursor (keyset)
+
+Em vez de OFFSET, cada página continua a partir da chave de ordenação do
+último item exibido (WHERE chave > cursor ORDER BY chave LIMIT n + 1), então
+a página 500 custa o mesmo que a primeira. O cursor da URL é a chave
+codificada (JSON em base64); a última coluna da chave precisa ser única
+(normalmente o id). Colunas anuláveis podem fazer parte da chave: NULL vem
+antes de qualquer valor, como no ORDER BY do MariaDB e do SQLite, e o cursor
+guarda o NULL. Se a primeira coluna é anulável, paginar() separa as linhas
+com NULL em um segmento próprio, para que o intervalo da primeira coluna
+continue servido pelo índice. O total de itens não faz parte da página: o backoffice usa
+contadores.total_listagem(), que fica em cache, e o catálogo público exibe as
+contagens das facetas (services/catalogo.py).
+
+Ordenações que não são uma chave de colunas (ex.: eventos ativos primeiro,
+sem data por último) usam paginar_segmentos(): cada segmento é uma query
+ordenada pelas próprias colunas, que um índice consegue servir, em vez de uma
+chave calculada (CASE, COALESCE) que obriga a ordenar a tabela inteira.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from sqlalchemy import and_, or_, true, false
+
+class PaginaKeyset:
+    """Itens de uma página e os cursores das páginas vizinhas"""
+
+    def __init__(self, items, per_page, page, total, prev_cursor, next_cursor):
+        self.items = items
+        self.per_page = per_page
+        self.page = page
+        self.total = total
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def primeiro(self):
+        """Posição (1-based) do primeiro item exibido"""
+        return (self.page - 1) * self.per_page + 1 if self.items else 0
+
+    @property
+    def ultimo(self):
+        return (self.page - 1) * self.per_page + len(self.items)
+
+def paginar(query, chaves, per_page, page=1, total=None, apos=None, antes=None):
+    """
+    Página de query ordenada por chaves, lista de (expressão, descendente)
+
+    apos/antes são cursores recebidos na URL (próxima/página anterior); um
+    cursor inválido volta para a primeira página. page serve apenas para
+    exibir a posição dos itens.
+    """
+    segmentos = segmentos_keyset(query, chaves)
+    if len(segmentos) > 1:
+        return paginar_segmentos(segmentos, per_page, page, total, apos, antes)
+
+    voltando = bool(antes)
+    valores = _decodificar(antes or apos, chaves) if (antes or apos) else None
+    if valores is None:
+        voltando = False
+        page = 1
+
+    linhas = _buscar(query, chaves, valores, voltando, per_page + 1)
+
+    mais = len(linhas) > per_page
+    linhas = linhas[:per_page]
+    if voltando:
+        linhas.reverse()
+
+    n = len(chaves)
+    items = [tuple(linha)[:-n] for linha in linhas]
+    primeiro = _codificar(tuple(linhas[0])[-n:]) if linhas else None
+    ultimo = _codificar(tuple(linhas[-1])[-n:]) if linhas else None
+
+    if voltando:
+        prev_cursor = primeiro if mais else None
+        next_cursor = ultimo
+    else:
+        prev_cursor = primeiro if valores is not None else None
+        next_cursor = ultimo if mais else None
+
+    return PaginaKeyset(items, per_page, max(page, 1), total, prev_cursor, next_cursor)
+
+def paginar_segmentos(segmentos, per_page, page=1, total=None, apos=None, antes=None):
+    """
+    Página de uma listagem formada por segmentos consecutivos, lista de (query, chaves)
+
+    Cada segmento é paginado como em paginar(); quando um acaba, a página
+    continua no seguinte (ou no anterior, na volta). O cursor guarda o
+    segmento e a chave do item, então continuar em qualquer segmento custa
+    o mesmo que a primeira página. A primeira coluna da chave de cada
+    segmento não pode ser NULL nas linhas do segmento.
+    """
+    voltando = bool(antes)
+    posicao = _decodificar_segmento(antes or apos, segmentos) if (antes or apos) else None
+    if posicao is None:
+        voltando = False
+        page = 1
+        inicio, valores = 0, None
+    else:
+        inicio, valores = posicao
+
+    linhas = []  # (segmento, linha)
+    for i in (range(inicio, -1, -1) if voltando else range(inicio, len(segmentos))):
+        query, chaves = segmentos[i]
+        encontradas = _buscar(query, chaves, valores if i == inicio else None, voltando,
+                              per_page + 1 - len(linhas))
+        linhas.extend((i, linha) for linha in encontradas)
+        if len(linhas) > per_page:
+            break
+
+    mais = len(linhas) > per_page
+    linhas = linhas[:per_page]
+    if voltando:
+        linhas.reverse()
+
+    def cursor(i, linha):
+        return _codificar((i,) + tuple(linha)[-len(segmentos[i][1]):])
+
+    items = [tuple(linha)[:-len(segmentos[i][1])] for i, linha in linhas]
+    primeiro = cursor(*linhas[0]) if linhas else None
+    ultimo = cursor(*linhas[-1]) if linhas else None
+
+    if voltando:
+        prev_cursor = primeiro if mais else None
+        next_cursor = ultimo
+    else:
+        prev_cursor = primeiro if valores is not None else None
+        next_cursor = ultimo if mais else None
+
+    return PaginaKeyset(items, per_page, max(page, 1), total, prev_cursor, next_cursor)
+
+def segmentos_keyset(query, chaves):
+    """
+    Segmentos (query, chaves) em que paginar() divide a query
+
+    Com a primeira coluna anulável, as linhas com NULL formam um segmento
+    ordenado pelas demais colunas: primeiro na ordem crescente, por último na
+    decrescente, como o MariaDB e o SQLite as ordenam.
+    """
+    primeira, descendente = chaves[0]
+    if not _anulavel(primeira):
+        return [(query, chaves)]
+    com_valor = (query.filter(primeira.isnot(None)), chaves)
+    nulos = (query.filter(primeira.is_(None)), chaves[1:])
+    return [com_valor, nulos] if descendente else [nulos, com_valor]
+
+def consulta_keyset(query, chaves, valores=None, voltando=False, limite=None):
+    """
+    Query de uma página: até limite linhas depois da chave valores (desde o início se None)
+
+    As colunas da chave vêm no fim de cada linha. Usada também pelo
+    explain_consultas.py para conferir o plano das páginas seguintes.
+    """
+    if valores is not None:
+        query = query.filter(_depois_de(chaves, valores, voltando))
+
+    # Na volta a ordem é invertida e o resultado é revertido por quem chama
+    ordem = [e.asc() if descendente == voltando else e.desc() for e, descendente in chaves]
+    colunas_chave = [e.label(f'_chave_{i}') for i, (e, _) in enumerate(chaves)]
+    return query.add_columns(*colunas_chave).order_by(*ordem).limit(limite)
+
+def _buscar(query, chaves, valores, voltando, limite):
+    return consulta_keyset(query, chaves, valores, voltando, limite).all()
+
+def _depois_de(chaves, valores, voltando):
+    """
+    (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ..., com o sentido de cada coluna
+
+    k1 >= v1 é repetido fora do OR para o banco usar o índice como intervalo
+    em vez de percorrê-lo desde o início.
+    """
+    condicoes = []
+    for i, (expressao, descendente) in enumerate(chaves):
+        iguais = [_igual(chaves[j][0], valores[j]) for j in range(i)]
+        condicoes.append(and_(*iguais, _alem(expressao, valores[i], descendente == voltando)))
+    primeira, descendente = chaves[0]
+    limite = _alem(primeira, valores[0], descendente == voltando, inclusive=True, nulos=False)
+    return and_(limite, or_(*condicoes))
+
+def _igual(expressao, valor):
+    return expressao.is_(None) if valor is None else expressao == valor
+
+def _alem(expressao, valor, maior, inclusive=False, nulos=True):
+    """expressao depois de valor no sentido maior/menor, com NULL antes de qualquer valor
+
+    nulos=False omite o IS NULL (coluna sem NULL nas linhas da query), para
+    que o banco use o índice como intervalo.
+    """
+    if valor is None:
+        if maior:
+            return true() if inclusive else expressao.isnot(None)
+        return expressao.is_(None) if inclusive else false()
+    if maior:
+        return expressao >= valor if inclusive else expressao > valor
+    comparacao = expressao <= valor if inclusive else expressao < valor
+    return or_(comparacao, expressao.is_(None)) if nulos and _anulavel(expressao) else comparacao
+
+def _anulavel(expressao):
+    """True para colunas anuláveis (expressões calculadas, como COALESCE, são tratadas como não nulas)"""
+    return getattr(getattr(expressao, 'expression', expressao), 'nullable', False)
+
+def _codificar(valores):
+    dados = [v.isoformat() if isinstance(v, datetime) else v for v in valores]
+    return base64.urlsafe_b64encode(json.dumps(dados).encode()).decode().rstrip('=')
+
+def _decodificar(cursor, chaves):
+    return _converter(_ler(cursor), chaves)
+
+def _decodificar_segmento(cursor, segmentos):
+    """(segmento, valores) de um cursor de paginar_segmentos (None se inválido)"""
+    dados = _ler(cursor)
+    if not dados or not isinstance(dados[0], int) or not 0 <= dados[0] < len(segmentos):
+        return None
+    valores = _converter(dados[1:], segmentos[dados[0]][1])
+    return (dados[0], valores) if valores is not None else None
+
+def _ler(cursor):
+    try:
+        dados = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    return dados if isinstance(dados, list) else None
+
+def _converter(dados, chaves):
+    if dados is None or len(dados) != len(chaves):
+        return None
+    try:
+        return [
+            datetime.fromisoformat(v) if v is not None and expressao.type.python_type is datetime else v
+            for v, (expressao, _) in zip(dados, chaves)
+        ]
+    except (ValueError, TypeError):
+        return None
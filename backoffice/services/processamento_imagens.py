@@ -0,0 +1,396 @@
+"""
+Processamento das imagens enviadas em segundo plano
+
+Gerar as variantes (decodificar, redimensionar com LANCZOS e codificar em
+WebP/JPEG) e enviá-las ao MinIO levava segundos dentro da requisição. Agora a
+view valida o arquivo, grava o registro e entrega os bytes a enviar(), que
+responde na hora com o caminho que a imagem terá. O trabalho segue em uma
+thread: as variantes são geradas em um pool de processos (BTL_IMAGENS_PROCESSOS,
+0 = na própria thread; criado no primeiro trabalho), armazenadas (services.armazenamento) e só então gravadas na coluna do
+registro (Backyard.profile_picture_path/logo_path, Atleta.imagem_perfil). Até
+lá as páginas continuam exibindo a imagem anterior.
+
+Os nomes das imagens são endereçados pelo conteúdo: se a mesma imagem já está
+armazenada (ex.: o logo reenviado a cada edição), não há processamento nem
+envio. imagens_armazenadas conta os registros que usam cada imagem;
+adquirir_imagem/liberar_imagem atualizam a contagem na transação da troca, e
+os objetos só são removidos depois do commit que liberou a última referência.
+As duas bloqueiam a linha da imagem e adquirir confere se os objetos ainda
+existem, então uma imagem removida por outro processo no meio do caminho é
+enviada de novo.
+
+- no máximo MAX_PENDENTES trabalhos por processo (os bytes ficam em memória);
+  com a fila cheia enviar() aguarda uma vaga por até ESPERA_VAGA segundos
+- falhas de envio/gravação são repetidas TENTATIVAS vezes, com espera
+  crescente; imagens que não podem ser decodificadas falham na hora
+- status(id) informa a situação do trabalho (neste processo)
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Backyard, AtletaBackyard, ImagemArmazenada
+from services.image_service import image_service, create_variants
+from services.race_state import race_states
+
+class ImagemInvalida(Exception):
+    """A imagem não pôde ser processada (não adianta tentar de novo)"""
+
+class ImagemRemovida(Exception):
+    """Os objetos da imagem foram removidos antes de a referência ser registrada"""
+
+class TrabalhoImagem:
+    """Uma imagem enviada, do recebimento até a gravação no registro"""
+
+    def __init__(self, conteudo, modelo, registro_id, campo, image_type):
+        self.id = uuid.uuid4().hex
+        self.prefixo = image_service.content_prefix(conteudo, image_type)
+        self.file_path = f"{self.prefixo}/full.jpg"
+        self.conteudo = conteudo
+        self.modelo = modelo
+        self.registro_id = registro_id
+        self.campo = campo
+        self.image_type = image_type
+        self.status = 'pendente'  # processando, enviando, gravando, concluido, substituido, erro
+        self.reaproveitada = False  # imagem já estava armazenada
+        self.larguras = None        # largura real de cada variante gerada
+        self.tentativas = 0
+        self.erro = None
+        self.criado_em = datetime.utcnow()
+        self.concluido_em = None
+
+    @property
+    def chave(self):
+        return (self.modelo.__name__, self.registro_id, self.campo)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'file_path': self.file_path,
+            'registro': f"{self.modelo.__name__}:{self.registro_id}",
+            'campo': self.campo,
+            'tentativas': self.tentativas,
+            'reaproveitada': self.reaproveitada,
+            'erro': self.erro,
+            'criado_em': self.criado_em.isoformat(),
+            'concluido_em': self.concluido_em.isoformat() if self.concluido_em else None,
+        }
+
+class ProcessadorImagens:
+    """Fila limitada de trabalhos de imagem com pool de processos"""
+
+    MAX_PENDENTES = 16
+    ESPERA_VAGA = 10.0       # segundos aguardando vaga com a fila cheia
+    TENTATIVAS = 3
+    ESPERA_RETENTATIVA = 2.0  # segundos antes da 2ª tentativa, dobrando a cada nova falha
+    TEMPO_PROCESSAMENTO = 60  # segundos para gerar as variantes de uma imagem
+    HISTORICO = 256           # trabalhos finalizados mantidos para status()
+
+    def __init__(self):
+        self.app = None
+        self.processos = int(os.environ.get('BTL_IMAGENS_PROCESSOS', 2))
+        self._lock = threading.Lock()
+        self._vagas = threading.BoundedSemaphore(self.MAX_PENDENTES)
+        self._trabalhos = OrderedDict()  # id -> TrabalhoImagem
+        self._ultimo = {}                # (modelo, id, campo) -> id do trabalho mais recente
+        self._threads = None
+        self._pool = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def enviar_arquivo(self, file, registro, campo, image_type='profile_picture'):
+        """Valida um arquivo enviado e agenda o processamento (mesmo formato de retorno de upload_image)"""
+        content, errors = image_service.read_image(file)
+        if errors:
+            return {'success': False, 'errors': errors}
+        return self.enviar(content, registro, campo, image_type)
+
+    def enviar(self, conteudo, registro, campo, image_type='profile_picture'):
+        """
+        Agenda o processamento dos bytes de uma imagem para registro.campo
+
+        O registro já precisa estar gravado (tem id). Retorna o caminho que a
+        imagem terá e o id do trabalho; a coluna é atualizada quando terminar.
+        """
+        if not self._vagas.acquire(timeout=self.ESPERA_VAGA):
+            return {'success': False, 'errors': ['Muitas imagens em processamento, tente novamente em instantes']}
+
+        trabalho = TrabalhoImagem(conteudo, type(registro), registro.id, campo, image_type)
+        with self._lock:
+            self._trabalhos[trabalho.id] = trabalho
+            self._ultimo[trabalho.chave] = trabalho.id
+            while len(self._trabalhos) > self.HISTORICO + self.MAX_PENDENTES:
+                self._trabalhos.popitem(last=False)
+        try:
+            self._executor().submit(self._executar, trabalho)
+        except Exception as e:
+            self._vagas.release()
+            self._finalizar(trabalho, 'erro', str(e))
+            return {'success': False, 'errors': [f"Upload failed: {str(e)}"]}
+
+        return {'success': True, 'job_id': trabalho.id, 'file_path': trabalho.file_path}
+
+    def status(self, trabalho_id=None):
+        """Situação de um trabalho (None se desconhecido) ou, sem id, o resumo da fila"""
+        with self._lock:
+            if trabalho_id is not None:
+                trabalho = self._trabalhos.get(trabalho_id)
+                return trabalho.to_dict() if trabalho else None
+            por_status = {}
+            for trabalho in self._trabalhos.values():
+                por_status[trabalho.status] = por_status.get(trabalho.status, 0) + 1
+        return {
+            'processos': self.processos,
+            'vagas': self.MAX_PENDENTES,
+            'trabalhos': por_status,
+        }
+
+    def _executor(self):
+        """Threads que conduzem os trabalhos (recriadas após fork, como o cliente MinIO)"""
+        pid = os.getpid()
+        with self._lock:
+            if self._threads is None or self._pid != pid:
+                self._threads = ThreadPoolExecutor(
+                    max_workers=max(self.processos, 1) + 2, thread_name_prefix='btl-imagens'
+                )
+                if self._pid != pid:
+                    self._pool = None
+                self._pid = pid
+            return self._threads
+
+    def _pool_processos(self, recriar=False):
+        with self._lock:
+            if self._pool is None or recriar:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False, cancel_futures=True)
+                # Criado no primeiro trabalho, não na importação do app (o app do backoffice
+                # é criado ao importar o módulo, inclusive por scripts e testes).
+                # fork: com spawn cada processo filho executaria de novo o app.py (python app.py);
+                # o filho só executa create_variants (Pillow), sem usar os locks das outras threads
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processos, mp_context=multiprocessing.get_context('fork')
+                )
+                self._pid = os.getpid()
+            return self._pool
+
+    def _executar(self, trabalho):
+        variantes = None
+        enviado = False
+        try:
+            for tentativa in range(1, self.TENTATIVAS + 1):
+                trabalho.tentativas = tentativa
+                try:
+                    if not enviado and variantes is None and image_service.is_stored(trabalho.file_path):
+                        # Mesmo conteúdo já armazenado: nada a processar nem enviar
+                        trabalho.reaproveitada = True
+                        enviado = True
+
+                    if not enviado:
+                        if variantes is None:
+                            trabalho.status = 'processando'
+                            variantes = self._gerar_variantes(trabalho)
+                            trabalho.larguras = image_service.variant_widths(variantes)
+                            trabalho.conteudo = None
+
+                        trabalho.status = 'enviando'
+                        image_service.store_variants(trabalho.prefixo, variantes)
+                        enviado = True
+
+                    trabalho.status = 'gravando'
+                    self._gravar(trabalho)
+                    return
+                except ImagemInvalida as e:
+                    self._finalizar(trabalho, 'erro', str(e))
+                    return
+                except ImagemRemovida as e:
+                    # A última referência foi liberada por outro registro no meio do caminho
+                    enviado = False
+                    trabalho.reaproveitada = False
+                    if tentativa == self.TENTATIVAS:
+                        self._finalizar(trabalho, 'erro', f"Imagem removida durante a gravação: {e}")
+                        return
+                    continue
+                except Exception as e:
+                    print(f"IMAGENS: trabalho {trabalho.id} falhou (tentativa {tentativa}): {e}")
+                    if tentativa == self.TENTATIVAS:
+                        self._descartar(trabalho)
+                        self._finalizar(trabalho, 'erro', str(e))
+                        return
+                    time.sleep(self.ESPERA_RETENTATIVA * 2 ** (tentativa - 1))
+        finally:
+            trabalho.conteudo = None
+            self._vagas.release()
+
+    def _gerar_variantes(self, trabalho):
+        try:
+            if self.processos <= 0:
+                return create_variants(trabalho.conteudo, trabalho.image_type)
+            futuro = self._pool_processos().submit(create_variants, trabalho.conteudo, trabalho.image_type)
+            return futuro.result(timeout=self.TEMPO_PROCESSAMENTO)
+        except BrokenProcessPool:
+            # Um processo morreu (ex.: falta de memória): o pool é recriado na retentativa
+            self._pool_processos(recriar=True)
+            raise
+        except Exception as e:
+            raise ImagemInvalida(str(e))
+
+    def _gravar(self, trabalho):
+        """Troca a imagem do registro pela nova, liberando a anterior"""
+        with self.app.app_context():
+            with self._lock:
+                substituido = self._ultimo.get(trabalho.chave) != trabalho.id
+            registro = None if substituido else db.session.get(trabalho.modelo, trabalho.registro_id)
+            if registro is None:
+                # Outra imagem foi enviada depois desta, ou o registro foi excluído
+                descartar_imagem(trabalho.file_path)
+                db.session.commit()
+                self._finalizar(trabalho, 'substituido')
+                return
+
+            anterior = getattr(registro, trabalho.campo)
+            if anterior == trabalho.file_path:
+                # A mesma imagem que o registro já usa
+                self._finalizar(trabalho, 'concluido')
+                return
+
+            adquirir_imagem(trabalho.file_path, trabalho.larguras)
+            setattr(registro, trabalho.campo, trabalho.file_path)
+            liberar_imagem(anterior)
+            backyard_ids = _registrar_alteracao(registro)
+            db.session.commit()
+            for backyard_id in backyard_ids:
+                race_states.invalidar(backyard_id)
+
+        self._finalizar(trabalho, 'concluido')
+
+    def _descartar(self, trabalho):
+        """Remove os objetos enviados por um trabalho que falhou, se nenhum registro os usa"""
+        try:
+            with self.app.app_context():
+                descartar_imagem(trabalho.file_path)
+                db.session.commit()
+        except Exception as e:
+            print(f"IMAGENS: erro ao descartar {trabalho.file_path}: {e}")
+
+    def _finalizar(self, trabalho, status, erro=None):
+        trabalho.status = status
+        trabalho.erro = erro
+        trabalho.concluido_em = datetime.utcnow()
+        with self._lock:
+            if self._ultimo.get(trabalho.chave) == trabalho.id:
+                del self._ultimo[trabalho.chave]
+
+def adquirir_imagem(file_path, larguras=None):
+    """Registra mais um uso da imagem (na transação corrente, sem commit)
+
+    larguras ({tamanho: largura} das variantes geradas) é gravado para o srcset
+    quando a imagem ainda não tem as larguras registradas.
+    """
+    prefixo = file_path.rsplit('/', 1)[0]
+    imagem = _bloquear(prefixo)
+    if not image_service.is_stored(file_path):
+        raise ImagemRemovida(file_path)
+    if imagem is None:
+        imagem = ImagemArmazenada(prefixo=prefixo, referencias=1)
+        db.session.add(imagem)
+    else:
+        imagem.referencias += 1
+    if larguras and not imagem.larguras:
+        imagem.larguras = image_service.encode_widths(larguras)
+        image_service.remember_widths(prefixo, larguras)
+
+def liberar_imagem(file_path):
+    """
+    Libera um uso da imagem (na transação corrente, sem commit)
+
+    Na última referência a linha fica com zero referências e os objetos são
+    removidos só depois do commit (_remover_liberadas). Se o commit falha nada
+    é removido; se a remoção falha sobram objetos órfãos, nunca um registro
+    apontando para uma imagem apagada. Imagens gravadas antes da contagem de
+    referências (nome com uuid, sem linha em imagens_armazenadas) pertencem a
+    um único registro e também são removidas após o commit.
+    """
+    if not file_path:
+        return
+    imagem = _bloquear(file_path.rsplit('/', 1)[0])
+    if imagem is not None:
+        imagem.referencias -= 1
+        if imagem.referencias > 0:
+            return
+    _remover_apos_commit(file_path)
+
+def descartar_imagem(file_path):
+    """Remove, após o commit, objetos gravados que nenhum registro chegou a usar"""
+    imagem = _bloquear(file_path.rsplit('/', 1)[0])
+    if imagem is None or imagem.referencias <= 0:
+        _remover_apos_commit(file_path)
+
+def _bloquear(prefixo, sessao=None):
+    """Linha da imagem com bloqueio até o fim da transação (None se não existe)"""
+    sessao = sessao or db.session
+    return sessao.query(ImagemArmazenada).filter_by(prefixo=prefixo).with_for_update().first()
+
+def _remover_apos_commit(file_path):
+    """Marca os objetos da imagem para remoção quando a transação corrente for confirmada"""
+    db.session.info.setdefault('btl_imagens_liberadas', set()).add(file_path)
+
+@event.listens_for(Session, 'after_commit')
+def _remover_liberadas(session):
+    """
+    Remove as imagens liberadas pela transação que acabou de ser confirmada
+
+    Cada imagem é conferida de novo em uma transação própria, com a linha
+    bloqueada: se alguém a adquiriu depois do commit ela fica. Quem tentar
+    adquiri-la durante a remoção espera o bloqueio, não encontra mais os
+    objetos e envia a imagem de novo (ImagemRemovida).
+    """
+    liberadas = session.info.pop('btl_imagens_liberadas', None)
+    if not liberadas:
+        return
+    with Session(session.get_bind()) as sessao:
+        for file_path in liberadas:
+            try:
+                imagem = _bloquear(file_path.rsplit('/', 1)[0], sessao)
+                if imagem is not None:
+                    if imagem.referencias > 0:
+                        sessao.rollback()
+                        continue
+                    sessao.delete(imagem)
+                if image_service.delete_image(file_path):
+                    sessao.commit()
+                else:
+                    sessao.rollback()  # a linha com zero referências fica como registro do órfão
+            except Exception as e:
+                sessao.rollback()
+                print(f"IMAGENS: erro ao remover {file_path}: {e}")
+
+@event.listens_for(Session, 'after_rollback')
+def _manter_liberadas(session):
+    """Transação desfeita: as imagens continuam em uso"""
+    session.info.pop('btl_imagens_liberadas', None)
+
+def _registrar_alteracao(registro):
+    """Incrementa versao_dados das backyards que exibem a imagem (páginas ao vivo e caches)"""
+    if isinstance(registro, Backyard):
+        backyard_ids = [registro.id]
+    else:
+        backyard_ids = [backyard_id for (backyard_id,) in db.session.query(
+            AtletaBackyard.backyard_id
+        ).filter(AtletaBackyard.atleta_id == registro.id)]
+    for backyard_id in backyard_ids:
+        Backyard.registrar_alteracao(backyard_id)
+    return backyard_ids
+
+# Instância global do processador de imagens
+processamento_imagens = ProcessadorImagens()
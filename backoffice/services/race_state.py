@@ -0,0 +1,370 @@
+"""
+Estado em memória das corridas (RaceState)
+
+Mantém, por backyard, o retrato usado pelas páginas de acompanhamento: loop
+corrente, contagens por status, números de peito e histórico de loops. As
+leituras são servidas da memória; o contador Backyard.versao_dados indica
+quando o retrato precisa ser reconstruído a partir do banco.
+
+Um RaceState publicado no cache nunca é alterado: páginas e snapshots
+percorrem corredores/eliminados sem lock enquanto outra thread registra
+chegadas. aplicar() altera uma cópia (dicionários novos, corredores e loop
+alterados copiados) e troca o estado do cache por ela.
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+from models import db, Backyard, Loop, AtletaLoop, Atleta, AtletaBackyard, LoopStatus, AtletaLoopStatus
+from services.estatisticas import STATUS_ELIMINACAO, ContagemLoop, estatisticas_loops
+
+# Prioridade de ordenação na tela de controle: ativos, concluídos, eliminados
+PRIORIDADE_STATUS = {
+    AtletaLoopStatus.ATIVO: 1,
+    AtletaLoopStatus.CONCLUIDO: 2,
+    AtletaLoopStatus.ELIMINADO: 3,
+    AtletaLoopStatus.DNF: 3,
+    AtletaLoopStatus.DNS: 3
+}
+
+# Campos de AtletaLoop que as telas de acompanhamento exibem
+CAMPOS_CORREDOR = ('status', 'tempo_inicio', 'tempo_fim', 'tempo_total_segundos', 'observacoes')
+
+class BackyardResumo:
+    """Dados da backyard exibidos nas páginas de acompanhamento"""
+
+    def __init__(self, backyard):
+        self.id = backyard.id
+        self.nome = backyard.nome
+        self.organizador = backyard.organizador
+        self.status = backyard.status
+        self.cidade = backyard.cidade
+        self.estado = backyard.estado
+        self.pais = backyard.pais
+        self.data_evento = backyard.data_evento
+        self.capacidade = backyard.capacidade
+        self.profile_picture_path = backyard.profile_picture_path
+        self.logo_path = backyard.logo_path
+
+class LoopResumo:
+    """Loop com totais de participantes (ContagemLoop), usado no histórico"""
+
+    def __init__(self, loop, contagem=None):
+        self.id = loop.id
+        self.numero_loop = loop.numero_loop
+        self.status = loop.status
+        self.data_inicio = loop.data_inicio
+        self.data_fim = loop.data_fim
+        self.tempo_limite = loop.tempo_limite
+        self.distancia_km = loop.distancia_km
+        self.contagem = contagem or ContagemLoop()
+
+    @property
+    def total_atletas(self):
+        return self.contagem.total
+
+    @property
+    def total_concluidos(self):
+        return self.contagem.concluidos
+
+class Corredor:
+    """Participação de um atleta em um loop (AtletaLoop + Atleta + número de peito)"""
+
+    def __init__(self, atleta_loop, atleta, numero_peito, numero_loop):
+        self.id = atleta_loop.id
+        self.atleta_id = atleta_loop.atleta_id
+        self.loop_id = atleta_loop.loop_id
+        self.numero_loop = numero_loop
+        self.nome = atleta.nome
+        self.cidade = atleta.cidade
+        self.imagem_perfil = atleta.imagem_perfil
+        self.numero_peito = numero_peito
+        for campo in CAMPOS_CORREDOR:
+            setattr(self, campo, getattr(atleta_loop, campo))
+
+    def get_tempo_formatado(self):
+        """Retorna o tempo formatado em MM:SS"""
+        if not self.tempo_total_segundos:
+            return "-"
+
+        minutos = self.tempo_total_segundos // 60
+        segundos = self.tempo_total_segundos % 60
+        return f"{minutos:02d}:{segundos:02d}"
+
+class RaceState:
+    """Retrato em memória de uma backyard e do seu loop corrente"""
+
+    def __init__(self, backyard, versao):
+        self.backyard = backyard
+        self.versao = versao
+        self.loops = []                 # LoopResumo, em ordem crescente de número
+        self.corredores = OrderedDict() # atleta_loop_id -> Corredor do loop corrente
+        self.eliminados = OrderedDict() # atleta_loop_id -> Corredor eliminado (todos os loops)
+        self.numeros_peito = {}         # atleta_id -> número de peito
+        self.total_inscritos = 0
+        self.inscricoes_com_numero = 0
+        self.contagens = dict((status, 0) for status in AtletaLoopStatus)
+        self.validado_em = time.monotonic()
+
+    @classmethod
+    def carregar(cls, backyard_id):
+        """Reconstrói o estado a partir do banco; retorna None se a backyard não existe"""
+        backyard = db.session.get(Backyard, backyard_id)
+        if backyard is None:
+            return None
+
+        estado = cls(BackyardResumo(backyard), backyard.versao_dados)
+
+        # Inscrições e números de peito
+        for atleta_id, numero_peito in db.session.query(
+            AtletaBackyard.atleta_id, AtletaBackyard.numero_peito
+        ).filter(AtletaBackyard.backyard_id == backyard_id):
+            estado.total_inscritos += 1
+            if numero_peito is not None:
+                estado.numeros_peito[atleta_id] = numero_peito
+                estado.inscricoes_com_numero += 1
+
+        # Histórico de loops com totais em uma única consulta agregada
+        estado.loops = [LoopResumo(loop, contagem) for loop, contagem in estatisticas_loops(backyard_id)]
+
+        loop_corrente = estado.loop_corrente
+        if loop_corrente:
+            for atleta_loop, atleta in db.session.query(AtletaLoop, Atleta).join(
+                Atleta, AtletaLoop.atleta_id == Atleta.id
+            ).filter(AtletaLoop.loop_id == loop_corrente.id):
+                corredor = Corredor(atleta_loop, atleta, estado.numeros_peito.get(atleta.id),
+                                    loop_corrente.numero_loop)
+                estado.corredores[corredor.id] = corredor
+                estado.contagens[corredor.status] += 1
+
+        # Eliminados de todos os loops (reaproveita os objetos do loop corrente)
+        numeros_loop = dict((loop.id, loop.numero_loop) for loop in estado.loops)
+        for atleta_loop, atleta in db.session.query(AtletaLoop, Atleta).join(
+            Atleta, AtletaLoop.atleta_id == Atleta.id
+        ).join(Loop, AtletaLoop.loop_id == Loop.id).filter(
+            Loop.backyard_id == backyard_id,
+            AtletaLoop.status.in_(STATUS_ELIMINACAO)
+        ).order_by(Loop.numero_loop, AtletaLoop.id):
+            corredor = estado.corredores.get(atleta_loop.id) or Corredor(
+                atleta_loop, atleta, estado.numeros_peito.get(atleta.id),
+                numeros_loop.get(atleta_loop.loop_id)
+            )
+            estado.eliminados[corredor.id] = corredor
+
+        return estado
+
+    @property
+    def loop_atual(self):
+        """Último loop ativo ou em preparação (None se não houver)"""
+        for loop in reversed(self.loops):
+            if loop.status in (LoopStatus.ATIVO, LoopStatus.PREPARACAO):
+                return loop
+        return None
+
+    @property
+    def loop_corrente(self):
+        """Loop exibido na tela de controle: o atual ou, na falta dele, o último"""
+        return self.loop_atual or (self.loops[-1] if self.loops else None)
+
+    @property
+    def total_eliminados_loop(self):
+        """Eliminados (ELIMINADO, DNF, DNS) no loop corrente"""
+        return sum(self.contagens[status] for status in STATUS_ELIMINACAO)
+
+    def estatisticas(self):
+        """Contadores exibidos na página ao vivo"""
+        loop = self.loop_atual
+        return {
+            'total_inscritos': self.total_inscritos,
+            'atletas_ativos': self.contagens[AtletaLoopStatus.ATIVO] if loop else 0,
+            'atletas_concluidos': self.contagens[AtletaLoopStatus.CONCLUIDO] if loop else 0,
+            'atletas_eliminados': len(self.eliminados),
+            'loop_atual': loop.numero_loop if loop else 0,
+            'total_loops': len(self.loops)
+        }
+
+    def para_dict(self):
+        """Representação JSON do estado (snapshot da página ao vivo)"""
+        loop = self.loop_atual
+        return {
+            'versao': self.versao,
+            'backyard': {
+                'id': self.backyard.id,
+                'nome': self.backyard.nome,
+                'status': self.backyard.status.value
+            },
+            'loop_atual': _loop_para_dict(loop) if loop else None,
+            'stats': self.estatisticas(),
+            'corredores': [_corredor_para_dict(c) for c in self.corredores.values()] if loop else [],
+            'eliminados': [_corredor_para_dict(c) for c in self.eliminados.values()],
+            'loops': [_loop_para_dict(l) for l in self.loops]
+        }
+
+    def corredores_ordenados(self):
+        """Corredores do loop corrente: ativos, depois concluídos, depois eliminados"""
+        return sorted(self.corredores.values(), key=lambda corredor: (
+            PRIORIDADE_STATUS.get(corredor.status, 4),
+            corredor.tempo_total_segundos if corredor.tempo_total_segundos else 999999,
+            corredor.nome
+        ))
+
+    def copiar(self):
+        """Cópia para alteração: dicionários e listas novos, com os mesmos corredores e loops"""
+        copia = copy.copy(self)
+        copia.loops = list(self.loops)
+        copia.corredores = OrderedDict(self.corredores)
+        copia.eliminados = OrderedDict(self.eliminados)
+        copia.contagens = dict(self.contagens)
+        return copia
+
+    def atualizar_corredor(self, atleta_loop_id, campos):
+        """Aplica a alteração de um AtletaLoop do loop corrente (em um estado obtido com copiar())
+
+        O corredor e o loop alterados são substituídos por cópias, então
+        estados anteriores continuam inalterados. Retorna False se o atleta não
+        pertence ao loop corrente (o estado precisa ser reconstruído).
+        """
+        corredor = self.corredores.get(atleta_loop_id)
+        if corredor is None:
+            return False
+
+        status_anterior = corredor.status
+        corredor = copy.copy(corredor)
+        for campo, valor in campos.items():
+            setattr(corredor, campo, valor)
+        self.corredores[corredor.id] = corredor
+        if corredor.id in self.eliminados:
+            self.eliminados[corredor.id] = corredor
+
+        if corredor.status != status_anterior:
+            self.contagens[status_anterior] -= 1
+            self.contagens[corredor.status] += 1
+
+            indice = self.loops.index(self.loop_corrente)
+            loop = copy.copy(self.loops[indice])
+            loop.contagem = copy.copy(loop.contagem)
+            loop.contagem.registrar_mudanca(status_anterior, corredor.status)
+            self.loops[indice] = loop
+
+            if corredor.status in STATUS_ELIMINACAO:
+                self.eliminados[corredor.id] = corredor
+            else:
+                self.eliminados.pop(corredor.id, None)
+        return True
+
+def _isoformat(valor):
+    return valor.isoformat() if valor else None
+
+def _loop_para_dict(loop):
+    return {
+        'id': loop.id,
+        'numero_loop': loop.numero_loop,
+        'status': loop.status.value,
+        'data_inicio': _isoformat(loop.data_inicio),
+        'data_fim': _isoformat(loop.data_fim),
+        'tempo_limite': loop.tempo_limite,
+        'distancia_km': loop.distancia_km,
+        'total_atletas': loop.total_atletas,
+        'total_concluidos': loop.total_concluidos
+    }
+
+def _corredor_para_dict(corredor):
+    return {
+        'id': corredor.id,
+        'atleta_id': corredor.atleta_id,
+        'numero_peito': corredor.numero_peito,
+        'nome': corredor.nome,
+        'numero_loop': corredor.numero_loop,
+        'status': corredor.status.value,
+        'tempo_inicio': _isoformat(corredor.tempo_inicio),
+        'tempo_fim': _isoformat(corredor.tempo_fim),
+        'tempo_total_segundos': corredor.tempo_total_segundos,
+        'tempo_formatado': corredor.get_tempo_formatado(),
+        'observacoes': corredor.observacoes
+    }
+
+class RaceStateCache:
+    """Cache de RaceState por backyard, compartilhado pelas requisições do processo
+
+    Dentro de TTL_VALIDACAO segundos após a última validação o estado é servido
+    sem nenhuma consulta; depois disso uma única leitura de versao_dados decide
+    se o estado em memória ainda vale ou precisa ser reconstruído.
+    """
+
+    TTL_VALIDACAO = 2.0
+    MAX_BACKYARDS = 64
+
+    def __init__(self):
+        self._estados = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, backyard_id):
+        """Retorna o RaceState da backyard (None se ela não existe)"""
+        with self._lock:
+            estado = self._estados.get(backyard_id)
+            if estado and time.monotonic() - estado.validado_em < self.TTL_VALIDACAO:
+                self._estados.move_to_end(backyard_id)
+                return estado
+
+        versao = db.session.query(Backyard.versao_dados).filter(Backyard.id == backyard_id).scalar()
+        if versao is None:
+            self.invalidar(backyard_id)
+            return None
+
+        if estado and estado.versao == versao:
+            estado.validado_em = time.monotonic()
+            return estado
+
+        estado = RaceState.carregar(backyard_id)
+        if estado is None:
+            return None
+
+        with self._lock:
+            self._estados[backyard_id] = estado
+            self._estados.move_to_end(backyard_id)
+            while len(self._estados) > self.MAX_BACKYARDS:
+                self._estados.popitem(last=False)
+        return estado
+
+    def invalidar(self, backyard_id):
+        """Descarta o estado em memória (alterações estruturais: novo loop, fim de evento)"""
+        with self._lock:
+            self._estados.pop(backyard_id, None)
+
+    @staticmethod
+    def capturar(atleta_loops):
+        """Copia os campos exibidos de cada AtletaLoop antes do commit (que os expira)"""
+        return [
+            (atleta_loop.id, dict((campo, getattr(atleta_loop, campo)) for campo in CAMPOS_CORREDOR))
+            for atleta_loop in atleta_loops
+        ]
+
+    def aplicar(self, backyard_id, alteracoes, versao):
+        """Aplica alterações já gravadas; versao é o versao_dados após o incremento
+
+        Só aplica sobre o estado da versão imediatamente anterior. Se o estado já
+        foi reconstruído depois do commit (já contém a alteração) ou se outra
+        escrita entrou no meio, ele é descartado e recarregado na próxima leitura.
+        """
+        with self._lock:
+            estado = self._estados.get(backyard_id)
+            if estado is None:
+                return
+
+            if estado.versao != versao - 1:
+                del self._estados[backyard_id]
+                return
+
+            # Leitores do estado atual não veem a alteração pela metade
+            novo = estado.copiar()
+            for atleta_loop_id, campos in alteracoes:
+                if not novo.atualizar_corredor(atleta_loop_id, campos):
+                    del self._estados[backyard_id]
+                    return
+
+            novo.versao = versao
+            self._estados[backyard_id] = novo
+
+# Instância global do cache
+race_states = RaceStateCache()
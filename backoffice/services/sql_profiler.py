@@ -0,0 +1,149 @@
+"""
+Perfil de SQL por requisição (opcional)
+
+Ativado com BTL_SQL_PROFILER=true. Conta os comandos e o tempo de banco de
+cada requisição através dos eventos de cursor do SQLAlchemy, registra os
+comandos lentos e aponta padrões N+1 (o mesmo comando normalizado executado
+muitas vezes na mesma requisição). O resultado vai no cabeçalho
+Server-Timing e fica guardado para a página de depuração.
+
+Configuração (variáveis de ambiente):
+    BTL_SQL_PROFILER        true/false (padrão false)
+    BTL_SQL_LENTO_MS        comando lento a partir de N ms (padrão 100)
+    BTL_SQL_N1_LIMITE       mesmo comando mais de N vezes = N+1 (padrão 10)
+    BTL_SQL_HISTORICO       requisições guardadas para a página (padrão 200)
+"""
+
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Literais e listas de parâmetros não distinguem um comando do outro
+_LITERAIS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+def normalizar(statement):
+    """Forma canônica de um comando SQL, usada para agrupar repetições"""
+    for padrao, substituto in _LITERAIS:
+        statement = padrao.sub(substituto, statement)
+    return statement.strip()
+
+class PerfilRequisicao:
+    """Comandos executados durante uma requisição"""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.consultas = 0
+        self.tempo_db = 0.0
+        self.repeticoes = Counter()
+        self.lentas = []
+
+    def registrar(self, statement, duracao, limite_lento):
+        self.consultas += 1
+        self.tempo_db += duracao
+        self.repeticoes[normalizar(statement)] += 1
+        if duracao >= limite_lento:
+            self.lentas.append((duracao * 1000, statement))
+
+class SqlProfiler:
+    """Middleware de perfil de SQL para uma aplicação Flask"""
+
+    def __init__(self):
+        self.ativo = False
+        self.limite_lento = 0.1
+        self.limite_n1 = 10
+        self._lock = threading.Lock()
+        self.historico = deque(maxlen=200)
+
+    def init_app(self, app):
+        """Registra os hooks da requisição e os eventos do SQLAlchemy, se ativado"""
+        self.ativo = os.environ.get('BTL_SQL_PROFILER', 'false').lower() == 'true'
+        if not self.ativo:
+            return
+
+        self.limite_lento = int(os.environ.get('BTL_SQL_LENTO_MS', '100')) / 1000.0
+        self.limite_n1 = int(os.environ.get('BTL_SQL_N1_LIMITE', '10'))
+        self.historico = deque(maxlen=int(os.environ.get('BTL_SQL_HISTORICO', '200')))
+
+        # Em todas as engines: comandos fora de uma requisição (scheduler, SSE) são ignorados
+        if not event.contains(Engine, 'before_cursor_execute', _antes_do_comando):
+            event.listen(Engine, 'before_cursor_execute', _antes_do_comando)
+            event.listen(Engine, 'after_cursor_execute', _depois_do_comando)
+
+        app.before_request(self._iniciar)
+        app.after_request(self._finalizar)
+        print(f"Perfil de SQL ativado (lento >= {self.limite_lento * 1000:.0f} ms, N+1 > {self.limite_n1} repetições)")
+
+    def _iniciar(self):
+        g._perfil_sql = PerfilRequisicao()
+
+    def _finalizar(self, response):
+        perfil = g.pop('_perfil_sql', None)
+        if perfil is None or request.endpoint in ('static', None):
+            return response
+
+        tempo_total = time.perf_counter() - perfil.inicio
+        n_mais_1 = [(statement, vezes) for statement, vezes in perfil.repeticoes.most_common()
+                    if vezes > self.limite_n1]
+
+        for duracao_ms, statement in perfil.lentas:
+            statement = ' '.join(statement.split())
+            print(f"SQL lento ({duracao_ms:.1f} ms) em {request.method} {request.path}: {statement[:300]}")
+        for statement, vezes in n_mais_1:
+            print(f"AVISO N+1 em {request.method} {request.path}: {vezes}x {statement[:300]}")
+
+        response.headers.add('Server-Timing', (
+            f'db;dur={perfil.tempo_db * 1000:.1f};desc="{perfil.consultas} queries", '
+            f'app;dur={tempo_total * 1000:.1f}'
+        ))
+
+        with self._lock:
+            self.historico.appendleft({
+                'quando': datetime.now(),
+                'metodo': request.method,
+                'caminho': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'consultas': perfil.consultas,
+                'tempo_db_ms': perfil.tempo_db * 1000,
+                'tempo_total_ms': tempo_total * 1000,
+                'lentas': perfil.lentas,
+                'n_mais_1': n_mais_1
+            })
+        return response
+
+    def requisicoes(self):
+        """Requisições recentes, da mais nova para a mais antiga"""
+        with self._lock:
+            return list(self.historico)
+
+    def limpar(self):
+        with self._lock:
+            self.historico.clear()
+
+def _antes_do_comando(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_perfil_sql' in g:
+        conn.info.setdefault('_perfil_sql_inicio', []).append(time.perf_counter())
+
+def _depois_do_comando(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get('_perfil_sql_inicio')
+    if not inicios or not has_request_context():
+        return
+    perfil = g.get('_perfil_sql')
+    duracao = time.perf_counter() - inicios.pop()
+    if perfil is not None:
+        perfil.registrar(statement, duracao, sql_profiler.limite_lento)
+
+# Instância global do profiler
+sql_profiler = SqlProfiler()
@@ -3,23 +3,28 @@ from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 from models import db, Atleta, Backyard, AtletaBackyard
-from services.image_service import ImageService
+from services.image_service import image_service
+from services.processamento_imagens import processamento_imagens, liberar_imagem
 from services.password_service import PasswordService
-from sqlalchemy import func, or_
+from services.race_state import race_states
+from services.contadores import contadores
+from services.busca import busca_atletas
+from services.paginacao import paginar
+from services.autorizacao import principal_atual
+from sqlalchemy import func
 import os
+import base64
 
 # Create blueprint
 atletas_bp = Blueprint('atletas', __name__)
 
-# Initialize image service
-image_service = ImageService()
-
 def admin_required(f):
     """Decorator to require admin access"""
     from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome != 'Admin':
+        principal = principal_atual()
+        if principal is None or not principal.is_admin:
             flash('Access denied. Admin privileges required.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -30,7 +35,8 @@ def organizador_or_admin_required(f):
     from functools import wraps
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome not in ['Admin', 'Organizador']:
+        principal = principal_atual()
+        if principal is None or not (principal.is_admin or principal.is_organizador):
             flash('Access denied. Insufficient privileges.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -40,53 +46,56 @@ def organizador_or_admin_required(f):
 @login_required
 @organizador_or_admin_required
 def list():
-    """List all atletas with search, pagination and backyard count"""
+    """List all atletas with search, keyset pagination and backyard count"""
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
     search = request.args.get('search', '', type=str)
     
-    # Base query with backyard count
-    query = db.session.query(
-        Atleta,
-        func.count(AtletaBackyard.id).label('total_backyards')
-    ).outerjoin(AtletaBackyard).group_by(Atleta.id)
+    query_total, query, chaves = consulta_listagem(principal_atual(), search)
+    
+    # Total is cached per user and search instead of recounted on every page
+    total = contadores.total_listagem(('atletas', current_user.id, search), query_total)
+    
+    atletas = paginar(
+        query, chaves, per_page, page=page, total=total,
+        apos=request.args.get('apos'), antes=request.args.get('antes')
+    )
+    
+    return render_template('atletas/list.html', 
+                         atletas=atletas, 
+                         search=search, 
+                         per_page=per_page)
+
+def consulta_listagem(principal, search=''):
+    """
+    Queries of the athlete list -> (count query, page query, keyset keys)
+
+    Also used by explain_consultas.py, so the EXPLAIN harness checks the
+    queries this view actually runs.
+    """
+    # Base query: filters only, no join (backyard count is computed for the page rows only)
+    query = db.session.query(Atleta)
     
     # Apply search filter if provided
     if search:
-        search_filter = or_(
-            Atleta.nome.ilike(f'%{search}%'),
-            Atleta.email.ilike(f'%{search}%'),
-            Atleta.cpf.ilike(f'%{search}%'),
-            Atleta.cidade.ilike(f'%{search}%'),
-            Atleta.estado.ilike(f'%{search}%')
-        )
-        query = query.filter(search_filter)
+        query = query.filter(busca_atletas.filtro(search))
     
     # Apply user role permissions
-    if current_user.profile.nome == 'Admin':
-        # Admin can see all atletas
-        pass
-    else:
+    if not principal.is_admin:
         # Organizador can see atletas inscribed in their backyards
-        user_orgs = [org.id for org in current_user.organizacoes]
         atletas_ids = db.session.query(AtletaBackyard.atleta_id).join(Backyard).filter(
-            Backyard.organizador.in_(user_orgs)
+            principal.filtro_organizacao(Backyard.organizador)
         ).distinct().subquery()
         
         query = query.filter(Atleta.id.in_(atletas_ids))
     
-    # Order by creation date (newest first)
-    query = query.order_by(Atleta.criado_em.desc())
+    total_backyards = db.session.query(func.count(AtletaBackyard.id)).filter(
+        AtletaBackyard.atleta_id == Atleta.id
+    ).correlate(Atleta).scalar_subquery().label('total_backyards')
     
-    # Paginate results
-    atletas = query.paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    
-    return render_template('atletas/list.html', 
-                         atletas=atletas, 
-                         search=search, 
-                         per_page=per_page)
+    # Newest first, keyset on (criado_em, id)
+    chaves = [(Atleta.criado_em, True), (Atleta.id, True)]
+    return query.with_entities(func.count(Atleta.id)), query.add_columns(total_backyards), chaves
 
 @atletas_bp.route('/create', methods=['GET', 'POST'])
 @login_required
@@ -129,43 +138,8 @@ def create():
                     flash(f'Erro na senha: {error}', 'danger')
                 return render_template('atletas/create.html')
             
-            # Handle image upload
-            imagem_perfil = None
-            
-            # Check if we have a cropped image (base64 data)
-            cropped_image = request.form.get('cropped_image')
-            if cropped_image and cropped_image.startswith('data:image/'):
-                try:
-                    # Process base64 cropped image
-                    import base64
-                    
-                    # Extract base64 data
-                    header, data = cropped_image.split(',', 1)
-                    image_data = base64.b64decode(data)
-                    
-                    # Upload the cropped image data directly
-                    upload_result = image_service.upload_image_data(image_data, 'cropped_profile.jpg', 'profile_picture', 'atletas')
-                    
-                    if upload_result.get('success'):
-                        imagem_perfil = upload_result['file_path']
-                    else:
-                        flash(f'Erro no upload da imagem cortada: {", ".join(upload_result.get("errors", ["Erro desconhecido"]))}', 'warning')
-                        
-                except Exception as e:
-                    flash(f'Erro ao processar imagem cortada: {str(e)}', 'warning')
-                    
-            # Fallback to regular file upload if no cropped image
-            elif 'imagem_perfil' in request.files:
-                file = request.files['imagem_perfil']
-                if file and file.filename != '':
-                    try:
-                        upload_result = image_service.upload_image(file, 'profile_picture', 'atletas')
-                        if upload_result.get('success'):
-                            imagem_perfil = upload_result['file_path']
-                        else:
-                            flash(f'Erro no upload da imagem: {", ".join(upload_result.get("errors", ["Erro desconhecido"]))}', 'warning')
-                    except Exception as e:
-                        flash(f'Erro no upload da imagem: {str(e)}', 'warning')
+            # Read the picture now; it is processed in background once the atleta exists
+            imagem = _ler_imagem_enviada()
             
             # Parse date
             data_nascimento_obj = None
@@ -184,7 +158,6 @@ def create():
                 password=generate_password_hash(password),
                 data_nascimento=data_nascimento_obj,
                 sexo=sexo if sexo else None,
-                imagem_perfil=imagem_perfil,
                 endereco=endereco,
                 cidade=cidade,
                 estado=estado,
@@ -193,6 +166,8 @@ def create():
             
             db.session.add(atleta)
             db.session.commit()
+            contadores.invalidar()
+            _enviar_imagem(atleta, imagem)
             
             flash('Atleta criado com sucesso!', 'success')
             return redirect(url_for('atletas.list'))
@@ -211,12 +186,11 @@ def view(id):
     atleta = Atleta.query.get_or_404(id)
     
     # Check if user can view this atleta
-    if current_user.profile.nome != 'Admin':
+    if not principal_atual().is_admin:
         # Organizador can only view atletas inscribed in their backyards
-        user_orgs = [org.id for org in current_user.organizacoes]
         atleta_in_orgs = db.session.query(AtletaBackyard).join(Backyard).filter(
             AtletaBackyard.atleta_id == id,
-            Backyard.organizador.in_(user_orgs)
+            principal_atual().filtro_organizacao(Backyard.organizador)
         ).first()
         
         if not atleta_in_orgs:
@@ -266,49 +240,8 @@ def edit(id):
                 flash('CPF já cadastrado por outro atleta.', 'danger')
                 return render_template('atletas/edit.html', atleta=atleta)
             
-            # Handle image upload
-            # Check if we have a cropped image (base64 data)
-            cropped_image = request.form.get('cropped_image')
-            if cropped_image and cropped_image.startswith('data:image/'):
-                try:
-                    # Process base64 cropped image
-                    import base64
-                    
-                    # Extract base64 data
-                    header, data = cropped_image.split(',', 1)
-                    image_data = base64.b64decode(data)
-                    
-                    # Upload the cropped image data directly
-                    upload_result = image_service.upload_image_data(image_data, 'cropped_profile.jpg', 'profile_picture', 'atletas')
-                    
-                    if upload_result.get('success'):
-                        # Delete old image if exists
-                        if atleta.imagem_perfil:
-                            image_service.delete_image(atleta.imagem_perfil)
-                        
-                        atleta.imagem_perfil = upload_result['file_path']
-                    else:
-                        flash(f'Erro no upload da imagem cortada: {", ".join(upload_result.get("errors", ["Erro desconhecido"]))}', 'warning')
-                        
-                except Exception as e:
-                    flash(f'Erro ao processar imagem cortada: {str(e)}', 'warning')
-                    
-            # Fallback to regular file upload if no cropped image
-            elif 'imagem_perfil' in request.files:
-                file = request.files['imagem_perfil']
-                if file and file.filename != '':
-                    try:
-                        upload_result = image_service.upload_image(file, 'profile_picture', 'atletas')
-                        if upload_result.get('success'):
-                            # Delete old image if exists
-                            if atleta.imagem_perfil:
-                                image_service.delete_image(atleta.imagem_perfil)
-                            
-                            atleta.imagem_perfil = upload_result['file_path']
-                        else:
-                            flash(f'Erro no upload da imagem: {", ".join(upload_result.get("errors", ["Erro desconhecido"]))}', 'warning')
-                    except Exception as e:
-                        flash(f'Erro no upload da imagem: {str(e)}', 'warning')
+            # Handle image upload (processed in background after the commit)
+            imagem = _ler_imagem_enviada()
             
             # Parse date
             data_nascimento_obj = None
@@ -335,7 +268,14 @@ def edit(id):
             atleta.estado = estado
             atleta.pais = pais
             
+            # Live pages show the athlete's name, city and picture
+            backyard_ids = _registrar_alteracao_backyards(id)
             db.session.commit()
+            for backyard_id in backyard_ids:
+                race_states.invalidar(backyard_id)
+            
+            # The old picture is replaced once the new one is processed
+            _enviar_imagem(atleta, imagem)
             flash('Atleta atualizado com sucesso!', 'success')
             return redirect(url_for('atletas.view', id=id))
             
@@ -353,18 +293,22 @@ def delete(id):
     try:
         atleta = Atleta.query.get_or_404(id)
         
-        # Delete image if exists
+        # Release image (removed from storage if no other record uses it)
         if atleta.imagem_perfil:
             try:
-                image_service.delete_image(atleta.imagem_perfil)
+                liberar_imagem(atleta.imagem_perfil)
             except:
                 pass  # Continue even if image deletion fails
         
         # Delete related inscriptions first
+        backyard_ids = _registrar_alteracao_backyards(id)
         AtletaBackyard.query.filter_by(atleta_id=id).delete()
         
         db.session.delete(atleta)
         db.session.commit()
+        contadores.invalidar()
+        for backyard_id in backyard_ids:
+            race_states.invalidar(backyard_id)
         
         flash('Atleta excluído com sucesso!', 'success')
     except Exception as e:
@@ -381,12 +325,11 @@ def inscricoes(id):
     atleta = Atleta.query.get_or_404(id)
     
     # Check if user can manage this atleta
-    if current_user.profile.nome != 'Admin':
+    if not principal_atual().is_admin:
         # Organizador can only manage atletas inscribed in their backyards
-        user_orgs = [org.id for org in current_user.organizacoes]
         atleta_in_orgs = db.session.query(AtletaBackyard).join(Backyard).filter(
             AtletaBackyard.atleta_id == id,
-            Backyard.organizador.in_(user_orgs)
+            principal_atual().filtro_organizacao(Backyard.organizador)
         ).first()
         
         if not atleta_in_orgs:
@@ -394,11 +337,10 @@ def inscricoes(id):
             return redirect(url_for('atletas.list'))
     
     # Get available backyards for inscription
-    if current_user.profile.nome == 'Admin':
+    if principal_atual().is_admin:
         available_backyards = Backyard.query.all()
     else:
-        user_orgs = [org.id for org in current_user.organizacoes]
-        available_backyards = Backyard.query.filter(Backyard.organizador.in_(user_orgs)).all()
+        available_backyards = Backyard.query.filter(principal_atual().filtro_organizacao(Backyard.organizador)).all()
     
     # Get current inscriptions
     current_inscricoes = db.session.query(AtletaBackyard, Backyard).join(
@@ -431,7 +373,10 @@ def inscrever_backyard(atleta_id, backyard_id):
                 status_inscricao='inscrito'
             )
             db.session.add(inscricao)
+            Backyard.registrar_alteracao(backyard_id)
             db.session.commit()
+            race_states.invalidar(backyard_id)
+            contadores.invalidar()
             flash('Atleta inscrito com sucesso!', 'success')
             
     except Exception as e:
@@ -466,20 +411,18 @@ def get_image(atleta_id):
         atleta = Atleta.query.get_or_404(atleta_id)
         
         # Check access permissions
-        if current_user.profile.nome != 'Admin':
+        if not principal_atual().is_admin:
             # Organizador can only view atletas inscribed in their backyards
-            user_orgs = [org.id for org in current_user.organizacoes]
             atleta_in_orgs = db.session.query(AtletaBackyard).join(Backyard).filter(
                 AtletaBackyard.atleta_id == atleta_id,
-                Backyard.organizador.in_(user_orgs)
+                principal_atual().filtro_organizacao(Backyard.organizador)
             ).first()
             
             if not atleta_in_orgs:
                 return '', 403
         
         if atleta.imagem_perfil:
-            image_service = ImageService()
-            url = image_service.get_image_url(atleta.imagem_perfil)
+            url = image_service.get_image_url(atleta.imagem_perfil, size=request.args.get('size'))
             if url:
                 return redirect(url)
         
@@ -487,3 +430,52 @@ def get_image(atleta_id):
         return '', 404
     except Exception as e:
         return '', 500
+
+def _ler_imagem_enviada():
+    """Bytes of the uploaded picture (cropped base64 data or file), or None; flashes errors"""
+    # Check if we have a cropped image (base64 data)
+    cropped_image = request.form.get('cropped_image')
+    if cropped_image and cropped_image.startswith('data:image/'):
+        try:
+            header, data = cropped_image.split(',', 1)
+            # Size checked on the base64 text, before decoding
+            if len(data) * 3 // 4 > image_service.max_file_size:
+                errors = [image_service.too_large_error()]
+            else:
+                image_data = base64.b64decode(data)
+                errors = image_service.validate_image_data(image_data)
+            if errors:
+                flash(f'Erro no upload da imagem cortada: {", ".join(errors)}', 'warning')
+                return None
+            return image_data
+        except Exception as e:
+            flash(f'Erro ao processar imagem cortada: {str(e)}', 'warning')
+            return None
+    
+    # Fallback to regular file upload if no cropped image
+    file = request.files.get('imagem_perfil')
+    if file and file.filename != '':
+        image_data, errors = image_service.read_image(file)
+        if errors:
+            flash(f'Erro no upload da imagem: {", ".join(errors)}', 'warning')
+        return image_data
+    return None
+
+def _enviar_imagem(atleta, imagem):
+    """Queue the picture for background processing (imagem_perfil is set when it is done)"""
+    if imagem is None:
+        return
+    upload_result = processamento_imagens.enviar(imagem, atleta, 'imagem_perfil', 'profile_picture')
+    if upload_result['success']:
+        flash('A foto está sendo processada e aparecerá em instantes.', 'info')
+    else:
+        flash(f'Erro no upload da imagem: {", ".join(upload_result["errors"])}', 'warning')
+
+def _registrar_alteracao_backyards(atleta_id):
+    """Bump the data version of every backyard the atleta is inscribed in (no commit)"""
+    backyard_ids = [backyard_id for (backyard_id,) in db.session.query(
+        AtletaBackyard.backyard_id
+    ).filter(AtletaBackyard.atleta_id == atleta_id)]
+    for backyard_id in backyard_ids:
+        Backyard.registrar_alteracao(backyard_id)
+    return backyard_ids
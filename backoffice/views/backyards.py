@@ -1,10 +1,17 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response
 from flask_login import login_required, current_user
 from models import db, Backyard, Organizacao, AtletaBackyard, Atleta, Loop, AtletaLoop
-from services.image_service import ImageService
+from services.image_service import image_service
+from services.processamento_imagens import processamento_imagens, liberar_imagem
+from services.race_state import race_states
+from services.estatisticas import estatisticas_inscricoes
+from services.contadores import contadores
+from services.busca import busca_backyards
+from services.paginacao import paginar_segmentos
+from services.autorizacao import principal_atual
 from functools import wraps
-from sqlalchemy import func, or_, case
-from datetime import datetime, date
+from sqlalchemy import func, or_
+from datetime import datetime, date, time, timedelta
 import csv
 import json
 import io
@@ -14,7 +21,8 @@ backyards_bp = Blueprint('backyards', __name__)
 def organizador_or_admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome not in ['Admin', 'Organizador']:
+        principal = principal_atual()
+        if principal is None or not (principal.is_admin or principal.is_organizador):
             flash('Access denied. Insufficient privileges.', 'danger')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -32,33 +40,6 @@ def list_backyards():
     date_from = request.args.get('date_from', '', type=str)
     date_to = request.args.get('date_to', '', type=str)
     
-    # Base query with athlete count
-    query = db.session.query(
-        Backyard,
-        func.count(AtletaBackyard.id).label('total_atletas')
-    ).outerjoin(AtletaBackyard).group_by(Backyard.id)
-    
-    # Apply search filter if provided
-    if search:
-        search_filter = or_(
-            Backyard.nome.ilike(f'%{search}%'),
-            Backyard.cidade.ilike(f'%{search}%'),
-            Backyard.estado.ilike(f'%{search}%'),
-            Backyard.descricao.ilike(f'%{search}%')
-        )
-        query = query.filter(search_filter)
-    
-    # Apply status filter if provided
-    if status_filter:
-        if status_filter == 'ATIVO':
-            query = query.filter(Backyard.status == 'ATIVO')
-        elif status_filter == 'PREPARACAO':
-            query = query.filter(Backyard.status == 'PREPARACAO')
-        elif status_filter == 'FINALIZADO':
-            query = query.filter(Backyard.status == 'FINALIZADO')
-        elif status_filter == 'CANCELADO':
-            query = query.filter(Backyard.status == 'CANCELADO')
-    
     # Apply date filters
     hoje = date.today()
     
@@ -76,56 +57,23 @@ def list_backyards():
         except ValueError:
             pass
     
-    # Apply date range filter if provided
-    if date_from_obj:
-        query = query.filter(func.date(Backyard.data_evento) >= date_from_obj)
-    if date_to_obj:
-        query = query.filter(func.date(Backyard.data_evento) <= date_to_obj)
-    
     # If not showing past events and no specific date filter, hide past events
-    if not show_past and not date_from_obj and not date_to_obj:
-        query = query.filter(
-            or_(
-                Backyard.data_evento.is_(None),  # Events without date
-                func.date(Backyard.data_evento) >= hoje,  # Future events
-                Backyard.status == 'ATIVO'  # Active events (regardless of date)
-            )
-        )
+    # (events without date and active events are always shown)
+    ocultar_passados = not show_past and not date_from_obj and not date_to_obj
     
-    # Apply user role permissions
-    if current_user.is_admin():
-        # Admin can see all backyards
-        pass
-    else:
-        # Organizador can only see backyards from their organizations
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if org_ids:
-            query = query.filter(Backyard.organizador.in_(org_ids))
-        else:
-            # If no organizations, return empty results
-            query = query.filter(Backyard.id == -1)
-    
-    # Smart ordering: Active events first, then by date (closest first)
-    query = query.order_by(
-        # Priority 1: Active events first
-        case(
-            (Backyard.status == 'ATIVO', 0),
-            else_=1
-        ),
-        # Priority 2: Events with dates, ordered chronologically
-        case(
-            (Backyard.data_evento.is_(None), 1),  # Events without date go last
-            else_=0
-        ),
-        Backyard.data_evento.asc(),  # Closest dates first (MySQL/MariaDB compatible)
-        Backyard.data_criacao.desc()  # Fallback: newest first
+    query_total, segmentos = consultas_listagem(
+        principal_atual(), search, status_filter, date_from_obj, date_to_obj, ocultar_passados, hoje
     )
     
-    # Paginate results
-    backyards = query.paginate(
-        page=page, per_page=per_page, error_out=False
+    # Total is cached per user and filters instead of recounted on every page
+    total = contadores.total_listagem(
+        ('backyards', current_user.id, search, status_filter, show_past, date_from, date_to),
+        query_total
+    )
+    
+    backyards = paginar_segmentos(
+        segmentos, per_page, page=page, total=total,
+        apos=request.args.get('apos'), antes=request.args.get('antes')
     )
     
     return render_template('backyards/list.html', 
@@ -138,6 +86,66 @@ def list_backyards():
                          per_page=per_page,
                          hoje=hoje)
 
+def consultas_listagem(principal, search='', status_filter='', date_from=None, date_to=None,
+                       ocultar_passados=True, hoje=None):
+    """
+    Queries of the backyard list -> (count query, paginar_segmentos segments)
+
+    Admin sees all backyards, Organizador only those of their organizations.
+    Also used by explain_consultas.py, so the EXPLAIN harness checks the
+    queries this view actually runs.
+    """
+    # Base query: filters only, no join (athlete count is computed for the page rows only)
+    query = db.session.query(Backyard).filter(principal.filtro_organizacao(Backyard.organizador))
+    
+    # Apply search filter if provided
+    if search:
+        query = query.filter(busca_backyards.filtro(search))
+    
+    # Apply status filter if provided
+    if status_filter in ('ATIVO', 'PREPARACAO', 'FINALIZADO', 'CANCELADO'):
+        query = query.filter(Backyard.status == status_filter)
+    
+    # Apply date range filter if provided (half-open ranges on the raw column so the index is usable)
+    if date_from:
+        query = query.filter(Backyard.data_evento >= datetime.combine(date_from, time.min))
+    if date_to:
+        query = query.filter(Backyard.data_evento < datetime.combine(date_to + timedelta(days=1), time.min))
+    
+    inicio_hoje = datetime.combine(hoje or date.today(), time.min)
+    
+    query_total = query
+    if ocultar_passados:
+        query_total = query.filter(or_(
+            Backyard.data_evento.is_(None),
+            Backyard.data_evento >= inicio_hoje,
+            Backyard.status == 'ATIVO'
+        ))
+    
+    total_atletas = db.session.query(func.count(AtletaBackyard.id)).filter(
+        AtletaBackyard.backyard_id == Backyard.id
+    ).correlate(Backyard).scalar_subquery().label('total_atletas')
+    
+    # Smart ordering: active events first, then by date (closest first), events
+    # without date last. Each part is its own keyset segment on the raw columns
+    # (data_evento, id) or (id), so the date indexes serve every page
+    query = query.add_columns(total_atletas)
+    por_data = [(Backyard.data_evento, False), (Backyard.id, False)]
+    por_id = [(Backyard.id, False)]
+    com_data = Backyard.data_evento.isnot(None)
+    sem_data = Backyard.data_evento.is_(None)
+    
+    segmentos = []
+    if status_filter not in ('PREPARACAO', 'FINALIZADO', 'CANCELADO'):
+        ativos = query.filter(Backyard.status == 'ATIVO')
+        segmentos += [(ativos.filter(com_data), por_data), (ativos.filter(sem_data), por_id)]
+    if status_filter != 'ATIVO':
+        outros = query.filter(Backyard.status != 'ATIVO')
+        datados = outros.filter(Backyard.data_evento >= inicio_hoje) if ocultar_passados else outros.filter(com_data)
+        segmentos += [(datados, por_data), (outros.filter(sem_data), por_id)]
+    
+    return query_total.with_entities(func.count(Backyard.id)), segmentos
+
 @backyards_bp.route('/create', methods=['GET', 'POST'])
 @login_required
 @organizador_or_admin_required
@@ -191,31 +199,11 @@ def create_backyard():
         try:
             db.session.add(backyard)
             db.session.commit()
+            contadores.invalidar()
             
-            # Handle image uploads
-            image_service = ImageService()
-            
-            # Upload profile picture
-            if 'profile_picture' in request.files and request.files['profile_picture'].filename:
-                profile_file = request.files['profile_picture']
-                result = image_service.upload_image(profile_file, 'profile_picture', f'backyards/{backyard.id}')
-                
-                if result['success']:
-                    backyard.profile_picture_path = result['file_path']
-                else:
-                    flash(f'Profile picture upload failed: {", ".join(result["errors"])}', 'warning')
-            
-            # Upload logo
-            if 'logo' in request.files and request.files['logo'].filename:
-                logo_file = request.files['logo']
-                result = image_service.upload_image(logo_file, 'logo', f'backyards/{backyard.id}')
-                
-                if result['success']:
-                    backyard.logo_path = result['file_path']
-                else:
-                    flash(f'Logo upload failed: {", ".join(result["errors"])}', 'warning')
+            # Handle image uploads (processed in background; paths are set when done)
+            _enviar_imagens(backyard)
             
-            db.session.commit()
             flash(f'Backyard {nome} created successfully!', 'success')
             return redirect(url_for('backyards.list_backyards'))
             
@@ -224,7 +212,7 @@ def create_backyard():
             flash(f'Error creating backyard: {str(e)}', 'danger')
     
     # Get available organizations based on user role
-    if current_user.is_admin():
+    if principal_atual().is_admin:
         organizacoes = Organizacao.query.all()
     else:
         # Organizador can only create backyards for their organizations
@@ -267,17 +255,13 @@ def edit_backyard(id):
     backyard = Backyard.query.get_or_404(id)
     
     # Check if organizador can edit this backyard
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only edit backyards from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only edit backyards from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
     # GET request - just show the form
     # Get available organizations based on user role
-    if current_user.is_admin():
+    if principal_atual().is_admin:
         organizacoes = Organizacao.query.all()
     else:
         # Organizador can only assign to their organizations
@@ -297,13 +281,9 @@ def update_backyard(id):
     backyard = Backyard.query.get_or_404(id)
     
     # Check if organizador can edit this backyard
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only edit backyards from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only edit backyards from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
     backyard.nome = request.form['nome']
     backyard.organizador = request.form['organizador']
@@ -341,38 +321,14 @@ def update_backyard(id):
         backyard.numero_inicial = None
     
     try:
-        # Handle image uploads
-        image_service = ImageService()
-        
-        # Upload new profile picture if provided
-        if 'profile_picture' in request.files and request.files['profile_picture'].filename:
-            # Delete old image if exists
-            if backyard.profile_picture_path:
-                image_service.delete_image(backyard.profile_picture_path)
-            
-            profile_file = request.files['profile_picture']
-            result = image_service.upload_image(profile_file, 'profile_picture', f'backyards/{backyard.id}')
-            
-            if result['success']:
-                backyard.profile_picture_path = result['file_path']
-            else:
-                flash(f'Profile picture upload failed: {", ".join(result["errors"])}', 'warning')
+        Backyard.registrar_alteracao(id)
+        db.session.commit()
+        race_states.invalidar(id)
+        contadores.invalidar()
         
-        # Upload new logo if provided
-        if 'logo' in request.files and request.files['logo'].filename:
-            # Delete old image if exists
-            if backyard.logo_path:
-                image_service.delete_image(backyard.logo_path)
-            
-            logo_file = request.files['logo']
-            result = image_service.upload_image(logo_file, 'logo', f'backyards/{backyard.id}')
-            
-            if result['success']:
-                backyard.logo_path = result['file_path']
-            else:
-                flash(f'Logo upload failed: {", ".join(result["errors"])}', 'warning')
+        # Handle image uploads (old images are replaced once the new ones are processed)
+        _enviar_imagens(backyard)
         
-        db.session.commit()
         flash(f'Backyard {backyard.nome} updated successfully!', 'success')
         return redirect(url_for('backyards.list_backyards'))
     except Exception as e:
@@ -380,6 +336,19 @@ def update_backyard(id):
         flash(f'Error updating backyard: {str(e)}', 'danger')
         return redirect(url_for('backyards.edit_backyard', id=id))
 
+def _enviar_imagens(backyard):
+    """Queue the uploaded profile picture and logo for background processing"""
+    for campo, image_type, label in (('profile_picture_path', 'profile_picture', 'Profile picture'),
+                                     ('logo_path', 'logo', 'Logo')):
+        file = request.files.get(image_type)
+        if not file or not file.filename:
+            continue
+        result = processamento_imagens.enviar_arquivo(file, backyard, campo, image_type)
+        if result['success']:
+            flash(f'{label} is being processed and will appear in a few seconds.', 'info')
+        else:
+            flash(f'{label} upload failed: {", ".join(result["errors"])}', 'warning')
+
 @backyards_bp.route('/view/<int:id>')
 @login_required
 @organizador_or_admin_required
@@ -388,16 +357,11 @@ def view_backyard(id):
     backyard = Backyard.query.get_or_404(id)
     
     # Check if organizador can view this backyard
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only view backyards from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only view backyards from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
     # Get image URLs
-    image_service = ImageService()
     profile_picture_url = None
     logo_url = None
     
@@ -408,16 +372,10 @@ def view_backyard(id):
         logo_url = image_service.get_image_url(backyard.logo_path)
     
     # Check if user can delete this backyard
-    can_delete = current_user.is_admin()
-    if not can_delete and current_user.is_organizador():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        can_delete = backyard.organizador in org_ids
+    can_delete = principal_atual().pode_gerenciar(backyard.organizador)
     
     # Estatísticas dos números de peito
-    total_inscricoes = AtletaBackyard.query.filter_by(backyard_id=id).count()
-    inscricoes_com_numero = AtletaBackyard.query.filter_by(backyard_id=id).filter(AtletaBackyard.numero_peito.isnot(None)).count()
-    inscricoes_sem_numero = total_inscricoes - inscricoes_com_numero
+    inscricoes = estatisticas_inscricoes(id)
     
     # Lista de atletas inscritos com números
     atletas_inscritos = db.session.query(AtletaBackyard, Atleta).join(
@@ -429,9 +387,9 @@ def view_backyard(id):
                          profile_picture_url=profile_picture_url,
                          logo_url=logo_url,
                          can_delete=can_delete,
-                         total_inscricoes=total_inscricoes,
-                         inscricoes_com_numero=inscricoes_com_numero,
-                         inscricoes_sem_numero=inscricoes_sem_numero,
+                         total_inscricoes=inscricoes.total,
+                         inscricoes_com_numero=inscricoes.com_numero,
+                         inscricoes_sem_numero=inscricoes.sem_numero,
                          atletas_inscritos=atletas_inscritos)
 
 @backyards_bp.route('/<int:id>/gerar-numeros', methods=['POST'])
@@ -443,17 +401,14 @@ def gerar_numeros_peito(id):
         backyard = Backyard.query.get_or_404(id)
         
         # Check if organizador can manage this backyard
-        if not current_user.is_admin():
-            user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-            org_ids = [org.id for org in user_orgs]
-            
-            if backyard.organizador not in org_ids:
-                return jsonify({'success': False, 'message': 'Acesso negado'}), 403
+        if not principal_atual().pode_gerenciar(backyard.organizador):
+            return jsonify({'success': False, 'message': 'Acesso negado'}), 403
         
         # Gerar números usando o método do modelo
         numeros_gerados = backyard.gerar_numeros_peito()
         
         if numeros_gerados > 0:
+            race_states.invalidar(id)
             return jsonify({
                 'success': True, 
                 'message': f'{numeros_gerados} números de peito gerados com sucesso!',
@@ -476,21 +431,14 @@ def delete_backyard(id):
     backyard = Backyard.query.get_or_404(id)
     
     # Check if organizador can delete this backyard
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only delete backyards from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only delete backyards from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
     try:
-        # Delete images from MinIO
-        image_service = ImageService()
-        if backyard.profile_picture_path:
-            image_service.delete_image(backyard.profile_picture_path)
-        if backyard.logo_path:
-            image_service.delete_image(backyard.logo_path)
+        # Release images (removed from storage if no other record uses them)
+        liberar_imagem(backyard.profile_picture_path)
+        liberar_imagem(backyard.logo_path)
         
         # Delete related records in the correct order to avoid foreign key constraints
         
@@ -512,6 +460,7 @@ def delete_backyard(id):
         # 4. Finally delete the backyard itself
         db.session.delete(backyard)
         db.session.commit()
+        contadores.invalidar()
         flash(f'Backyard {backyard.nome} deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -530,27 +479,20 @@ def get_image(backyard_id, image_type):
         print(f"DEBUG: Found backyard: {backyard.nome}")
         
         # Check access permissions
-        if not current_user.is_admin():
-            print(f"DEBUG: User is not admin, checking permissions")
-            user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-            org_ids = [org.id for org in user_orgs]
-            
-            if backyard.organizador not in org_ids:
-                print(f"DEBUG: Access denied for user {current_user.id} to backyard {backyard_id}")
-                return '', 403
-        
-        image_service = ImageService()
+        if not principal_atual().pode_gerenciar(backyard.organizador):
+            print(f"DEBUG: Access denied for user {current_user.id} to backyard {backyard_id}")
+            return '', 403
         
         print(f"DEBUG: Profile picture path: {backyard.profile_picture_path}")
         print(f"DEBUG: Logo path: {backyard.logo_path}")
         
         if image_type == 'profile_picture' and backyard.profile_picture_path:
-            url = image_service.get_image_url(backyard.profile_picture_path)
+            url = image_service.get_image_url(backyard.profile_picture_path, size=request.args.get('size'))
             print(f"DEBUG: Generated profile picture URL: {url}")
             if url:
                 return redirect(url)
         elif image_type == 'logo' and backyard.logo_path:
-            url = image_service.get_image_url(backyard.logo_path)
+            url = image_service.get_image_url(backyard.logo_path, size=request.args.get('size'))
             print(f"DEBUG: Generated logo URL: {url}")
             if url:
                 return redirect(url)
@@ -570,30 +512,27 @@ def delete_image(id, image_type):
     backyard = Backyard.query.get_or_404(id)
     
     # Check if organizador can edit this backyard
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only edit backyards from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only edit backyards from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
-    image_service = ImageService()
     
     try:
         if image_type == 'profile_picture' and backyard.profile_picture_path:
-            image_service.delete_image(backyard.profile_picture_path)
+            liberar_imagem(backyard.profile_picture_path)
             backyard.profile_picture_path = None
             flash('Profile picture deleted successfully!', 'success')
         elif image_type == 'logo' and backyard.logo_path:
-            image_service.delete_image(backyard.logo_path)
+            liberar_imagem(backyard.logo_path)
             backyard.logo_path = None
             flash('Logo deleted successfully!', 'success')
         else:
             flash('Image not found.', 'warning')
             return redirect(url_for('backyards.edit_backyard', id=id))
         
+        Backyard.registrar_alteracao(id)
         db.session.commit()
+        race_states.invalidar(id)
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting image: {str(e)}', 'danger')
@@ -608,13 +547,9 @@ def export_backyard_data(id):
     backyard = Backyard.query.get_or_404(id)
     
     # Verificar permissão
-    if not current_user.is_admin():
-        user_orgs = Organizacao.query.filter_by(organizador=current_user.id).all()
-        org_ids = [org.id for org in user_orgs]
-        
-        if backyard.organizador not in org_ids:
-            flash('Access denied. You can only export data from your organizations.', 'danger')
-            return redirect(url_for('backyards.list_backyards'))
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        flash('Access denied. You can only export data from your organizations.', 'danger')
+        return redirect(url_for('backyards.list_backyards'))
     
     # Buscar dados completos
     atletas_inscritos = db.session.query(AtletaBackyard, Atleta).join(
@@ -1,17 +1,26 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
-from flask_login import login_required, current_user
-from datetime import datetime, timedelta
-from sqlalchemy import func
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, abort
+from flask_login import login_required
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, insert, select, update, literal, bindparam
 from models import db, Backyard, Loop, AtletaLoop, Atleta, AtletaBackyard, BackyardStatus, LoopStatus, AtletaLoopStatus
+from scheduler import scheduler
+from services.race_state import race_states
+from services.idempotencia import idempotente
+from services.estatisticas import estatisticas_loop, contar_participantes
+from services.autorizacao import principal_atual
 from functools import wraps
 import json
 
 # Create blueprint
 loops_bp = Blueprint('loops', __name__)
+
+# Tolerância para relógios de cronometragem adiantados em relação ao servidor
+TOLERANCIA_RELOGIO = timedelta(seconds=30)
 def organizador_or_admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.profile.nome not in ['Admin', 'Organizador']:
+        principal = principal_atual()
+        if principal is None or not (principal.is_admin or principal.is_organizador):
             flash('Access denied. Insufficient privileges.', 'danger')
             return redirect(url_for('dashboard.index'))
         return f(*args, **kwargs)
@@ -21,72 +30,27 @@ def organizador_or_admin_required(f):
 @login_required
 def manage_backyard(backyard_id):
     """Interface principal para gerenciar loops de um backyard"""
-    backyard = Backyard.query.get_or_404(backyard_id)
-    
-    # Buscar loops ordenados por número
-    loops = Loop.query.filter_by(backyard_id=backyard_id).order_by(Loop.numero_loop).all()
+    # Estado da corrida servido da memória (RaceState), revalidado pela versão da backyard
+    estado = race_states.obter(backyard_id)
+    if estado is None:
+        abort(404)
     
-    # Loop atual (último ativo ou em preparação)
-    loop_atual = Loop.query.filter_by(backyard_id=backyard_id).filter(
-        Loop.status.in_([LoopStatus.ATIVO, LoopStatus.PREPARACAO])
-    ).order_by(Loop.numero_loop.desc()).first()
+    backyard = estado.backyard
+    loops = estado.loops
     
-    # Se não há loop ativo/preparação, pegar o último finalizado
-    if not loop_atual and loops:
-        loop_atual = loops[-1]
+    # Loop atual (último ativo ou em preparação; se não houver, o último finalizado)
+    loop_atual = estado.loop_corrente
     
     # Estatísticas gerais do backyard
-    total_atletas_inscritos = len(backyard.atletas)
+    total_atletas_inscritos = estado.total_inscritos
     
     # Estatísticas do loop atual
-    atletas_ativos = 0
-    atletas_concluidos = 0
-    atletas_eliminados = 0
-    
-    # Buscar atletas do loop atual com seus status
-    atletas_loop_atual = []
-    if loop_atual:
-        # Contar por status
-        atletas_ativos = AtletaLoop.query.filter_by(
-            loop_id=loop_atual.id,
-            status=AtletaLoopStatus.ATIVO
-        ).count()
-        
-        atletas_concluidos = AtletaLoop.query.filter_by(
-            loop_id=loop_atual.id,
-            status=AtletaLoopStatus.CONCLUIDO
-        ).count()
-        
-        atletas_eliminados = AtletaLoop.query.filter(
-            AtletaLoop.loop_id == loop_atual.id,
-            AtletaLoop.status.in_([AtletaLoopStatus.ELIMINADO, AtletaLoopStatus.DNF, AtletaLoopStatus.DNS])
-        ).count()
-        
-        # Buscar todos os atletas do loop atual com informações detalhadas incluindo número de peito
-        atletas_loop_atual = db.session.query(
-            AtletaLoop, Atleta, AtletaBackyard
-        ).join(Atleta, AtletaLoop.atleta_id == Atleta.id
-        ).join(AtletaBackyard, 
-               (AtletaBackyard.atleta_id == Atleta.id) & 
-               (AtletaBackyard.backyard_id == backyard_id)
-        ).filter(AtletaLoop.loop_id == loop_atual.id
-        ).all()
-        
-        # Ordenar manualmente: primeiro os ativos, depois os concluídos, depois os eliminados
-        def sort_key(item):
-            atleta_loop, atleta, atleta_backyard = item
-            status_priority = {
-                AtletaLoopStatus.ATIVO: 1,
-                AtletaLoopStatus.CONCLUIDO: 2,
-                AtletaLoopStatus.ELIMINADO: 3,
-                AtletaLoopStatus.DNF: 3,
-                AtletaLoopStatus.DNS: 3
-            }
-            priority = status_priority.get(atleta_loop.status, 4)
-            tempo = atleta_loop.tempo_total_segundos if atleta_loop.tempo_total_segundos else 999999
-            return (priority, tempo, atleta.nome)
-        
-        atletas_loop_atual.sort(key=sort_key)
+    atletas_ativos = estado.contagens[AtletaLoopStatus.ATIVO]
+    atletas_concluidos = estado.contagens[AtletaLoopStatus.CONCLUIDO]
+    atletas_eliminados = estado.total_eliminados_loop
+    
+    # Atletas do loop atual: primeiro os ativos, depois os concluídos, depois os eliminados
+    atletas_loop_atual = estado.corredores_ordenados()
     
     # Loops anteriores para navegação (últimos 10, em ordem decrescente)
     loops_recentes = (loops[-10:] if len(loops) > 10 else loops)
@@ -94,15 +58,13 @@ def manage_backyard(backyard_id):
     total_loops = len(loops)
     
     # Estatísticas históricas
-    total_loops_finalizados = len([l for l in loops if l.status == LoopStatus.FINALIZADO])
-    ultimo_loop_finalizado = None
-    if total_loops_finalizados > 0:
-        ultimo_loop_finalizado = max([l for l in loops if l.status == LoopStatus.FINALIZADO], 
-                                   key=lambda x: x.numero_loop)
+    loops_finalizados = [l for l in loops if l.status == LoopStatus.FINALIZADO]
+    total_loops_finalizados = len(loops_finalizados)
+    ultimo_loop_finalizado = loops_finalizados[-1] if loops_finalizados else None
     
     # Estatísticas dos números de peito
-    total_inscricoes = AtletaBackyard.query.filter_by(backyard_id=backyard_id).count()
-    inscricoes_com_numero = AtletaBackyard.query.filter_by(backyard_id=backyard_id).filter(AtletaBackyard.numero_peito.isnot(None)).count()
+    total_inscricoes = estado.total_inscritos
+    inscricoes_com_numero = estado.inscricoes_com_numero
     inscricoes_sem_numero = total_inscricoes - inscricoes_com_numero
     
     return render_template('loops/manage_backyard.html',
@@ -165,6 +127,31 @@ def view_specific_loop(backyard_id, loop_number):
                          loop_proximo=loop_proximo,
                          total_loops=len(loops))
 
+@loops_bp.route('/backyard/<int:backyard_id>/classificacao')
+@login_required
+def classificacao(backyard_id):
+    """Classificação do evento (voltas completadas e tempo total mantidos a cada loop finalizado)"""
+    Backyard.query.get_or_404(backyard_id)
+    
+    linhas = AtletaBackyard.classificacao(backyard_id).join(
+        Atleta, AtletaBackyard.atleta_id == Atleta.id
+    ).with_entities(
+        AtletaBackyard.atleta_id, Atleta.nome, AtletaBackyard.numero_peito,
+        AtletaBackyard.voltas_completadas, AtletaBackyard.tempo_total_segundos, AtletaBackyard.posicao_final
+    ).all()
+    
+    return jsonify({
+        'success': True,
+        'classificacao': [{
+            'posicao': posicao_final or posicao,
+            'atleta_id': atleta_id,
+            'nome': nome,
+            'numero_peito': numero_peito,
+            'voltas_completadas': voltas or 0,
+            'tempo_total_segundos': tempo_total
+        } for posicao, (atleta_id, nome, numero_peito, voltas, tempo_total, posicao_final) in enumerate(linhas, start=1)]
+    })
+
 @loops_bp.route('/backyard/<int:backyard_id>/start', methods=['POST'])
 @login_required
 def start_backyard(backyard_id):
@@ -175,12 +162,17 @@ def start_backyard(backyard_id):
         flash('Evento já foi iniciado ou finalizado!', 'warning')
         return redirect(url_for('loops.manage_backyard', backyard_id=backyard_id))
     
-    # Verificar se há atletas inscritos
-    if not backyard.atletas:
+    # Verificar se há atletas inscritos (sem carregar os atletas)
+    tem_inscritos = db.session.query(
+        AtletaBackyard.query.filter_by(backyard_id=backyard_id).exists()
+    ).scalar()
+    if not tem_inscritos:
         flash('Não há atletas inscritos neste evento!', 'error')
         return redirect(url_for('loops.manage_backyard', backyard_id=backyard_id))
     
     try:
+        agora = datetime.utcnow()
+        
         # Atualizar status do backyard
         backyard.status = BackyardStatus.ATIVO
         
@@ -189,25 +181,24 @@ def start_backyard(backyard_id):
             backyard_id=backyard_id,
             numero_loop=1,
             status=LoopStatus.PREPARACAO,
-            data_inicio=datetime.utcnow(),
+            data_inicio=agora,
             tempo_limite=3600,  # 1 hora
             distancia_km=6.7
         )
         db.session.add(primeiro_loop)
         db.session.flush()  # Para obter o ID do loop
         
-        # Adicionar todos os atletas ao primeiro loop
-        for atleta in backyard.atletas:
-            atleta_loop = AtletaLoop(
-                atleta_id=atleta.id,
-                loop_id=primeiro_loop.id,
-                status=AtletaLoopStatus.ATIVO,
-                tempo_inicio=datetime.utcnow()
-            )
-            db.session.add(atleta_loop)
+        # Adicionar todos os inscritos ao primeiro loop com um único INSERT ... SELECT
+        total_atletas = _inserir_atletas_no_loop(
+            primeiro_loop.id,
+            select(AtletaBackyard.atleta_id).where(AtletaBackyard.backyard_id == backyard_id),
+            tempo_inicio=agora
+        )
         
+        Backyard.registrar_alteracao(backyard_id)
         db.session.commit()
-        flash(f'Evento iniciado! Loop 1 criado com {len(backyard.atletas)} atletas.', 'success')
+        race_states.invalidar(backyard_id)
+        flash(f'Evento iniciado! Loop 1 criado com {total_atletas} atletas.', 'success')
         
     except Exception as e:
         db.session.rollback()
@@ -226,13 +217,8 @@ def manage_loop(loop_id):
         Atleta, AtletaLoop.atleta_id == Atleta.id
     ).filter(AtletaLoop.loop_id == loop_id).order_by(Atleta.nome).all()
     
-    # Estatísticas do loop
-    stats = {
-        'total': len(atletas_loop),
-        'ativos': len([al for al, _ in atletas_loop if al.status == AtletaLoopStatus.ATIVO]),
-        'concluidos': len([al for al, _ in atletas_loop if al.status == AtletaLoopStatus.CONCLUIDO]),
-        'eliminados': len([al for al, _ in atletas_loop if al.status in [AtletaLoopStatus.ELIMINADO, AtletaLoopStatus.DNF, AtletaLoopStatus.DNS]])
-    }
+    # Estatísticas do loop a partir das linhas já carregadas (sem outra consulta)
+    stats = contar_participantes(atleta_loop for atleta_loop, _ in atletas_loop)
     
     return render_template('loops/manage_loop.html',
                          loop=loop,
@@ -241,6 +227,7 @@ def manage_loop(loop_id):
 
 @loops_bp.route('/loop/<int:loop_id>/start', methods=['POST'])
 @login_required
+@idempotente
 def start_loop(loop_id):
     """Iniciar um loop específico"""
     loop = Loop.query.get_or_404(loop_id)
@@ -249,16 +236,21 @@ def start_loop(loop_id):
         return jsonify({'success': False, 'message': 'Loop já foi iniciado!'})
     
     try:
+        data_inicio = datetime.utcnow()
+        prazo = data_inicio + timedelta(seconds=loop.tempo_limite)
         loop.status = LoopStatus.ATIVO
-        loop.data_inicio = datetime.utcnow()
+        loop.data_inicio = data_inicio
         
         # Atualizar tempo de início para todos os atletas ativos
-        AtletaLoop.query.filter_by(
-            loop_id=loop_id,
-            status=AtletaLoopStatus.ATIVO
-        ).update({'tempo_inicio': datetime.utcnow()})
+        consulta_atletas_ativos(loop_id).update({'tempo_inicio': data_inicio})
         
+        backyard_id = loop.backyard_id
+        Backyard.registrar_alteracao(backyard_id)
         db.session.commit()
+        race_states.invalidar(backyard_id)
+        
+        # Armar a eliminação automática para o prazo deste loop
+        scheduler.agendar(loop_id, prazo)
         return jsonify({'success': True, 'message': f'Loop {loop.numero_loop} iniciado!'})
         
     except Exception as e:
@@ -270,6 +262,7 @@ def start_loop(loop_id):
 def finish_atleta_loop(atleta_loop_id):
     """Marcar atleta como concluído no loop"""
     atleta_loop = AtletaLoop.query.get_or_404(atleta_loop_id)
+    status_anterior, tempo_anterior = atleta_loop.status, atleta_loop.tempo_total_segundos
     
     # Obter dados do formulário
     tempo_fim_str = request.form.get('tempo_fim')
@@ -298,7 +291,12 @@ def finish_atleta_loop(atleta_loop_id):
         atleta_loop.observacoes = observacoes
         atleta_loop.atualizado_em = datetime.utcnow()
         
+        _corrigir_classificacao(atleta_loop, status_anterior, tempo_anterior)
+        backyard_id = atleta_loop.loop.backyard_id
+        versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+        alteracoes = race_states.capturar([atleta_loop])
         db.session.commit()
+        race_states.aplicar(backyard_id, alteracoes, versao)
         flash('Atleta marcado como concluído!', 'success')
         
     except Exception as e:
@@ -312,6 +310,7 @@ def finish_atleta_loop(atleta_loop_id):
 def change_atleta_status(atleta_loop_id):
     """Alterar status de um atleta no loop (desclassificação, correção)"""
     atleta_loop = AtletaLoop.query.get_or_404(atleta_loop_id)
+    status_anterior, tempo_anterior = atleta_loop.status, atleta_loop.tempo_total_segundos
     
     novo_status = request.form.get('status')
     observacoes = request.form.get('observacoes', '')
@@ -328,7 +327,12 @@ def change_atleta_status(atleta_loop_id):
                 if not atleta_loop.tempo_fim:
                     atleta_loop.tempo_fim = datetime.utcnow()
             
+            _corrigir_classificacao(atleta_loop, status_anterior, tempo_anterior)
+            backyard_id = atleta_loop.loop.backyard_id
+            versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+            alteracoes = race_states.capturar([atleta_loop])
             db.session.commit()
+            race_states.aplicar(backyard_id, alteracoes, versao)
             flash(f'Status alterado para {atleta_loop.status.value}!', 'success')
         else:
             flash('Status inválido!', 'error')
@@ -341,6 +345,7 @@ def change_atleta_status(atleta_loop_id):
 
 @loops_bp.route('/loop/<int:loop_id>/create_next', methods=['POST'])
 @login_required
+@idempotente
 def create_next_loop(loop_id):
     """Criar próximo loop com atletas que concluíram o atual"""
     loop_atual = Loop.query.get_or_404(loop_id)
@@ -348,34 +353,31 @@ def create_next_loop(loop_id):
     if loop_atual.status != LoopStatus.ATIVO:
         return jsonify({'success': False, 'message': 'Loop atual deve estar ativo!'})
     
-    # Buscar atletas que concluíram o loop atual
-    atletas_qualificados = AtletaLoop.query.filter_by(
-        loop_id=loop_id,
-        status=AtletaLoopStatus.CONCLUIDO
-    ).all()
+    # Contar atletas que concluíram o loop atual
+    total_qualificados = estatisticas_loop(loop_id).concluidos
     
     # REGRA DO BACKYARD ULTRA: Nunca finalizar evento aqui!
     # Mesmo se apenas 1 atleta se qualificou, ele deve fazer um loop solo
     # O evento só termina quando um atleta COMPLETA um loop sozinho
     
-    if len(atletas_qualificados) == 0:
+    if total_qualificados == 0:
         # Se nenhum atleta se qualificou, finalizar evento (todos foram eliminados)
-        backyard = loop_atual.backyard
-        backyard.status = BackyardStatus.FINALIZADO
+        Backyard.query.filter_by(id=loop_atual.backyard_id).update(
+            {'status': BackyardStatus.FINALIZADO}, synchronize_session=False
+        )
         loop_atual.status = LoopStatus.FINALIZADO
         loop_atual.data_fim = datetime.utcnow()
         
         # REGRA DE NEGÓCIO: Atletas que ainda estavam ATIVOS quando o evento foi finalizado devem virar DNF
-        atletas_ativos_nao_concluidos = AtletaLoop.query.filter_by(
-            loop_id=loop_id,
-            status=AtletaLoopStatus.ATIVO
-        ).all()
-        
-        for atleta_loop in atletas_ativos_nao_concluidos:
-            atleta_loop.status = AtletaLoopStatus.DNF
-            atleta_loop.observacoes = "DNF - Loop finalizado antes da conclusão"
+        _marcar_ativos_como_dnf(loop_id)
         
+        # Ninguém concluiu este loop: a classificação final é a acumulada até o loop anterior
+        backyard_id = loop_atual.backyard_id
+        _atribuir_posicoes_finais(backyard_id)
+        Backyard.registrar_alteracao(backyard_id)
         db.session.commit()
+        scheduler.cancelar(loop_id)
+        race_states.invalidar(backyard_id)
         
         return jsonify({
             'success': True, 
@@ -389,14 +391,10 @@ def create_next_loop(loop_id):
         loop_atual.data_fim = datetime.utcnow()
         
         # REGRA DE NEGÓCIO: Atletas que ainda estavam ATIVOS quando o loop foi finalizado devem virar DNF
-        atletas_ativos_nao_concluidos = AtletaLoop.query.filter_by(
-            loop_id=loop_id,
-            status=AtletaLoopStatus.ATIVO
-        ).all()
+        _marcar_ativos_como_dnf(loop_id)
         
-        for atleta_loop in atletas_ativos_nao_concluidos:
-            atleta_loop.status = AtletaLoopStatus.DNF
-            atleta_loop.observacoes = "DNF - Loop finalizado antes da conclusão"
+        # Classificação: quem concluiu o loop ganha uma volta e soma o tempo
+        _contabilizar_loop(loop_id, loop_atual.backyard_id)
         
         # Criar próximo loop
         proximo_loop = Loop(
@@ -409,20 +407,23 @@ def create_next_loop(loop_id):
         db.session.add(proximo_loop)
         db.session.flush()
         
-        # Adicionar atletas qualificados ao próximo loop
-        for atleta_loop in atletas_qualificados:
-            novo_atleta_loop = AtletaLoop(
-                atleta_id=atleta_loop.atleta_id,
-                loop_id=proximo_loop.id,
-                status=AtletaLoopStatus.ATIVO
+        # Adicionar atletas qualificados ao próximo loop com um único INSERT ... SELECT
+        _inserir_atletas_no_loop(
+            proximo_loop.id,
+            select(AtletaLoop.atleta_id).where(
+                AtletaLoop.loop_id == loop_id,
+                AtletaLoop.status == AtletaLoopStatus.CONCLUIDO
             )
-            db.session.add(novo_atleta_loop)
+        )
         
+        Backyard.registrar_alteracao(proximo_loop.backyard_id)
         db.session.commit()
+        scheduler.cancelar(loop_id)
+        race_states.invalidar(proximo_loop.backyard_id)
         
         return jsonify({
             'success': True,
-            'message': f'Loop {proximo_loop.numero_loop} criado com {len(atletas_qualificados)} atletas!',
+            'message': f'Loop {proximo_loop.numero_loop} criado com {total_qualificados} atletas!',
             'new_loop_id': proximo_loop.id
         })
         
@@ -435,6 +436,7 @@ def create_next_loop(loop_id):
 def edit_time(atleta_loop_id):
     """Corrigir tempo de um atleta"""
     atleta_loop = AtletaLoop.query.get_or_404(atleta_loop_id)
+    status_anterior, tempo_anterior = atleta_loop.status, atleta_loop.tempo_total_segundos
     
     novo_tempo = request.form.get('tempo_total')
     observacoes = request.form.get('observacoes', '')
@@ -458,7 +460,12 @@ def edit_time(atleta_loop_id):
         atleta_loop.observacoes = observacoes
         atleta_loop.atualizado_em = datetime.utcnow()
         
+        _corrigir_classificacao(atleta_loop, status_anterior, tempo_anterior)
+        backyard_id = atleta_loop.loop.backyard_id
+        versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+        alteracoes = race_states.capturar([atleta_loop])
         db.session.commit()
+        race_states.aplicar(backyard_id, alteracoes, versao)
         flash('Tempo corrigido com sucesso!', 'success')
         
     except Exception as e:
@@ -469,17 +476,13 @@ def edit_time(atleta_loop_id):
 
 @loops_bp.route('/atleta/<int:atleta_loop_id>/concluir', methods=['POST'])
 @login_required
+@idempotente
 def marcar_atleta_concluido(atleta_loop_id):
     """Endpoint AJAX para marcar atleta como concluído rapidamente"""
-    print(f"DEBUG: marcar_atleta_concluido chamado com ID: {atleta_loop_id}")
     try:
-        atleta_loop = AtletaLoop.query.get_or_404(atleta_loop_id)
-        print(f"DEBUG: Atleta encontrado: {atleta_loop.id}, Status: {atleta_loop.status}")
-        
-        # Calcular tempo real baseado no início do loop
-        from datetime import datetime
-        tempo_atual = datetime.now()
-        loop = atleta_loop.loop
+        atleta_loop, loop = db.session.query(AtletaLoop, Loop).join(
+            Loop, AtletaLoop.loop_id == Loop.id
+        ).filter(AtletaLoop.id == atleta_loop_id).first_or_404()
         
         # Verificar se o loop está ativo
         if loop.status != LoopStatus.ATIVO:
@@ -489,100 +492,47 @@ def marcar_atleta_concluido(atleta_loop_id):
         if atleta_loop.status != AtletaLoopStatus.ATIVO:
             return jsonify({'success': False, 'message': 'Atleta não está ativo neste loop'}), 400
         
-        # Calcular tempo total baseado no início do loop
-        if loop.data_inicio:
-            tempo_decorrido = tempo_atual - loop.data_inicio
-            tempo_total_segundos = int(tempo_decorrido.total_seconds())
-            print(f"DEBUG: Usando data_inicio do loop: {loop.data_inicio}")
-        else:
-            # Se não há data de início, usar tempo desde a criação do loop
-            tempo_decorrido = tempo_atual - loop.criado_em
-            tempo_total_segundos = int(tempo_decorrido.total_seconds())
-            print(f"DEBUG: Usando criado_em do loop: {loop.criado_em}")
-        
-        print(f"DEBUG: Tempo atual: {tempo_atual}")
-        print(f"DEBUG: Tempo decorrido: {tempo_decorrido}")
-        print(f"DEBUG: Tempo total em segundos: {tempo_total_segundos}")
-        
-        # REGRA CRÍTICA DO BACKYARD ULTRA: Verificar se excedeu o tempo limite
-        if tempo_total_segundos > loop.tempo_limite:
-            # Atleta excedeu o tempo limite - ELIMINADO automaticamente
-            atleta_loop.status = AtletaLoopStatus.ELIMINADO
-            atleta_loop.tempo_fim = tempo_atual
-            atleta_loop.tempo_total_segundos = tempo_total_segundos
-            atleta_loop.observacoes = f"ELIMINADO - Excedeu tempo limite ({tempo_total_segundos}s > {loop.tempo_limite}s)"
-            atleta_loop.atualizado_em = datetime.utcnow()
-            
+        # Calcular tempo real baseado no início do loop (UTC, como o check-in em lote)
+        tempo_atual = datetime.utcnow()
+        status = _registrar_chegada(loop, atleta_loop, tempo_atual)
+        backyard_id = loop.backyard_id
+        versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+        alteracoes = race_states.capturar([atleta_loop])
+        
+        # REGRA CRÍTICA DO BACKYARD ULTRA: atleta que excedeu o tempo limite é ELIMINADO
+        if status == AtletaLoopStatus.ELIMINADO:
             db.session.commit()
-            print(f"DEBUG: Atleta ELIMINADO por exceder tempo limite: {tempo_total_segundos}s > {loop.tempo_limite}s")
+            race_states.aplicar(backyard_id, alteracoes, versao)
             
             return jsonify({
                 'success': False,
-                'message': f'Atleta ELIMINADO! Tempo {tempo_total_segundos}s excedeu o limite de {loop.tempo_limite}s',
+                'message': f'Atleta ELIMINADO! Tempo {atleta_loop.tempo_total_segundos}s excedeu o limite de {loop.tempo_limite}s',
                 'status': 'ELIMINADO',
-                'tempo_total': tempo_total_segundos,
+                'tempo_total': atleta_loop.tempo_total_segundos,
                 'tempo_limite': loop.tempo_limite,
                 'eliminated': True
             })
         
-        # Atleta completou dentro do tempo limite
-        atleta_loop.status = AtletaLoopStatus.CONCLUIDO
-        atleta_loop.tempo_fim = tempo_atual
-        atleta_loop.tempo_total_segundos = tempo_total_segundos
-        
-        db.session.commit()
-        print("DEBUG: Commit realizado com sucesso")
-        
         # REGRA DO BACKYARD ULTRA: Verificar se este é um LOOP SOLO COMPLETADO
-        # Um loop solo é quando apenas 1 atleta INICIOU o loop (não apenas completou)
-        
-        # Contar quantos atletas participaram deste loop (todos os status)
-        total_atletas_no_loop = AtletaLoop.query.filter_by(loop_id=loop.id).count()
+        vencedor = _verificar_loop_solo(loop)
+        db.session.commit()
         
-        print(f"DEBUG: Total de atletas que participaram do loop {loop.numero_loop}: {total_atletas_no_loop}")
+        tempo_formatado = atleta_loop.get_tempo_formatado()
         
-        # Se apenas 1 atleta participou do loop E ele completou, temos um vencedor!
-        if total_atletas_no_loop == 1:
-            atletas_concluidos_no_loop = AtletaLoop.query.filter_by(
-                loop_id=loop.id,
-                status=AtletaLoopStatus.CONCLUIDO
-            ).count()
-            
-            print(f"DEBUG: Atletas concluídos no loop solo: {atletas_concluidos_no_loop}")
-            
-            # Se o único atleta do loop completou, ele é o campeão!
-            if atletas_concluidos_no_loop == 1:
-                backyard = loop.backyard
-                backyard.status = BackyardStatus.FINALIZADO
-                loop.status = LoopStatus.FINALIZADO
-                loop.data_fim = datetime.now()
-                
-                # Buscar o vencedor
-                vencedor_atleta_loop = AtletaLoop.query.filter_by(
-                    loop_id=loop.id,
-                    status=AtletaLoopStatus.CONCLUIDO
-                ).first()
-                vencedor = Atleta.query.get(vencedor_atleta_loop.atleta_id)
-                
-                db.session.commit()
-                print(f"DEBUG: EVENTO FINALIZADO! Vencedor: {vencedor.nome} completou loop solo #{loop.numero_loop}")
-                
-                # Retornar dados atualizados
-                tempo_formatado = atleta_loop.get_tempo_formatado()
-                
-                return jsonify({
-                    'success': True, 
-                    'message': f'🏆 PARABÉNS! {vencedor.nome} é o CAMPEÃO! Completou o loop #{loop.numero_loop} sozinho!',
-                    'tempo_formatado': tempo_formatado,
-                    'status': 'CONCLUIDO',
-                    'event_finished': True,
-                    'winner': vencedor.nome
-                })
+        if vencedor:
+            scheduler.cancelar(loop.id)
+            race_states.invalidar(backyard_id)
+            return jsonify({
+                'success': True, 
+                'message': f'🏆 PARABÉNS! {vencedor.nome} é o CAMPEÃO! Completou o loop #{loop.numero_loop} sozinho!',
+                'tempo_formatado': tempo_formatado,
+                'status': 'CONCLUIDO',
+                'event_finished': True,
+                'winner': vencedor.nome
+            })
         
         # Retornar dados atualizados (caso normal)
-        tempo_formatado = atleta_loop.get_tempo_formatado()
-        print(f"DEBUG: Tempo formatado: {tempo_formatado}")
-        
+        race_states.aplicar(backyard_id, alteracoes, versao)
         return jsonify({
             'success': True, 
             'message': 'Atleta marcado como concluído',
@@ -591,13 +541,233 @@ def marcar_atleta_concluido(atleta_loop_id):
         })
         
     except Exception as e:
-        print(f"DEBUG: Erro: {str(e)}")
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@loops_bp.route('/backyard/<int:backyard_id>/checkin', methods=['POST'])
+@login_required
+@organizador_or_admin_required
+@idempotente
+def checkin_lote(backyard_id):
+    """
+    Endpoint AJAX para registrar um lote de chegadas do curral pelo número de peito
+    
+    Aceita uma lista JSON [{"bib": 12, "timestamp": "2024-05-01T10:58:03"}, ...]
+    (ou {"chegadas": [...]}). O timestamp é opcional (padrão: agora, em UTC);
+    chegadas antes do início do loop ou no futuro (além de TOLERANCIA_RELOGIO)
+    são recusadas no resultado do item. As demais são aplicadas ao loop ativo e
+    gravadas em um único commit.
+    """
+    backyard = Backyard.query.get_or_404(backyard_id)
+
+    # Verificar permissões
+    if not principal_atual().pode_gerenciar(backyard.organizador):
+        return jsonify({'success': False, 'message': 'Sem permissão'}), 403
+
+    dados = request.get_json(silent=True)
+    chegadas = dados.get('chegadas') if isinstance(dados, dict) else dados
+    
+    if not isinstance(chegadas, list) or not chegadas:
+        return jsonify({'success': False, 'message': 'Envie uma lista de chegadas [{bib, timestamp}]'}), 400
+    
+    # Validar e normalizar o lote antes de tocar no banco
+    lote = []
+    for item in chegadas:
+        try:
+            bib = int(item['bib'])
+            tempo_chegada = _parse_timestamp_chegada(item.get('timestamp'))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return jsonify({'success': False, 'message': f'Chegada inválida: {item}'}), 400
+        lote.append((tempo_chegada, bib))
+    
+    # Processar na ordem em que os atletas cruzaram a linha
+    lote.sort(key=lambda chegada: chegada[0])
+    
+    try:
+        loop = consulta_loop_ativo(backyard_id).first()
+        
+        if not loop:
+            return jsonify({'success': False, 'message': 'Nenhum loop ativo neste evento'}), 400
+        
+        # Resolver todos os números de peito do lote em uma única consulta
+        atletas_por_bib = dict(
+            (numero_peito, atleta_loop) for atleta_loop, numero_peito in consulta_atletas_por_numero(
+                backyard_id, loop.id, set(bib for _, bib in lote)
+            ).all()
+        )
+        
+        resultados = []
+        registrados = []
+        concluidos = 0
+        eliminados = 0
+        for tempo_chegada, bib in lote:
+            if not _chegada_no_loop(loop, tempo_chegada):
+                resultados.append({'bib': bib, 'status': 'TIMESTAMP_INVALIDO',
+                                   'message': 'Horário de chegada fora do loop (antes do início ou no futuro)'})
+                continue
+            
+            atleta_loop = atletas_por_bib.get(bib)
+            if atleta_loop is None:
+                resultados.append({'bib': bib, 'status': 'NAO_ENCONTRADO',
+                                   'message': 'Número de peito não está neste loop'})
+                continue
+            
+            if atleta_loop.status != AtletaLoopStatus.ATIVO:
+                resultados.append({'bib': bib, 'atleta_loop_id': atleta_loop.id,
+                                   'status': atleta_loop.status.value,
+                                   'message': 'Atleta não está ativo neste loop'})
+                continue
+            
+            status = _registrar_chegada(loop, atleta_loop, tempo_chegada)
+            registrados.append(atleta_loop)
+            if status == AtletaLoopStatus.ELIMINADO:
+                eliminados += 1
+            else:
+                concluidos += 1
+            
+            resultados.append({
+                'bib': bib,
+                'atleta_loop_id': atleta_loop.id,
+                'status': status.value,
+                'tempo_total': atleta_loop.tempo_total_segundos,
+                'tempo_formatado': atleta_loop.get_tempo_formatado()
+            })
+        
+        # REGRA DO BACKYARD ULTRA: loop solo completado encerra o evento
+        vencedor = _verificar_loop_solo(loop) if concluidos else None
+        loop_id, numero_loop = loop.id, loop.numero_loop
+        
+        versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+        alteracoes = race_states.capturar(registrados)
+        db.session.commit()
+        
+        resposta = {
+            'success': True,
+            'message': f'{concluidos} chegadas registradas, {eliminados} eliminados por tempo',
+            'loop_id': loop_id,
+            'concluidos': concluidos,
+            'eliminados': eliminados,
+            'resultados': resultados
+        }
+        
+        if vencedor:
+            scheduler.cancelar(loop_id)
+            race_states.invalidar(backyard_id)
+            resposta['event_finished'] = True
+            resposta['winner'] = vencedor.nome
+            resposta['message'] = f'🏆 PARABÉNS! {vencedor.nome} é o CAMPEÃO! Completou o loop #{numero_loop} sozinho!'
+        else:
+            race_states.aplicar(backyard_id, alteracoes, versao)
+        
+        return jsonify(resposta)
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+def consulta_loop_ativo(backyard_id):
+    """Loop ativo da backyard (o de maior número, se houver mais de um)"""
+    return Loop.query.filter_by(
+        backyard_id=backyard_id,
+        status=LoopStatus.ATIVO
+    ).order_by(Loop.numero_loop.desc())
+
+def consulta_atletas_por_numero(backyard_id, loop_id, numeros):
+    """(AtletaLoop, número de peito) dos atletas do loop com os números informados"""
+    return db.session.query(
+        AtletaLoop, AtletaBackyard.numero_peito
+    ).join(
+        AtletaBackyard,
+        (AtletaBackyard.atleta_id == AtletaLoop.atleta_id) &
+        (AtletaBackyard.backyard_id == backyard_id)
+    ).filter(
+        AtletaLoop.loop_id == loop_id,
+        AtletaBackyard.numero_peito.in_(numeros)
+    )
+
+def consulta_atletas_ativos(loop_id):
+    """AtletaLoops ainda ATIVOS no loop"""
+    return AtletaLoop.query.filter_by(
+        loop_id=loop_id,
+        status=AtletaLoopStatus.ATIVO
+    )
+
+def _parse_timestamp_chegada(valor):
+    """Converte o timestamp ISO 8601 de uma chegada para datetime UTC ingênuo"""
+    if not valor:
+        return datetime.utcnow()
+    
+    tempo = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    if tempo.tzinfo is not None:
+        tempo = tempo.astimezone(timezone.utc).replace(tzinfo=None)
+    return tempo
+
+def _chegada_no_loop(loop, tempo_chegada):
+    """True se a chegada está entre o início do loop e agora (com TOLERANCIA_RELOGIO)"""
+    inicio = loop.data_inicio or loop.criado_em
+    if inicio is not None and tempo_chegada < inicio:
+        return False
+    return tempo_chegada <= datetime.utcnow() + TOLERANCIA_RELOGIO
+
+def _registrar_chegada(loop, atleta_loop, tempo_chegada):
+    """
+    Aplica a regra de tempo limite à chegada de um atleta ATIVO
+    Retorna o novo status (CONCLUIDO ou ELIMINADO); não faz commit
+    """
+    # Calcular tempo total baseado no início do loop
+    inicio = loop.data_inicio or loop.criado_em
+    tempo_total_segundos = int((tempo_chegada - inicio).total_seconds())
+    
+    atleta_loop.tempo_fim = tempo_chegada
+    atleta_loop.tempo_total_segundos = tempo_total_segundos
+    
+    # REGRA CRÍTICA DO BACKYARD ULTRA: Verificar se excedeu o tempo limite
+    if tempo_total_segundos > loop.tempo_limite:
+        atleta_loop.status = AtletaLoopStatus.ELIMINADO
+        atleta_loop.observacoes = f"ELIMINADO - Excedeu tempo limite ({tempo_total_segundos}s > {loop.tempo_limite}s)"
+        atleta_loop.atualizado_em = datetime.utcnow()
+    else:
+        atleta_loop.status = AtletaLoopStatus.CONCLUIDO
+    
+    return atleta_loop.status
+
+def _verificar_loop_solo(loop):
+    """
+    Finaliza o evento se o loop teve um único participante e ele concluiu
+    Um loop solo é quando apenas 1 atleta INICIOU o loop (não apenas completou).
+    Retorna o Atleta vencedor ou None; não faz commit
+    """
+    db.session.flush()
+    
+    contagem = estatisticas_loop(loop.id)
+    
+    # Se o único atleta do loop completou, ele é o campeão!
+    if contagem.total != 1 or contagem.concluidos != 1:
+        return None
+    
+    Backyard.query.filter_by(id=loop.backyard_id).update(
+        {'status': BackyardStatus.FINALIZADO}, synchronize_session=False
+    )
+    loop.status = LoopStatus.FINALIZADO
+    loop.data_fim = datetime.now()
+    
+    # Classificação: contabilizar o loop solo e fixar as posições finais
+    _contabilizar_loop(loop.id, loop.backyard_id)
+    _atribuir_posicoes_finais(loop.backyard_id)
+    
+    vencedor = db.session.query(Atleta).join(
+        AtletaLoop, AtletaLoop.atleta_id == Atleta.id
+    ).filter(
+        AtletaLoop.loop_id == loop.id,
+        AtletaLoop.status == AtletaLoopStatus.CONCLUIDO
+    ).first()
+    print(f"EVENTO FINALIZADO! Vencedor: {vencedor.nome} completou loop solo #{loop.numero_loop}")
+    return vencedor
+
 @loops_bp.route('/atleta/<int:atleta_loop_id>/eliminar', methods=['POST'])
 @login_required
-@organizador_or_admin_required  
+@organizador_or_admin_required
+@idempotente
 def marcar_atleta_eliminado(atleta_loop_id):
     """Endpoint AJAX para marcar atleta como eliminado rapidamente"""
     try:
@@ -606,7 +776,7 @@ def marcar_atleta_eliminado(atleta_loop_id):
         backyard = loop.backyard
         
         # Verificar permissões
-        if current_user.profile.nome == 'Organizador' and backyard.organizador != current_user.organizacao_id:
+        if not principal_atual().pode_gerenciar(backyard.organizador):
             return jsonify({'success': False, 'message': 'Sem permissão'}), 403
         
         # Verificar se o loop está ativo
@@ -622,7 +792,11 @@ def marcar_atleta_eliminado(atleta_loop_id):
         atleta_loop.tempo_fim = datetime.now()
         atleta_loop.tempo_total_segundos = None  # Não completou
         
+        backyard_id = backyard.id
+        versao = Backyard.registrar_alteracao(backyard_id, retornar_versao=True)
+        alteracoes = race_states.capturar([atleta_loop])
         db.session.commit()
+        race_states.aplicar(backyard_id, alteracoes, versao)
         
         return jsonify({
             'success': True, 
@@ -634,6 +808,97 @@ def marcar_atleta_eliminado(atleta_loop_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def _inserir_atletas_no_loop(loop_id, atletas_select, tempo_inicio=None):
+    """
+    Insere como ATIVOS no loop os atletas retornados por atletas_select
+    (uma coluna atleta_id) em um único INSERT ... SELECT.
+    Retorna o número de linhas inseridas
+    """
+    origem = atletas_select.add_columns(
+        literal(loop_id),
+        literal(AtletaLoopStatus.ATIVO, AtletaLoop.status.type),
+        literal(tempo_inicio, AtletaLoop.tempo_inicio.type)
+    )
+    resultado = db.session.execute(
+        insert(AtletaLoop.__table__).from_select(
+            ['atleta_id', 'loop_id', 'status', 'tempo_inicio'], origem
+        )
+    )
+    return resultado.rowcount
+
+def _marcar_ativos_como_dnf(loop_id):
+    """Marca como DNF, em um único UPDATE, os atletas ainda ATIVOS no loop"""
+    return consulta_atletas_ativos(loop_id).update({
+        'status': AtletaLoopStatus.DNF,
+        'observacoes': "DNF - Loop finalizado antes da conclusão"
+    }, synchronize_session=False)
+
+def _contabilizar_loop(loop_id, backyard_id):
+    """
+    Soma o loop finalizado à classificação de quem o concluiu
+    (voltas_completadas + 1, tempo_total_segundos + tempo do loop) em um único UPDATE
+    """
+    tempo_no_loop = select(func.coalesce(AtletaLoop.tempo_total_segundos, 0)).where(
+        AtletaLoop.loop_id == loop_id,
+        AtletaLoop.atleta_id == AtletaBackyard.atleta_id
+    ).scalar_subquery()
+    
+    db.session.execute(
+        update(AtletaBackyard).where(
+            AtletaBackyard.backyard_id == backyard_id,
+            AtletaBackyard.atleta_id.in_(select(AtletaLoop.atleta_id).where(
+                AtletaLoop.loop_id == loop_id,
+                AtletaLoop.status == AtletaLoopStatus.CONCLUIDO
+            ))
+        ).values(
+            voltas_completadas=func.coalesce(AtletaBackyard.voltas_completadas, 0) + 1,
+            tempo_total_segundos=AtletaBackyard.tempo_total_segundos + tempo_no_loop
+        ).execution_options(synchronize_session=False)
+    )
+
+def _atribuir_posicoes_finais(backyard_id):
+    """Grava posicao_final de todos os inscritos conforme a classificação (evento encerrado)"""
+    ids = [inscricao_id for (inscricao_id,) in AtletaBackyard.classificacao(backyard_id).with_entities(
+        AtletaBackyard.id
+    )]
+    if not ids:
+        return
+    
+    tabela = AtletaBackyard.__table__
+    db.session.execute(
+        tabela.update().where(tabela.c.id == bindparam('inscricao_id')).values(posicao_final=bindparam('posicao')),
+        [{'inscricao_id': inscricao_id, 'posicao': posicao} for posicao, inscricao_id in enumerate(ids, start=1)]
+    )
+
+def _corrigir_classificacao(atleta_loop, status_anterior, tempo_anterior):
+    """
+    Reflete na classificação uma correção feita em um loop já finalizado
+    (loops em andamento só entram na classificação quando finalizam)
+    """
+    loop = atleta_loop.loop
+    if loop.status != LoopStatus.FINALIZADO:
+        return
+    
+    concluiu_antes = status_anterior == AtletaLoopStatus.CONCLUIDO
+    concluiu_agora = atleta_loop.status == AtletaLoopStatus.CONCLUIDO
+    delta_voltas = int(concluiu_agora) - int(concluiu_antes)
+    delta_tempo = ((atleta_loop.tempo_total_segundos or 0) if concluiu_agora else 0) - \
+                  ((tempo_anterior or 0) if concluiu_antes else 0)
+    if not delta_voltas and not delta_tempo:
+        return
+    
+    AtletaBackyard.query.filter_by(
+        backyard_id=loop.backyard_id,
+        atleta_id=atleta_loop.atleta_id
+    ).update({
+        'voltas_completadas': func.coalesce(AtletaBackyard.voltas_completadas, 0) + delta_voltas,
+        'tempo_total_segundos': AtletaBackyard.tempo_total_segundos + delta_tempo
+    }, synchronize_session=False)
+    
+    # Evento já encerrado: a correção pode mudar as posições finais
+    if db.session.query(Backyard.status).filter(Backyard.id == loop.backyard_id).scalar() == BackyardStatus.FINALIZADO:
+        _atribuir_posicoes_finais(loop.backyard_id)
+
 def eliminar_atletas_por_tempo(loop_id):
     """
     Função utilitária para eliminar automaticamente atletas que excederam o tempo limite
@@ -656,10 +921,7 @@ def eliminar_atletas_por_tempo(loop_id):
             return 0
         
         # Buscar atletas ativos que ainda não chegaram
-        atletas_ativos = AtletaLoop.query.filter_by(
-            loop_id=loop_id,
-            status=AtletaLoopStatus.ATIVO
-        ).all()
+        atletas_ativos = consulta_atletas_ativos(loop_id).all()
         
         atletas_eliminados = 0
         
@@ -675,7 +937,10 @@ def eliminar_atletas_por_tempo(loop_id):
             print(f"DEBUG: Atleta {atleta_loop.atleta_id} eliminado automaticamente por tempo no loop {loop_id}")
         
         if atletas_eliminados > 0:
+            backyard_id = loop.backyard_id
+            Backyard.registrar_alteracao(backyard_id)
             db.session.commit()
+            race_states.invalidar(backyard_id)
             print(f"DEBUG: {atletas_eliminados} atletas eliminados automaticamente no loop {loop_id}")
         
         return atletas_eliminados
@@ -1,6 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from models import db, Organizacao, Backend_Users
+from services.contadores import contadores
 from functools import wraps
 
 organizacoes_bp = Blueprint('organizacoes', __name__)
@@ -40,6 +41,7 @@ def create_organizacao():
         try:
             db.session.add(organizacao)
             db.session.commit()
+            contadores.invalidar()
             flash(f'Organization {nome} created successfully!', 'success')
             return redirect(url_for('organizacoes.list_organizacoes'))
         except Exception as e:
@@ -62,6 +64,7 @@ def edit_organizacao(id):
         
         try:
             db.session.commit()
+            contadores.invalidar()
             flash(f'Organization {organizacao.nome} updated successfully!', 'success')
             return redirect(url_for('organizacoes.list_organizacoes'))
         except Exception as e:
@@ -86,6 +89,7 @@ def delete_organizacao(id):
     try:
         db.session.delete(organizacao)
         db.session.commit()
+        contadores.invalidar()
         flash(f'Organization {organizacao.nome} deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -3,6 +3,7 @@ from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
 from models import db, Backend_Users, Profile
 from services.password_service import PasswordService
+from services.contadores import contadores
 from functools import wraps
 
 users_bp = Blueprint('users', __name__)
@@ -62,6 +63,7 @@ def create_user():
         try:
             db.session.add(user)
             db.session.commit()
+            contadores.invalidar()
             flash(f'User {nome} created successfully!', 'success')
             return redirect(url_for('users.list_users'))
         except Exception as e:
@@ -111,6 +113,7 @@ def delete_user(id):
     try:
         db.session.delete(user)
         db.session.commit()
+        contadores.invalidar()
         flash(f'User {user.nome} deleted successfully!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -12,7 +12,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime
 
 from models import db, Atleta, Backyard, AtletaBackyard, BackyardStatus
-from services.image_service import ImageService
+from services.image_service import image_service
 from services.password_service import PasswordService
 
 def create_app():
@@ -22,6 +22,9 @@ def create_app():
     # Configuration
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
     
+    # Limite do corpo da requisição: duas imagens de até 5MB e o formulário
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+    
     # Database configuration (same as backoffice)
     db_host = os.environ.get('DB_HOST', 'mariadb')
     db_port = os.environ.get('DB_PORT', '3306')
@@ -29,12 +32,38 @@ def create_app():
     db_password = os.environ.get('DB_PASSWORD', 'btl_password')
     db_name = os.environ.get('DB_NAME', 'btl_db')
     
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
+    # DATABASE_URL permite apontar para outro banco (ex.: sqlite:///btl.db em desenvolvimento/testes)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL',
+        f'mysql+pymysql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
+    )
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
+    # Réplica de leitura opcional para as páginas de espectadores (DATABASE_REPLICA_URL ou DB_REPLICA_HOST)
+    replica_host = os.environ.get('DB_REPLICA_HOST')
+    replica_url = os.environ.get('DATABASE_REPLICA_URL') or (
+        replica_host and
+        f'mysql+pymysql://{db_user}:{db_password}@{replica_host}:{os.environ.get("DB_REPLICA_PORT", db_port)}/{db_name}'
+    )
+    if replica_url:
+        app.config['SQLALCHEMY_BINDS'] = {'replica': replica_url}
+    app.config['BTL_REPLICA_ATRASO_MAXIMO'] = os.environ.get('BTL_REPLICA_ATRASO_MAXIMO', 5)
+    if os.environ.get('BTL_REPLICA_FIXACAO'):
+        app.config['BTL_REPLICA_FIXACAO'] = os.environ['BTL_REPLICA_FIXACAO']
+    
     # Initialize extensions
     db.init_app(app)
     
+    from services.replica import roteador_replica
+    roteador_replica.init_app(app)
+    
+    # Armazenamento das imagens (backend local registra a rota dos arquivos)
+    image_service.init_app(app)
+    
+    # Uploads de imagem processados em segundo plano
+    from services.processamento_imagens import processamento_imagens
+    processamento_imagens.init_app(app)
+    
     # Setup Flask-Login
     login_manager = LoginManager()
     login_manager.init_app(app)
@@ -57,14 +86,48 @@ def create_app():
     app.register_blueprint(profile_bp, url_prefix='/profile')
     app.register_blueprint(backyards_bp, url_prefix='/backyards')
     
+    # Transmissão ao vivo (SSE) das backyards em andamento
+    from services.live_stream import live_broadcaster
+    live_broadcaster.init_app(app)
+    
+    # Perfil de SQL por requisição (BTL_SQL_PROFILER=true): Server-Timing, comandos lentos e N+1
+    from services.sql_profiler import sql_profiler
+    sql_profiler.init_app(app)
+    
+    @app.route('/debug/sql')
+    def debug_sql():
+        """Requisições recentes do profiler (JSON); exige BTL_SQL_PROFILER_TOKEN"""
+        token = os.environ.get('BTL_SQL_PROFILER_TOKEN')
+        if not sql_profiler.ativo or not token or request.args.get('token') != token:
+            return render_template('errors/404.html'), 404
+        
+        return jsonify({
+            'limite_lento_ms': sql_profiler.limite_lento * 1000,
+            'limite_n1': sql_profiler.limite_n1,
+            'requisicoes': [dict(r, quando=r['quando'].isoformat()) for r in sql_profiler.requisicoes()]
+        })
+
+    @app.route('/imagens/trabalhos/<trabalho_id>')
+    @login_required
+    def status_trabalho_imagem(trabalho_id):
+        """Situação do processamento da foto enviada pelo atleta (trabalhos deste processo)"""
+        status = processamento_imagens.status(trabalho_id)
+        if status is None or status['registro'] != f"Atleta:{current_user.id}":
+            return jsonify({'status': 'desconhecido'}), 404
+        return jsonify(status)
+
     # Custom Jinja2 filters
     @app.template_filter('minio_url')
-    def minio_url_filter(file_path):
-        """Generate MinIO URL for a file path"""
+    def minio_url_filter(file_path, size=None):
+        """Generate MinIO URL for a file path (size: thumb, card or full variant)"""
         if not file_path:
             return None
-        image_service = ImageService()
-        return image_service.get_public_url(file_path)
+        return image_service.get_public_url(file_path, size)
+    
+    @app.template_filter('minio_srcset')
+    def minio_srcset_filter(file_path, fmt='jpg'):
+        """srcset with the image variants in the given format (webp or jpg)"""
+        return image_service.get_srcset(file_path, fmt)
     
     # Context processors for templates
     @app.context_processor
@@ -0,0 +1,163 @@
+"""
+Armazenamento dos objetos de imagem
+
+O ImageService grava, verifica e remove objetos por nome através de um
+backend, escolhido por BTL_IMAGENS_BACKEND:
+
+- minio (padrão): bucket MINIO_BUCKET, URLs públicas em MINIO_PUBLIC_ENDPOINT
+- local: arquivos em BTL_IMAGENS_DIR, servidos pela própria aplicação em
+  BTL_IMAGENS_URL (init_app registra a rota); permite rodar o caminho
+  completo das imagens sem um container MinIO
+
+Os nomes são endereçados pelo conteúdo (services.image_service), então gravar
+o mesmo nome de novo é inofensivo e os objetos nunca mudam depois de gravados.
+"""
+
+import io
+import os
+import tempfile
+import threading
+import urllib3
+from flask import send_from_directory
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class ArmazenamentoMinio:
+    """Objetos em um bucket público do MinIO"""
+
+    POOL_MAXSIZE = 10  # conexões simultâneas com o MinIO por processo
+
+    def __init__(self):
+        self.endpoint = os.environ.get('MINIO_ENDPOINT', 'minio:9000')
+        self.access_key = os.environ.get('MINIO_ACCESS_KEY', 'minioadmin')
+        self.secret_key = os.environ.get('MINIO_SECRET_KEY', 'minioadmin123')
+        self.bucket_name = os.environ.get('MINIO_BUCKET', 'btl-images')
+        self.secure = os.environ.get('MINIO_SECURE', 'False').lower() == 'true'
+
+        # Cliente criado no primeiro uso e recriado se o processo foi bifurcado
+        # (ex.: gunicorn --preload): sockets do pool não podem ser compartilhados
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
+        # For URL generation, use public endpoint if provided, otherwise use configured endpoint
+        public_endpoint = os.environ.get('MINIO_PUBLIC_ENDPOINT', self.endpoint)
+        protocol = 'https' if self.secure else 'http'
+        self.url_base = f"{protocol}://{public_endpoint}/{self.bucket_name}/"
+
+    def init_app(self, app):
+        pass
+
+    @property
+    def client(self):
+        """Cliente MinIO do processo, com pool de conexões compartilhado entre as threads"""
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._client_lock:
+                if self._client is None or self._client_pid != pid:
+                    self._client = Minio(
+                        self.endpoint,
+                        access_key=self.access_key,
+                        secret_key=self.secret_key,
+                        secure=self.secure,
+                        http_client=urllib3.PoolManager(
+                            maxsize=self.POOL_MAXSIZE,
+                            block=False,
+                            timeout=urllib3.Timeout(connect=5, read=60),
+                            retries=urllib3.Retry(
+                                total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+                            )
+                        )
+                    )
+                    self._client_pid = pid
+        return self._client
+
+    def gravar(self, nome, dados, content_type):
+        self.client.put_object(
+            self.bucket_name,
+            nome,
+            io.BytesIO(dados),
+            length=len(dados),
+            content_type=content_type,
+            metadata={'Cache-Control': CACHE_CONTROL}
+        )
+
+    def existe(self, nome):
+        try:
+            self.client.stat_object(self.bucket_name, nome)
+            return True
+        except S3Error as e:
+            if e.code in ('NoSuchKey', 'NoSuchObject'):
+                return False
+            raise
+
+    def remover(self, nomes):
+        erros = list(self.client.remove_objects(self.bucket_name, [DeleteObject(n) for n in nomes]))
+        if erros:
+            raise Exception(erros[0])
+
+class ArmazenamentoLocal:
+    """Objetos como arquivos em um diretório local"""
+
+    def __init__(self):
+        self.diretorio = os.path.abspath(os.environ.get('BTL_IMAGENS_DIR', 'imagens'))
+        self.url_base = os.environ.get('BTL_IMAGENS_URL', '/midia/').rstrip('/') + '/'
+
+    def init_app(self, app):
+        """Serve os arquivos em BTL_IMAGENS_URL (quando é um caminho desta aplicação)"""
+        if not self.url_base.startswith('/'):
+            return
+
+        def servir_imagem(nome):
+            return send_from_directory(self.diretorio, nome, max_age=31536000)
+
+        app.add_url_rule(f"{self.url_base}<path:nome>", 'servir_imagem', servir_imagem)
+
+    def _caminho(self, nome):
+        caminho = os.path.abspath(os.path.join(self.diretorio, nome))
+        if not caminho.startswith(self.diretorio + os.sep):
+            raise ValueError(f"Invalid object name: {nome}")
+        return caminho
+
+    def gravar(self, nome, dados, content_type):
+        caminho = self._caminho(nome)
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Arquivo temporário + rename: leitores nunca veem um arquivo pela metade
+        fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as arquivo:
+                arquivo.write(dados)
+            os.replace(temporario, caminho)
+        except Exception:
+            os.unlink(temporario)
+            raise
+
+    def existe(self, nome):
+        return os.path.isfile(self._caminho(nome))
+
+    def remover(self, nomes):
+        diretorios = set()
+        for nome in nomes:
+            caminho = self._caminho(nome)
+            try:
+                os.unlink(caminho)
+            except FileNotFoundError:
+                pass
+            diretorios.add(os.path.dirname(caminho))
+        for diretorio in diretorios:
+            try:
+                os.rmdir(diretorio)
+            except OSError:
+                pass  # ainda tem arquivos
+
+def criar_armazenamento():
+    """Backend configurado em BTL_IMAGENS_BACKEND (minio ou local)"""
+    backend = os.environ.get('BTL_IMAGENS_BACKEND', 'minio').lower()
+    if backend == 'local':
+        return ArmazenamentoLocal()
+    if backend != 'minio':
+        raise ValueError(f"BTL_IMAGENS_BACKEND inválido: {backend}")
+    return ArmazenamentoMinio()
@@ -0,0 +1,164 @@
+"""
+Busca textual de atletas e backyards
+
+Substitui os filtros ilike('%termo%'), que varrem a tabela inteira, por uma
+busca por palavras com prefixo e sem acentos ("joao silv" encontra
+"João Silva"). Todas as palavras do termo precisam aparecer, em qualquer
+uma das colunas pesquisadas:
+
+- MariaDB/MySQL: índices FULLTEXT (criar_indices_fulltext) consultados com
+  MATCH ... AGAINST em modo booleano ('+joao* +silv*'); a colação do banco
+  já ignora acentos e maiúsculas. Palavras menores que o token mínimo do
+  InnoDB (ex.: UF "SP") não são indexadas e viram LIKE 'sp%' nas colunas
+- demais bancos (SQLite em desenvolvimento): índice invertido em memória,
+  reconstruído quando a assinatura da tabela (COUNT, MAX(id), MAX(data de
+  atualização)) muda, revalidada no máximo a cada TTL_VALIDACAO segundos
+"""
+
+import bisect
+import json
+import re
+import threading
+import time
+import unicodedata
+from sqlalchemy import select, func, column, inspect, text, and_, or_, true, false
+from sqlalchemy.dialects.mysql import match
+from models import db, Atleta, Backyard
+
+MIN_PALAVRA_FULLTEXT = 3  # innodb_ft_min_token_size padrão
+
+def normalizar(texto):
+    """Minúsculas e sem acentos ('João' -> 'joao')"""
+    decomposto = unicodedata.normalize('NFKD', texto or '')
+    return ''.join(c for c in decomposto if not unicodedata.combining(c)).lower()
+
+def palavras(texto):
+    """Palavras normalizadas de um texto, na ordem em que aparecem"""
+    return re.findall(r'\w+', normalizar(texto))
+
+class IndiceInvertido:
+    """Palavra normalizada -> ids, com busca por prefixo na lista ordenada de palavras"""
+
+    def __init__(self, linhas):
+        termos = {}
+        for id, *valores in linhas:
+            for valor in valores:
+                for palavra in palavras(valor):
+                    termos.setdefault(palavra, set()).add(id)
+        self._termos = termos
+        self._ordenadas = sorted(termos)
+
+    def buscar(self, consulta):
+        """Ids que têm, para cada palavra da consulta, alguma palavra começando com ela"""
+        resultado = None
+        for prefixo in set(palavras(consulta)):
+            ids = set()
+            i = bisect.bisect_left(self._ordenadas, prefixo)
+            while i < len(self._ordenadas) and self._ordenadas[i].startswith(prefixo):
+                ids |= self._termos[self._ordenadas[i]]
+                i += 1
+            resultado = ids if resultado is None else resultado & ids
+            if not resultado:
+                break
+        return resultado or set()
+
+class BuscaTextual:
+    """Busca por palavras nas colunas de texto de um modelo"""
+
+    TTL_VALIDACAO = 2.0  # segundos entre consultas da assinatura da tabela
+
+    def __init__(self, modelo, colunas, atualizado_em, nome_indice):
+        self.modelo = modelo
+        self.colunas = colunas
+        self.atualizado_em = atualizado_em
+        self.nome_indice = nome_indice
+        self._lock = threading.Lock()
+        self._construcao = threading.Lock()
+        self._indice = None
+        self._assinatura = None
+        self._validado_em = 0.0
+
+    def filtro(self, termo):
+        """Condição para Query.filter() com as linhas que contêm todas as palavras do termo"""
+        consulta = palavras(termo)
+        if not consulta:
+            return true()
+
+        if _usa_fulltext():
+            return self._filtro_fulltext(consulta)
+
+        ids = self._obter_indice().buscar(termo)
+        if not ids:
+            return false()
+        # Um único parâmetro JSON em vez de um por id (SQLite limita a quantidade de parâmetros)
+        return self.modelo.id.in_(
+            select(column('value')).select_from(func.json_each(json.dumps(sorted(ids))))
+        )
+
+    def _filtro_fulltext(self, consulta):
+        longas = [p for p in consulta if len(p) >= MIN_PALAVRA_FULLTEXT]
+        curtas = [p for p in consulta if len(p) < MIN_PALAVRA_FULLTEXT]
+
+        condicoes = []
+        if longas:
+            condicoes.append(match(
+                *self.colunas, against=' '.join(f'+{p}*' for p in longas)
+            ).in_boolean_mode())
+        for palavra in curtas:
+            condicoes.append(or_(*[c.startswith(palavra, autoescape=True) for c in self.colunas]))
+        return and_(*condicoes)
+
+    def _obter_indice(self):
+        agora = time.monotonic()
+        with self._lock:
+            if self._indice is not None and agora - self._validado_em < self.TTL_VALIDACAO:
+                return self._indice
+
+        assinatura = tuple(db.session.query(
+            func.count(self.modelo.id), func.max(self.modelo.id), func.max(self.atualizado_em)
+        ).one())
+
+        with self._construcao:
+            with self._lock:
+                if self._indice is not None and self._assinatura == assinatura:
+                    self._validado_em = agora
+                    return self._indice
+
+            indice = IndiceInvertido(db.session.query(self.modelo.id, *self.colunas).yield_per(5000))
+            with self._lock:
+                self._indice = indice
+                self._assinatura = assinatura
+                self._validado_em = agora
+            return indice
+
+def _usa_fulltext():
+    return db.engine.dialect.name in ('mysql', 'mariadb')
+
+def criar_indices_fulltext(engine):
+    """Cria os índices FULLTEXT que ainda não existem (apenas MariaDB/MySQL)"""
+    if engine.dialect.name not in ('mysql', 'mariadb'):
+        return
+    inspector = inspect(engine)
+    for busca in (busca_atletas, busca_backyards):
+        tabela = busca.modelo.__tablename__
+        existentes = {i['name'] for i in inspector.get_indexes(tabela)}
+        if busca.nome_indice in existentes:
+            continue
+        print(f"Creating fulltext index {busca.nome_indice}...")
+        colunas = ', '.join(c.name for c in busca.colunas)
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {tabela} ADD FULLTEXT INDEX {busca.nome_indice} ({colunas})"))
+
+# Instâncias globais: colunas de cada busca (a ordem precisa ser a mesma do índice FULLTEXT)
+busca_atletas = BuscaTextual(
+    Atleta,
+    [Atleta.nome, Atleta.email, Atleta.cpf, Atleta.cidade, Atleta.estado],
+    Atleta.atualizado_em,
+    'ft_atletas_busca'
+)
+busca_backyards = BuscaTextual(
+    Backyard,
+    [Backyard.nome, Backyard.cidade, Backyard.estado, Backyard.descricao],
+    Backyard.data_ultima_atualizacao,
+    'ft_backyards_busca'
+)
@@ -0,0 +1,60 @@
+"""
+Facetas do catálogo público de backyards
+
+Contagens por status, cidade e estado das backyards públicas, calculadas em
+uma única consulta agregada (GROUP BY status, cidade, estado) e reutilizadas
+enquanto a versão do catálogo (page_cache.versao_catalogo) não mudar.
+"""
+
+import threading
+from sqlalchemy import func
+from models import db, Backyard, BackyardStatus
+from services.page_cache import page_cache
+
+# Status exibidos no catálogo público
+STATUS_PUBLICOS = [BackyardStatus.ATIVO, BackyardStatus.PREPARACAO, BackyardStatus.FINALIZADO]
+
+class FacetasCatalogo:
+    """Contagens por status, cidade e estado, revalidadas pela versão do catálogo"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versao = None
+        self._facetas = None
+
+    def obter(self):
+        """{'status': {valor: total}, 'cidade': {...}, 'estado': {...}}"""
+        versao = page_cache.versao_catalogo()
+        with self._lock:
+            if self._facetas is not None and self._versao == versao:
+                return self._facetas
+
+        facetas = _calcular()
+        with self._lock:
+            self._versao = versao
+            self._facetas = facetas
+        return facetas
+
+def _calcular():
+    linhas = db.session.query(
+        Backyard.status, Backyard.cidade, Backyard.estado, func.count(Backyard.id)
+    ).filter(
+        Backyard.status.in_(STATUS_PUBLICOS)
+    ).group_by(Backyard.status, Backyard.cidade, Backyard.estado).all()
+
+    status, cidades, estados = {}, {}, {}
+    for situacao, cidade, estado, total in linhas:
+        status[situacao.value] = status.get(situacao.value, 0) + total
+        if cidade:
+            cidades[cidade] = cidades.get(cidade, 0) + total
+        if estado:
+            estados[estado] = estados.get(estado, 0) + total
+
+    return {
+        'status': status,
+        'cidade': dict(sorted(cidades.items())),
+        'estado': dict(sorted(estados.items())),
+    }
+
+# Instância global das facetas do catálogo
+facetas_catalogo = FacetasCatalogo()
@@ -0,0 +1,91 @@
+"""
+Estatísticas das corridas
+
+Contadores por loop e por backyard calculados com agregação condicional
+(COUNT + SUM(CASE ...)) em uma única consulta. Usados pela tela de controle,
+pela tela do loop, pelos detalhes da backyard e pela página ao vivo, para que
+todas exibam os mesmos números.
+"""
+
+from sqlalchemy import func, case
+from models import db, Loop, AtletaLoop, AtletaBackyard, AtletaLoopStatus
+
+STATUS_ELIMINACAO = (AtletaLoopStatus.ELIMINADO, AtletaLoopStatus.DNF, AtletaLoopStatus.DNS)
+
+class ContagemLoop:
+    """Participantes de um loop por situação"""
+
+    def __init__(self, total=0, ativos=0, concluidos=0, eliminados=0):
+        # SUM de um grupo vazio retorna NULL
+        self.total = total or 0
+        self.ativos = ativos or 0
+        self.concluidos = concluidos or 0
+        self.eliminados = eliminados or 0
+
+    def registrar_mudanca(self, status_anterior, status_novo):
+        """Atualiza os contadores quando um participante muda de situação"""
+        for status, delta in ((status_anterior, -1), (status_novo, 1)):
+            if status == AtletaLoopStatus.ATIVO:
+                self.ativos += delta
+            elif status == AtletaLoopStatus.CONCLUIDO:
+                self.concluidos += delta
+            elif status in STATUS_ELIMINACAO:
+                self.eliminados += delta
+
+    def para_dict(self):
+        return {
+            'total': self.total,
+            'ativos': self.ativos,
+            'concluidos': self.concluidos,
+            'eliminados': self.eliminados
+        }
+
+class ContagemInscricoes:
+    """Inscrições de uma backyard e cobertura dos números de peito"""
+
+    def __init__(self, total=0, com_numero=0):
+        self.total = total or 0
+        self.com_numero = com_numero or 0
+
+    @property
+    def sem_numero(self):
+        return self.total - self.com_numero
+
+def _colunas_loop():
+    """Colunas agregadas de AtletaLoop, na ordem dos argumentos de ContagemLoop"""
+    return (
+        func.count(AtletaLoop.id),
+        func.sum(case((AtletaLoop.status == AtletaLoopStatus.ATIVO, 1), else_=0)),
+        func.sum(case((AtletaLoop.status == AtletaLoopStatus.CONCLUIDO, 1), else_=0)),
+        func.sum(case((AtletaLoop.status.in_(STATUS_ELIMINACAO), 1), else_=0))
+    )
+
+def estatisticas_loops(backyard_id):
+    """Lista de (Loop, ContagemLoop) da backyard em ordem crescente de número"""
+    linhas = db.session.query(Loop, *_colunas_loop()).outerjoin(
+        AtletaLoop, AtletaLoop.loop_id == Loop.id
+    ).filter(
+        Loop.backyard_id == backyard_id
+    ).group_by(Loop.id).order_by(Loop.numero_loop).all()
+    return [(linha[0], ContagemLoop(*linha[1:])) for linha in linhas]
+
+def estatisticas_loop(loop_id):
+    """ContagemLoop de um único loop"""
+    linha = db.session.query(*_colunas_loop()).filter(AtletaLoop.loop_id == loop_id).one()
+    return ContagemLoop(*linha)
+
+def contar_participantes(atleta_loops):
+    """ContagemLoop de AtletaLoops já carregados (sem consulta), com os mesmos critérios de estatisticas_loop"""
+    contagem = ContagemLoop()
+    for atleta_loop in atleta_loops:
+        contagem.total += 1
+        contagem.registrar_mudanca(None, atleta_loop.status)  # entra sem situação anterior
+    return contagem
+
+def estatisticas_inscricoes(backyard_id):
+    """ContagemInscricoes da backyard"""
+    linha = db.session.query(
+        func.count(AtletaBackyard.id),
+        func.sum(case((AtletaBackyard.numero_peito.isnot(None), 1), else_=0))
+    ).filter(AtletaBackyard.backyard_id == backyard_id).one()
+    return ContagemInscricoes(*linha)
@@ -0,0 +1,205 @@
+"""
+Transmissão ao vivo (Server-Sent Events) das backyards em andamento
+
+Uma única thread por processo lê Backyard.versao_dados das backyards com
+espectadores conectados. Quando a versão muda, o RaceState é reconstruído,
+comparado com o último estado publicado e apenas as diferenças (atleta
+chegou, atleta eliminado, loop iniciado, vencedor) são enviadas às filas
+dos espectadores, já serializadas no formato SSE.
+"""
+
+import json
+import queue
+import threading
+from models import db, Backyard, BackyardStatus, AtletaLoopStatus
+from services.race_state import race_states, STATUS_ELIMINACAO
+
+def formatar_evento(tipo, dados, versao=None):
+    """Serializa um evento no formato text/event-stream"""
+    linhas = []
+    if versao is not None:
+        linhas.append(f"id: {versao}")
+    linhas.append(f"event: {tipo}")
+    linhas.append(f"data: {json.dumps(dados, ensure_ascii=False)}")
+    return "\n".join(linhas) + "\n\n"
+
+class Retrato:
+    """Resumo de um RaceState usado para calcular as diferenças entre versões"""
+
+    def __init__(self, estado):
+        self.versao = estado.versao
+        self.backyard_status = estado.backyard.status
+        loop = estado.loop_atual
+        self.loop = (loop.id, loop.status, loop.data_inicio) if loop else None
+        self.corredores = dict(
+            (corredor.id, (corredor.status, corredor.tempo_total_segundos, corredor.observacoes))
+            for corredor in estado.corredores.values()
+        )
+
+class LiveBroadcaster:
+    """Distribui as alterações das corridas para os espectadores conectados"""
+
+    INTERVALO = 1.0        # segundos entre leituras de versao_dados
+    KEEPALIVE = 15         # segundos sem eventos até enviar um comentário de keepalive
+    TAMANHO_FILA = 256     # eventos pendentes por espectador antes de forçar recarga
+
+    def __init__(self):
+        self.app = None
+        self.thread = None
+        self._lock = threading.Lock()
+        self._assinantes = {}   # backyard_id -> set(queue.Queue)
+        self._retratos = {}     # backyard_id -> Retrato publicado
+        self._parar = threading.Event()
+
+    def init_app(self, app):
+        """Inicializa o broadcaster com a aplicação Flask"""
+        self.app = app
+
+    def assinar(self, backyard_id):
+        """Registra um espectador; retorna (fila, versão publicada) ou (None, None)"""
+        with self._lock:
+            retrato = self._retratos.get(backyard_id)
+
+        if retrato is None:
+            estado = race_states.obter(backyard_id)
+            if estado is None:
+                return None, None
+            retrato = Retrato(estado)
+
+        fila = queue.Queue(maxsize=self.TAMANHO_FILA)
+        with self._lock:
+            retrato = self._retratos.setdefault(backyard_id, retrato)
+            self._assinantes.setdefault(backyard_id, set()).add(fila)
+            if self.thread is None:
+                self._parar.clear()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return fila, retrato.versao
+
+    def cancelar(self, backyard_id, fila):
+        """Remove um espectador (conexão encerrada)"""
+        with self._lock:
+            assinantes = self._assinantes.get(backyard_id)
+            if assinantes is None:
+                return
+            assinantes.discard(fila)
+            if not assinantes:
+                # Sem espectadores o retrato deixa de ser acompanhado e fica obsoleto
+                del self._assinantes[backyard_id]
+                self._retratos.pop(backyard_id, None)
+
+    def status(self):
+        """Retorna o número de espectadores conectados por backyard"""
+        with self._lock:
+            return dict((backyard_id, len(filas)) for backyard_id, filas in self._assinantes.items())
+
+    def stop(self):
+        """Para a thread de leitura"""
+        self._parar.set()
+
+    def _run(self):
+        """Loop principal: uma consulta de versões por intervalo, para todas as backyards"""
+        while not self._parar.wait(self.INTERVALO):
+            with self._lock:
+                backyard_ids = list(self._assinantes)
+                if not backyard_ids:
+                    self.thread = None
+                    return
+
+            try:
+                with self.app.app_context():
+                    versoes = dict(db.session.query(Backyard.id, Backyard.versao_dados).filter(
+                        Backyard.id.in_(backyard_ids)
+                    ).all())
+
+                    for backyard_id in backyard_ids:
+                        with self._lock:
+                            anterior = self._retratos.get(backyard_id)
+                        if anterior is None or versoes.get(backyard_id, anterior.versao) == anterior.versao:
+                            continue
+                        self._publicar(backyard_id, anterior)
+
+            except Exception as e:
+                print(f"ERRO na transmissão ao vivo: {str(e)}")
+
+    def _publicar(self, backyard_id, anterior):
+        """Reconstrói o estado, calcula as diferenças e as envia aos espectadores"""
+        race_states.invalidar(backyard_id)
+        estado = race_states.obter(backyard_id)
+        if estado is None:
+            self._enviar(backyard_id, [formatar_evento('recarregar', {})])
+            return
+
+        atual = Retrato(estado)
+        eventos = [formatar_evento(tipo, dados, atual.versao) for tipo, dados in self._diferencas(anterior, atual, estado)]
+
+        with self._lock:
+            if backyard_id in self._retratos:
+                self._retratos[backyard_id] = atual
+        self._enviar(backyard_id, eventos)
+
+    def _diferencas(self, anterior, atual, estado):
+        """Lista de (tipo, dados) entre dois retratos consecutivos"""
+        eventos = []
+        loop = estado.loop_atual
+
+        if atual.loop != anterior.loop:
+            eventos.append(('loop', {
+                'id': loop.id,
+                'numero_loop': loop.numero_loop,
+                'status': loop.status.value,
+                'data_inicio': loop.data_inicio.isoformat() if loop.data_inicio else None,
+                'distancia_km': loop.distancia_km,
+                'tempo_limite': loop.tempo_limite
+            } if loop else None))
+
+        # Em um loop novo os corredores são outros: o cliente recarrega a página
+        mesmo_loop = anterior.loop is not None and atual.loop is not None and anterior.loop[0] == atual.loop[0]
+        if mesmo_loop:
+            for atleta_loop_id, dados in atual.corredores.items():
+                if anterior.corredores.get(atleta_loop_id) == dados:
+                    continue
+                corredor = estado.corredores[atleta_loop_id]
+                eventos.append(('atleta', {
+                    'id': corredor.id,
+                    'nome': corredor.nome,
+                    'numero_peito': corredor.numero_peito,
+                    'numero_loop': corredor.numero_loop,
+                    'status': corredor.status.value,
+                    'eliminado': corredor.status in STATUS_ELIMINACAO,
+                    'tempo_total_segundos': corredor.tempo_total_segundos,
+                    'tempo_formatado': corredor.get_tempo_formatado(),
+                    'observacoes': corredor.observacoes
+                }))
+
+        eventos.append(('stats', estado.estatisticas()))
+
+        if atual.backyard_status != anterior.backyard_status and atual.backyard_status == BackyardStatus.FINALIZADO:
+            # Loop solo concluído: o único corredor que chegou é o campeão
+            ultimo_loop = estado.loop_corrente
+            vencedor = None
+            if ultimo_loop and ultimo_loop.total_atletas == 1:
+                vencedor = next((c.nome for c in estado.corredores.values()
+                                 if c.status == AtletaLoopStatus.CONCLUIDO), None)
+            # Primeiro da lista: o cliente encerra a transmissão em vez de recarregar
+            eventos.insert(0, ('fim', {'vencedor': vencedor}))
+
+        return eventos
+
+    def _enviar(self, backyard_id, eventos):
+        """Entrega os eventos já serializados a todas as filas da backyard"""
+        with self._lock:
+            filas = list(self._assinantes.get(backyard_id, ()))
+
+        for fila in filas:
+            try:
+                for evento in eventos:
+                    fila.put_nowait(evento)
+            except queue.Full:
+                # Espectador lento: descarta o que está pendente e pede recarga completa
+                with fila.mutex:
+                    fila.queue.clear()
+                fila.put_nowait(formatar_evento('recarregar', {}))
+
+# Instância global do broadcaster
+live_broadcaster = LiveBroadcaster()
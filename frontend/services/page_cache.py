@@ -0,0 +1,141 @@
+"""
+Cache de páginas públicas renderizadas
+
+Guarda o HTML das páginas públicas (home, lista e detalhes de backyards)
+para visitantes anônimos, indexado por rota, argumentos e versão dos dados:
+
+- página de uma backyard: Backyard.versao_dados
+- home e lista: versão do catálogo, (COUNT(*), MAX(id), SUM(versao_dados))
+  de backyards, que muda a cada backyard criada, removida ou alterada
+- páginas que dependem da data (home: próximos eventos) também pela data
+  corrente (em_cache(..., por_dia=True)), já que a virada do dia não altera
+  nenhuma versão
+
+As versões são revalidadas no banco no máximo a cada TTL_VALIDACAO
+segundos, então um pico de acessos anônimos é servido da memória. Atletas
+logados (botão de inscrição, menu do perfil) e requisições com mensagens
+flash pendentes não usam o cache, e views que caem em uma página de erro
+(ex.: lista vazia quando o banco falha) chamam nao_guardar() para que ela
+não fique em cache depois que o banco voltar.
+"""
+
+import threading
+import time
+from datetime import date
+from collections import OrderedDict
+from functools import wraps
+from flask import g, request, session, make_response
+from flask_login import current_user
+from sqlalchemy import func
+from models import db, Backyard
+
+class PageCache:
+    """Páginas renderizadas por (endpoint, argumentos, versão dos dados)"""
+
+    TTL_VALIDACAO = 2.0   # segundos entre consultas de versão
+    MAX_PAGINAS = 512     # páginas guardadas (LRU); argumentos arbitrários não esgotam a memória
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paginas = OrderedDict()  # chave -> (versão, corpo, mimetype)
+        self._versoes = {}             # chave de versão -> (validado_em, versão)
+
+    def versao_catalogo(self):
+        """Versão do conjunto de backyards (home e lista)"""
+        return self._versao('catalogo', lambda: tuple(db.session.query(
+            func.count(Backyard.id),
+            func.max(Backyard.id),
+            func.coalesce(func.sum(Backyard.versao_dados), 0)
+        ).one()))
+
+    def versao_backyard(self, backyard_id):
+        """Versão dos dados de uma backyard (None se não existe)"""
+        return self._versao(('backyard', backyard_id), lambda: db.session.query(
+            Backyard.versao_dados
+        ).filter(Backyard.id == backyard_id).scalar())
+
+    def obter(self, chave, versao):
+        with self._lock:
+            pagina = self._paginas.get(chave)
+            if pagina is None or pagina[0] != versao:
+                return None
+            self._paginas.move_to_end(chave)
+            return pagina
+
+    def guardar(self, chave, versao, corpo, mimetype):
+        with self._lock:
+            self._paginas[chave] = (versao, corpo, mimetype)
+            self._paginas.move_to_end(chave)
+            while len(self._paginas) > self.MAX_PAGINAS:
+                self._paginas.popitem(last=False)
+
+    def limpar(self):
+        with self._lock:
+            self._paginas.clear()
+            self._versoes.clear()
+
+    def _versao(self, chave, consultar):
+        agora = time.monotonic()
+        with self._lock:
+            entrada = self._versoes.get(chave)
+        if entrada is not None and agora - entrada[0] < self.TTL_VALIDACAO:
+            return entrada[1]
+
+        versao = consultar()
+        with self._lock:
+            self._versoes[chave] = (agora, versao)
+        return versao
+
+def nao_guardar():
+    """A resposta da requisição corrente não deve ser guardada (ex.: página de fallback de erro)"""
+    g.btl_sem_cache = True
+
+def _cacheavel():
+    """Apenas GET anônimo, sem mensagens flash esperando para serem exibidas"""
+    return (request.method == 'GET'
+            and not current_user.is_authenticated
+            and '_flashes' not in session)
+
+def em_cache(obter_versao, por_dia=False):
+    """
+    Decorator: serve a página do cache para visitantes anônimos
+
+    obter_versao recebe os argumentos da rota e retorna a versão dos dados
+    exibidos (None desativa o cache para a requisição). Com por_dia=True a
+    página guardada vale apenas até o fim do dia.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not _cacheavel():
+                return f(*args, **kwargs)
+
+            versao = obter_versao(**kwargs)
+            if versao is None:
+                return f(*args, **kwargs)
+
+            chave = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                date.today() if por_dia else None
+            )
+            pagina = page_cache.obter(chave, versao)
+            if pagina is not None:
+                resposta = make_response(pagina[1])
+                resposta.mimetype = pagina[2]
+                resposta.headers['X-Page-Cache'] = 'HIT'
+                return resposta
+
+            resposta = make_response(f(*args, **kwargs))
+            # Erros, redirecionamentos e respostas que alteram a sessão não são guardados
+            if (resposta.status_code == 200 and not resposta.direct_passthrough
+                    and not session.modified and not g.get('btl_sem_cache')):
+                page_cache.guardar(chave, versao, resposta.get_data(), resposta.mimetype)
+                resposta.headers['X-Page-Cache'] = 'MISS'
+            return resposta
+        return decorated_function
+    return decorator
+
+# Instância global do cache de páginas
+page_cache = PageCache()
@@ -0,0 +1,110 @@
+"""
+Leituras do frontend na réplica do banco
+
+Views marcadas com @somente_leitura (páginas de espectadores) fazem suas
+consultas na réplica (SQLALCHEMY_BINDS['replica']), deixando o primário para
+as gravações de tempo do curral. Continuam no primário:
+
+- flush e comandos de escrita (INSERT/UPDATE/DELETE), mesmo dentro dessas views
+- visitantes que gravaram algo há menos de `fixacao` segundos: o cookie de
+  sessão guarda até quando ler do primário, então o redirect depois de uma
+  inscrição já mostra a inscrição
+- tudo, enquanto a réplica estiver atrasada mais que `atraso_maximo` segundos
+  (Seconds_Behind_Master, verificado no máximo a cada INTERVALO segundos) ou
+  inacessível
+
+Em outros bancos (ex.: dois arquivos SQLite em desenvolvimento) não há como
+medir o atraso e a réplica é considerada em dia.
+"""
+
+import threading
+import time
+from functools import wraps
+from flask import g, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.sql.dml import UpdateBase
+
+CHAVE_SESSAO = '_primario_ate'
+
+class SessaoRoteada(Session):
+    """Sessão que envia as leituras das views somente leitura para a réplica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            escrita = self._flushing or isinstance(clause, UpdateBase)
+            if escrita:
+                g.btl_escreveu = True
+            elif g.get('btl_somente_leitura') and not g.get('btl_escreveu'):
+                replica = self._db.engines.get('replica')
+                if replica is not None and roteador_replica.em_dia(replica):
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class RoteadorReplica:
+    """Limite de atraso da réplica e fixação no primário após escritas"""
+
+    INTERVALO = 5.0  # segundos entre verificações do atraso
+
+    def __init__(self):
+        self.atraso_maximo = 5.0
+        self.fixacao = 10.0
+        self.atraso = None  # último atraso medido (None: réplica indisponível)
+        self._verificado_em = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.atraso_maximo = float(app.config.get('BTL_REPLICA_ATRASO_MAXIMO', self.atraso_maximo))
+        # Por padrão a fixação cobre o atraso máximo aceito mais o intervalo de verificação
+        self.fixacao = float(app.config.get('BTL_REPLICA_FIXACAO', self.atraso_maximo + self.INTERVALO))
+
+        @app.after_request
+        def fixar_no_primario(resposta):
+            if g.get('btl_escreveu'):
+                session[CHAVE_SESSAO] = time.time() + self.fixacao
+            return resposta
+
+    def em_dia(self, engine):
+        """True se a réplica responde e está dentro do atraso máximo"""
+        agora = time.monotonic()
+        with self._lock:
+            if self._verificado_em is not None and agora - self._verificado_em < self.INTERVALO:
+                return self.atraso is not None and self.atraso <= self.atraso_maximo
+            # Demais threads usam o resultado anterior enquanto esta verifica
+            self._verificado_em = agora
+
+        atraso = _medir_atraso(engine)
+        with self._lock:
+            self.atraso = atraso
+        if atraso is None or atraso > self.atraso_maximo:
+            print(f"REPLICA: leituras no primário (atraso: {atraso})")
+        return atraso is not None and atraso <= self.atraso_maximo
+
+def _medir_atraso(engine):
+    """Atraso da réplica em segundos (0 se não é possível medir, None se inacessível)"""
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name not in ('mysql', 'mariadb'):
+                conn.execute(text('SELECT 1'))
+                return 0.0
+            status = conn.execute(text('SHOW SLAVE STATUS')).mappings().first()
+    except Exception as e:
+        print(f"REPLICA: erro ao verificar atraso: {e}")
+        return None
+
+    if status is None:
+        # Servidor sem replicação configurada (ex.: segunda instância local)
+        return 0.0
+    atraso = status.get('Seconds_Behind_Master')
+    return float(atraso) if atraso is not None else None
+
+def somente_leitura(f):
+    """Decorator: consultas da view vão para a réplica (se configurada e em dia)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.btl_somente_leitura = session.get(CHAVE_SESSAO, 0) < time.time()
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Instância global do roteador de réplica
+roteador_replica = RoteadorReplica()
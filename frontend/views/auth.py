@@ -9,7 +9,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime
 from models import db, Atleta
 from services.password_service import PasswordService
-from services.image_service import ImageService
+from services.processamento_imagens import processamento_imagens
 
 # Create blueprint
 auth_bp = Blueprint('auth', __name__)
@@ -101,26 +101,6 @@ def register():
                     flash('Data de nascimento inválida.', 'danger')
                     return render_template('auth/register.html')
             
-            # Handle profile image upload (optional)
-            imagem_perfil = None
-            if 'imagem_perfil' in request.files:
-                file = request.files['imagem_perfil']
-                if file and file.filename:
-                    try:
-                        image_service = ImageService()
-                        upload_result = image_service.upload_image(
-                            file, 
-                            image_type='profile_picture',
-                            folder='atletas'
-                        )
-                        if upload_result['success']:
-                            imagem_perfil = upload_result['file_path']
-                        else:
-                            for error in upload_result.get('errors', []):
-                                flash(f'Erro no upload da imagem: {error}', 'warning')
-                    except Exception as e:
-                        flash('Erro ao fazer upload da imagem. Continuando sem imagem.', 'warning')
-            
             # Create new atleta
             atleta = Atleta(
                 nome=nome,
@@ -132,13 +112,25 @@ def register():
                 endereco=endereco if endereco else None,
                 cidade=cidade if cidade else None,
                 estado=estado if estado else None,
-                pais=pais,
-                imagem_perfil=imagem_perfil
+                pais=pais
             )
             
             db.session.add(atleta)
             db.session.commit()
             
+            # Handle profile image upload (optional, processed in background)
+            file = request.files.get('imagem_perfil')
+            if file and file.filename:
+                upload_result = processamento_imagens.enviar_arquivo(
+                    file,
+                    atleta,
+                    'imagem_perfil',
+                    image_type='profile_picture'
+                )
+                if not upload_result['success']:
+                    for error in upload_result.get('errors', []):
+                        flash(f'Erro no upload da imagem: {error}', 'warning')
+            
             flash('Cadastro realizado com sucesso! Você já pode fazer login.', 'success')
             return redirect(url_for('auth.login'))
             
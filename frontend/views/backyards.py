@@ -3,83 +3,143 @@ BTL Frontend - Backyards Views
 Views para listagem e visualização de backyards públicas
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, Response, jsonify
 from flask_login import login_required, current_user
 from datetime import datetime
-from models import db, Backyard, BackyardStatus, AtletaBackyard, Loop, LoopStatus, AtletaLoop, AtletaLoopStatus
-from sqlalchemy import desc, asc
+from models import db, Backyard, BackyardStatus, Atleta, AtletaBackyard, Loop, AtletaLoop, AtletaLoopStatus
+from sqlalchemy import desc, and_, func, case
+from services.race_state import race_states, Corredor
+from services.live_stream import live_broadcaster, formatar_evento
+from services.page_cache import em_cache, page_cache, nao_guardar
+from services.replica import somente_leitura
+from services.busca import busca_backyards
+from services.paginacao import paginar
+from services.catalogo import facetas_catalogo, STATUS_PUBLICOS
+import json
+import queue
 
 # Create blueprint
 backyards_bp = Blueprint('backyards', __name__)
 
+# Itens por página do catálogo público (as seguintes são carregadas sob demanda)
+POR_PAGINA = 12
+
+# Chaves de ordenação para backyards sem data (depois de todas as datadas)
+DATA_MINIMA = datetime(1000, 1, 1)
+DATA_MAXIMA = datetime(9999, 12, 31)
+
 @backyards_bp.route('/')
+@somente_leitura
+@em_cache(page_cache.versao_catalogo)
 def list_backyards():
-    """Lista pública de backyards"""
+    """Lista pública de backyards (primeira página; as demais vêm de feed_backyards)"""
+    filtros = _filtros_catalogo()
     try:
-        # Parâmetros de filtro
-        status_filter = request.args.get('status', '')
-        cidade_filter = request.args.get('cidade', '')
-        search = request.args.get('search', '')
-        
-        # Base query - backyards públicas (ativas, em preparação e finalizadas)
-        query = Backyard.query.filter(
-            Backyard.status.in_([BackyardStatus.ATIVO, BackyardStatus.PREPARACAO, BackyardStatus.FINALIZADO])
-        )
-        
-        # Aplicar filtros
-        if status_filter:
-            query = query.filter(Backyard.status == BackyardStatus(status_filter))
-        
-        if cidade_filter:
-            query = query.filter(Backyard.cidade.ilike(f'%{cidade_filter}%'))
-        
-        if search:
-            query = query.filter(
-                Backyard.nome.ilike(f'%{search}%') |
-                Backyard.cidade.ilike(f'%{search}%') |
-                Backyard.estado.ilike(f'%{search}%')
-            )
-        
-        # Ordenação: ativos primeiro, depois em preparação, depois finalizados
-        if status_filter == 'FINALIZADO':
-            # Para finalizados: mais recentes primeiro
-            backyards = query.order_by(
-                desc(Backyard.data_evento),
-                desc(Backyard.data_criacao)
-            ).all()
-        else:
-            # Para ativos e preparação: prioridade por status, depois por data
-            backyards = query.order_by(
-                (Backyard.status == BackyardStatus.ATIVO).desc(),
-                (Backyard.status == BackyardStatus.PREPARACAO).desc(),
-                asc(Backyard.data_evento),
-                desc(Backyard.data_criacao)
-            ).all()
-        
-        # Buscar cidades para filtro
-        cidades = db.session.query(Backyard.cidade).distinct().filter(
-            Backyard.cidade.isnot(None),
-            Backyard.status.in_([BackyardStatus.ATIVO, BackyardStatus.PREPARACAO, BackyardStatus.FINALIZADO])
-        ).order_by(Backyard.cidade).all()
-        cidades = [c[0] for c in cidades if c[0]]
+        pagina = _pagina_catalogo(filtros)
+        facetas = facetas_catalogo.obter()
         
         return render_template('backyards/list.html', 
-                             backyards=backyards,
-                             cidades=cidades,
-                             status_filter=status_filter,
-                             cidade_filter=cidade_filter,
-                             search=search)
+                             backyards=pagina.items,
+                             proximo=pagina.next_cursor,
+                             facetas=facetas,
+                             status_filter=filtros['status'],
+                             cidade_filter=filtros['cidade'],
+                             estado_filter=filtros['estado'],
+                             search=filtros['search'])
     
     except Exception as e:
         print(f"Erro ao listar backyards: {e}")
+        nao_guardar()
         return render_template('backyards/list.html', 
                              backyards=[],
-                             cidades=[],
+                             proximo=None,
+                             facetas={'status': {}, 'cidade': {}, 'estado': {}},
                              status_filter='',
                              cidade_filter='',
+                             estado_filter='',
                              search='')
 
+@backyards_bp.route('/feed.json')
+@somente_leitura
+@em_cache(page_cache.versao_catalogo)
+def feed_backyards():
+    """Página seguinte do catálogo em JSON (cursor em ?apos=), com facetas e HTML dos cards"""
+    filtros = _filtros_catalogo()
+    pagina = _pagina_catalogo(filtros, request.args.get('apos'))
+    
+    itens = [{
+        'id': backyard.id,
+        'nome': backyard.nome,
+        'cidade': backyard.cidade,
+        'estado': backyard.estado,
+        'status': backyard.status.value,
+        'data_evento': backyard.data_evento.isoformat() if backyard.data_evento else None,
+        'capacidade': backyard.capacidade,
+        'total_inscritos': total_inscritos,
+        'url': url_for('backyards.view_backyard', id=backyard.id),
+    } for backyard, total_inscritos in pagina.items]
+    
+    return jsonify({
+        'itens': itens,
+        'html': render_template('backyards/cards.html', backyards=pagina.items),
+        'proximo': pagina.next_cursor,
+        'facetas': facetas_catalogo.obter(),
+    })
+
+def _filtros_catalogo():
+    """Filtros da URL; status inválido é ignorado"""
+    status = request.args.get('status', '')
+    if status not in BackyardStatus.__members__:
+        status = ''
+    return {
+        'status': status,
+        'cidade': request.args.get('cidade', ''),
+        'estado': request.args.get('estado', ''),
+        'search': request.args.get('search', ''),
+    }
+
+def _pagina_catalogo(filtros, apos=None):
+    """Página do catálogo com o total de inscritos de cada backyard (keyset, sem OFFSET)"""
+    # Base query - backyards públicas (ativas, em preparação e finalizadas)
+    query = db.session.query(Backyard).filter(Backyard.status.in_(STATUS_PUBLICOS))
+    
+    # Aplicar filtros (cidade e estado vêm das facetas, comparação exata)
+    if filtros['status']:
+        query = query.filter(Backyard.status == BackyardStatus(filtros['status']))
+    
+    if filtros['cidade']:
+        query = query.filter(Backyard.cidade == filtros['cidade'])
+    
+    if filtros['estado']:
+        query = query.filter(Backyard.estado == filtros['estado'])
+    
+    if filtros['search']:
+        query = query.filter(busca_backyards.filtro(filtros['search']))
+    
+    total_inscritos = db.session.query(func.count(AtletaBackyard.id)).filter(
+        AtletaBackyard.backyard_id == Backyard.id
+    ).correlate(Backyard).scalar_subquery().label('total_inscritos')
+    
+    if filtros['status'] == 'FINALIZADO':
+        # Para finalizados: mais recentes primeiro
+        chaves = [
+            (func.coalesce(Backyard.data_evento, DATA_MINIMA), True),
+            (Backyard.id, True),
+        ]
+    else:
+        # Para ativos e preparação: prioridade por status, depois por data
+        chaves = [
+            (case((Backyard.status == BackyardStatus.ATIVO, 0),
+                  (Backyard.status == BackyardStatus.PREPARACAO, 1), else_=2), False),
+            (func.coalesce(Backyard.data_evento, DATA_MAXIMA), False),
+            (Backyard.id, False),
+        ]
+    
+    return paginar(query.add_columns(total_inscritos), chaves, POR_PAGINA, apos=apos)
+
 @backyards_bp.route('/<int:id>')
+@somente_leitura
+@em_cache(lambda id: page_cache.versao_backyard(id))
 def view_backyard(id):
     """Visualizar detalhes de uma backyard"""
     try:
@@ -161,6 +221,7 @@ def inscrever(id):
         # Número de peito será atribuído posteriormente pelo administrador via backoffice
         
         db.session.add(inscricao)
+        Backyard.registrar_alteracao(backyard.id)
         db.session.commit()
         
         flash('Inscrição realizada com sucesso! O número de peito será atribuído pelo organizador.', 'success')
@@ -195,6 +256,7 @@ def cancelar_inscricao(id):
             return redirect(url_for('backyards.view_backyard', id=id))
         
         db.session.delete(inscricao)
+        Backyard.registrar_alteracao(backyard.id)
         db.session.commit()
         
         flash('Inscrição cancelada com sucesso.', 'info')
@@ -207,66 +269,43 @@ def cancelar_inscricao(id):
         return redirect(url_for('backyards.view_backyard', id=id))
 
 @backyards_bp.route('/<int:id>/live')
+@somente_leitura
 def live_view(id):
     """Visualização em tempo real de uma backyard ativa"""
     try:
-        backyard = Backyard.query.get_or_404(id)
+        # Estado da corrida servido da memória (RaceState), revalidado pela versão da backyard
+        estado = race_states.obter(id)
+        if estado is None:
+            abort(404)
+        backyard = estado.backyard
         
         # Verificar se a backyard está ativa
         if backyard.status != BackyardStatus.ATIVO:
             flash('Esta backyard não está ativa no momento.', 'warning')
             return redirect(url_for('backyards.view_backyard', id=id))
         
-        # Buscar loop atual (último loop ativo ou em preparação)
-        loop_atual = Loop.query.filter_by(backyard_id=id).filter(
-            Loop.status.in_([LoopStatus.ATIVO, LoopStatus.PREPARACAO])
-        ).order_by(desc(Loop.numero_loop)).first()
-        
-        # Buscar todos os loops da backyard para histórico
-        loops_historico = Loop.query.filter_by(backyard_id=id).order_by(
-            desc(Loop.numero_loop)
-        ).all()
-        
-        # Estatísticas gerais
-        total_inscritos = AtletaBackyard.query.filter_by(backyard_id=id).count()
+        # Loop atual (último loop ativo ou em preparação) e histórico, do mais recente ao mais antigo
+        loop_atual = estado.loop_atual
+        loops_historico = list(reversed(estado.loops))
         
         # Se há loop atual, buscar atletas participantes
         atletas_ativos = []
         atletas_eliminados = []
         if loop_atual:
-            # Buscar atletas ativos E concluídos do loop atual
-            atletas_ativos_puro = loop_atual.get_atletas_ativos()
-            atletas_concluidos = loop_atual.get_atletas_concluidos()
-            
-            # Combinar e ordenar: concluídos primeiro (por tempo), depois ativos
-            atletas_ativos = []
+            corredores = list(estado.corredores.values())
             
-            # Adicionar concluídos primeiro, ordenados por tempo
-            atletas_concluidos_ordenados = sorted(atletas_concluidos, 
-                                                key=lambda x: x.tempo_total_segundos or 0)
-            atletas_ativos.extend(atletas_concluidos_ordenados)
-            
-            # Adicionar ativos depois
-            atletas_ativos.extend(atletas_ativos_puro)
+            # Concluídos primeiro (por tempo), depois os que ainda estão correndo
+            atletas_concluidos = sorted(
+                [c for c in corredores if c.status == AtletaLoopStatus.CONCLUIDO],
+                key=lambda x: x.tempo_total_segundos or 0
+            )
+            atletas_ativos_puro = [c for c in corredores if c.status == AtletaLoopStatus.ATIVO]
+            atletas_ativos = atletas_concluidos + atletas_ativos_puro
             
-            # Buscar todos os atletas eliminados em qualquer loop
-            atletas_eliminados = AtletaLoop.query.join(Loop).filter(
-                Loop.backyard_id == id,
-                AtletaLoop.status.in_([AtletaLoopStatus.ELIMINADO, AtletaLoopStatus.DNF, AtletaLoopStatus.DNS])
-            ).all()
+            # Atletas eliminados em qualquer loop
+            atletas_eliminados = list(estado.eliminados.values())
         
-        # Estatísticas do loop atual
-        atletas_concluidos_count = len(atletas_concluidos) if loop_atual else 0
-        atletas_ativos_puro_count = len(atletas_ativos_puro) if loop_atual else 0
-        
-        stats = {
-            'total_inscritos': total_inscritos,
-            'atletas_ativos': atletas_ativos_puro_count,
-            'atletas_concluidos': atletas_concluidos_count,
-            'atletas_eliminados': len(atletas_eliminados),
-            'loop_atual': loop_atual.numero_loop if loop_atual else 0,
-            'total_loops': len(loops_historico)
-        }
+        stats = estado.estatisticas()
         
         return render_template('backyards/live.html',
                              backyard=backyard,
@@ -274,24 +313,99 @@ def live_view(id):
                              loops_historico=loops_historico,
                              atletas_ativos=atletas_ativos,
                              atletas_eliminados=atletas_eliminados,
-                             stats=stats)
+                             stats=stats,
+                             versao=estado.versao)
     
     except Exception as e:
         print(f"Erro na visualização live: {e}")
         flash('Erro ao carregar visualização em tempo real.', 'danger')
         return redirect(url_for('backyards.view_backyard', id=id))
 
+@backyards_bp.route('/<int:id>/live.json')
+@somente_leitura
+def live_snapshot(id):
+    """Snapshot JSON da corrida com ETag forte derivado de versao_dados (304 se nada mudou)"""
+    estado = race_states.obter(id)
+    if estado is None:
+        abort(404)
+    
+    etag = f"{id}-{estado.versao}"
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+    else:
+        resposta = Response(_snapshot_json(estado), mimetype='application/json')
+    
+    resposta.set_etag(etag)
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+# Último JSON serializado por backyard: (versao, bytes), reaproveitado entre clientes
+_snapshots = {}
+
+def _snapshot_json(estado):
+    """Serializa o RaceState uma única vez por versão"""
+    backyard_id = estado.backyard.id
+    versao, corpo = _snapshots.get(backyard_id, (None, None))
+    if versao != estado.versao:
+        corpo = json.dumps(estado.para_dict(), ensure_ascii=False).encode('utf-8')
+        _snapshots[backyard_id] = (estado.versao, corpo)
+    return corpo
+
+@backyards_bp.route('/<int:id>/live/stream')
+def live_stream(id):
+    """Stream SSE com as alterações da corrida (atleta chegou/eliminado, loop iniciado, vencedor)"""
+    fila, versao = live_broadcaster.assinar(id)
+    if fila is None:
+        abort(404)
+    
+    # Versão com que a página foi renderizada (ou último evento recebido, na reconexão)
+    versao_cliente = request.headers.get('Last-Event-ID') or request.args.get('versao')
+    try:
+        versao_cliente = int(versao_cliente) if versao_cliente else None
+    except ValueError:
+        versao_cliente = None
+    
+    def gerar():
+        try:
+            yield "retry: 3000\n\n"
+            if versao_cliente is not None and versao_cliente < versao:
+                # O cliente perdeu alterações: mais simples recarregar a página inteira
+                yield formatar_evento('recarregar', {}, versao)
+            
+            while True:
+                try:
+                    yield fila.get(timeout=live_broadcaster.KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            live_broadcaster.cancelar(id, fila)
+    
+    return Response(gerar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @backyards_bp.route('/<int:id>/loop/<int:loop_id>')
+@somente_leitura
 def view_loop(id, loop_id):
     """Visualizar detalhes específicos de um loop"""
     try:
         backyard = Backyard.query.get_or_404(id)
         loop = Loop.query.filter_by(id=loop_id, backyard_id=id).first_or_404()
         
-        # Buscar todos os atletas deste loop
-        atletas_loop = AtletaLoop.query.filter_by(loop_id=loop_id).join(
-            AtletaLoop.atleta
-        ).order_by(AtletaLoop.tempo_total_segundos.asc()).all()
+        # Buscar todos os atletas deste loop com nome e número de peito em uma única consulta
+        atletas_loop = [
+            Corredor(atleta_loop, atleta, numero_peito, loop.numero_loop)
+            for atleta_loop, atleta, numero_peito in db.session.query(
+                AtletaLoop, Atleta, AtletaBackyard.numero_peito
+            ).join(
+                Atleta, AtletaLoop.atleta_id == Atleta.id
+            ).outerjoin(
+                AtletaBackyard, and_(AtletaBackyard.atleta_id == Atleta.id, AtletaBackyard.backyard_id == id)
+            ).filter(
+                AtletaLoop.loop_id == loop_id
+            ).order_by(AtletaLoop.tempo_total_segundos.asc())
+        ]
         
         # Separar por status
         atletas_concluidos = [al for al in atletas_loop if al.status == AtletaLoopStatus.CONCLUIDO]
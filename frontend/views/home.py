@@ -7,11 +7,15 @@ from flask import Blueprint, render_template, request
 from flask_login import current_user
 from models import Backyard, BackyardStatus
 from sqlalchemy import desc
+from services.page_cache import em_cache, page_cache, nao_guardar
+from services.replica import somente_leitura
 
 # Create blueprint
 home_bp = Blueprint('home', __name__)
 
 @home_bp.route('/')
+@somente_leitura
+@em_cache(page_cache.versao_catalogo, por_dia=True)
 def index():
     """Página inicial do frontend"""
     try:
@@ -33,6 +37,7 @@ def index():
     
     except Exception as e:
         print(f"Erro na página inicial: {e}")
+        nao_guardar()
         return render_template('home/index.html', 
                              backyards=[],
                              stats={'total_backyards': 0, 'backyards_ativas': 0, 'backyards_proximas': 0})
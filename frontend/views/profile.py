@@ -8,8 +8,9 @@ from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
 from datetime import datetime
 from models import db, Atleta, AtletaBackyard, Backyard
+from sqlalchemy.orm import joinedload
 from services.password_service import PasswordService
-from services.image_service import ImageService
+from services.processamento_imagens import processamento_imagens
 
 # Create blueprint
 profile_bp = Blueprint('profile', __name__)
@@ -20,7 +21,9 @@ def dashboard():
     """Dashboard do atleta"""
     try:
         # Buscar backyards em que o atleta está inscrito
-        inscricoes = AtletaBackyard.query.filter_by(atleta_id=current_user.id).all()
+        inscricoes = AtletaBackyard.query.options(
+            joinedload(AtletaBackyard.backyard)
+        ).filter_by(atleta_id=current_user.id).all()
         
         # Estatísticas do atleta
         stats = {
@@ -82,30 +85,6 @@ def edit():
                     flash('Data de nascimento inválida.', 'danger')
                     return render_template('profile/edit.html')
             
-            # Handle profile image upload (optional)
-            if 'imagem_perfil' in request.files:
-                file = request.files['imagem_perfil']
-                if file and file.filename:
-                    try:
-                        image_service = ImageService()
-                        
-                        # Delete old image if exists
-                        if current_user.imagem_perfil:
-                            image_service.delete_image(current_user.imagem_perfil)
-                        
-                        upload_result = image_service.upload_image(
-                            file, 
-                            image_type='profile_picture',
-                            folder='atletas'
-                        )
-                        if upload_result['success']:
-                            current_user.imagem_perfil = upload_result['file_path']
-                        else:
-                            for error in upload_result.get('errors', []):
-                                flash(f'Erro no upload da imagem: {error}', 'warning')
-                    except Exception as e:
-                        flash('Erro ao fazer upload da imagem.', 'warning')
-            
             # Update atleta data
             current_user.nome = nome
             current_user.email = email
@@ -118,7 +97,28 @@ def edit():
             current_user.pais = pais if pais else None
             current_user.data_ultima_atualizacao = datetime.utcnow()
             
+            # Páginas ao vivo exibem nome e foto do atleta
+            for inscricao in current_user.inscricoes:
+                Backyard.registrar_alteracao(inscricao.backyard_id)
+            
             db.session.commit()
+            
+            # Handle profile image upload (optional): processed in background,
+            # the old image is replaced once the new one is ready
+            file = request.files.get('imagem_perfil')
+            if file and file.filename:
+                upload_result = processamento_imagens.enviar_arquivo(
+                    file,
+                    current_user._get_current_object(),
+                    'imagem_perfil',
+                    image_type='profile_picture'
+                )
+                if upload_result['success']:
+                    flash('Sua foto está sendo processada e aparecerá em instantes.', 'info')
+                else:
+                    for error in upload_result.get('errors', []):
+                        flash(f'Erro no upload da imagem: {error}', 'warning')
+            
             flash('Perfil atualizado com sucesso!', 'success')
             return redirect(url_for('profile.dashboard'))
             
@@ -187,7 +187,9 @@ def change_password():
 def my_backyards():
     """Minhas inscrições em backyards"""
     try:
-        inscricoes = AtletaBackyard.query.filter_by(atleta_id=current_user.id).all()
+        inscricoes = AtletaBackyard.query.options(
+            joinedload(AtletaBackyard.backyard)
+        ).filter_by(atleta_id=current_user.id).all()
         return render_template('profile/my_backyards.html', inscricoes=inscricoes)
     
     except Exception as e: